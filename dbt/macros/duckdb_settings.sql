@@ -0,0 +1,20 @@
+{#
+    SET statements applying the pipeline's DuckDB settings (the DUCKDB_* variables resolved
+    by scripts/db_config.py) before any model runs. Unset variables keep DuckDB's defaults,
+    except preserve_insertion_order, which is off unless asked for.
+#}
+{% macro duckdb_settings() %}
+    {%- set statements = [
+        "SET preserve_insertion_order = " ~ env_var('DUCKDB_PRESERVE_INSERTION_ORDER', 'false')
+    ] -%}
+    {%- if env_var('DUCKDB_MEMORY_LIMIT', '') -%}
+        {%- do statements.append("SET memory_limit = '" ~ env_var('DUCKDB_MEMORY_LIMIT') ~ "'") -%}
+    {%- endif -%}
+    {%- if env_var('DUCKDB_THREADS', '') -%}
+        {%- do statements.append("SET threads = " ~ env_var('DUCKDB_THREADS')) -%}
+    {%- endif -%}
+    {%- if env_var('DUCKDB_TEMP_DIRECTORY', '') -%}
+        {%- do statements.append("SET temp_directory = '" ~ env_var('DUCKDB_TEMP_DIRECTORY') ~ "'") -%}
+    {%- endif -%}
+    {{ statements | join(";\n") }}
+{% endmacro %}
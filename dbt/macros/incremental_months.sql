@@ -0,0 +1,58 @@
+{#
+    Cab type/pickup months an incremental model rebuilds, for its delete+insert on
+    (cab_type, year_month). Each *_months macro is a query of (cab_type, month_start) rows;
+    month_filter runs it when the model is compiled and turns the months into literal
+    pickup_ts ranges, so zone maps prune the model's scan to the changed months.
+
+    reloaded_months: pickup months of `relation` holding trips from source files (re)loaded
+    since the model's last run. Trips are matched to the manifest by source_month, the month
+    of the file they came from, so a stray pickup (a January trip in the February file) is
+    rebuilt with the file that holds it. Months are truncated and grouped before they are
+    formatted, so strftime runs once per month rather than once per row.
+
+    rewritten_months: pickup months trips_transformed rewrote since the model's last run, for
+    the models built on top of it.
+#}
+{% macro reloaded_months(relation, refreshed_column) %}
+    SELECT cab_type, strftime(month_start, '%Y-%m-%d') AS month_start
+    FROM (
+        SELECT
+            CAST(r.cab_type AS VARCHAR) AS cab_type,
+            date_trunc('month', r.pickup_ts) AS month_start
+        FROM {{ relation }} r
+        WHERE r.pickup_ts IS NOT NULL
+          AND (CAST(r.cab_type AS VARCHAR), r.source_month) IN (
+            SELECT cab_type, year_month
+            FROM {{ source('main', 'load_manifest') }}
+            WHERE loaded_at > (SELECT COALESCE(MAX({{ refreshed_column }}), TIMESTAMP '1970-01-01') FROM {{ this }})
+          )
+        GROUP BY ALL
+    )
+{% endmacro %}
+
+{% macro rewritten_months(refreshed_column) %}
+    SELECT DISTINCT
+        CAST(cab_type AS VARCHAR) AS cab_type,
+        year_month || '-01' AS month_start
+    FROM {{ ref('trips_transformed') }}
+    WHERE transformed_at > (SELECT COALESCE(MAX({{ refreshed_column }}), TIMESTAMP '1970-01-01') FROM {{ this }})
+      AND year_month IS NOT NULL
+{% endmacro %}
+
+{% macro month_filter(months_sql, cab_column, pickup_column) %}
+    {%- set months = [] %}
+    {%- if execute %}
+        {%- set months = run_query('SELECT DISTINCT cab_type, month_start FROM (' ~ months_sql ~ ') ORDER BY ALL').rows %}
+    {%- endif %}
+    {%- if months | length == 0 %}
+    FALSE
+    {%- else %}
+    (
+        {%- for cab_type, month_start in months %}
+        {{ 'OR ' if not loop.first }}({{ cab_column }} = '{{ cab_type }}'
+            AND {{ pickup_column }} >= TIMESTAMP '{{ month_start }}'
+            AND {{ pickup_column }} < TIMESTAMP '{{ month_start }}' + INTERVAL 1 MONTH)
+        {%- endfor %}
+    )
+    {%- endif %}
+{% endmacro %}
@@ -0,0 +1,28 @@
+{{ config(
+    materialized='incremental',
+    incremental_strategy='delete+insert',
+    unique_key=['cab_type', 'year_month']
+) }}
+
+-- Hourly CO2 rollup per cab type and pickup date. Every bucket analysis.py reports
+-- (hour, day of week, week, month, year-month) is a re-aggregation of these rows.
+SELECT
+    t.cab_type,
+    t.year_month,
+    CAST(t.pickup_ts AS DATE) AS pickup_date,
+    t.hour_of_day,
+    t.day_of_week,
+    t.week_of_year,
+    t.month_of_year,
+    SUM(t.trip_co2_kgs)       AS co2_kgs_sum,
+    COUNT(*)                  AS trip_count,
+    CAST(now() AS TIMESTAMP)  AS refreshed_at
+
+FROM {{ ref('trips_transformed') }} t
+
+{% if is_incremental() %}
+-- Only re-aggregate months trips_transformed rewrote since the last refresh
+WHERE {{ month_filter(rewritten_months('refreshed_at'), 't.cab_type', 't.pickup_ts') }}
+{% endif %}
+
+GROUP BY ALL
@@ -0,0 +1,133 @@
+{{ config(
+    materialized='incremental',
+    incremental_strategy='delete+insert',
+    unique_key=['cab_type', 'year_month']
+) }}
+
+-- The extreme_trips_per_month most extreme trips per cab type and pickup month by CO2,
+-- distance, duration and average speed, so "largest trip" and outlier reports read a few
+-- rows per month instead of every trip. arg_max(..., n) keeps a bounded heap per group,
+-- so no month is sorted. Metric 'distance_over_cap' lists the longest raw trips that
+-- clean.py drops for trip_distance > 100, for reviewing the cap (it is empty for months
+-- loaded with --clean-on-ingest, which never stores them).
+
+WITH trips AS (
+    SELECT
+        t.cab_type,
+        t.year_month,
+        {
+            'vendorid': t.vendorid,
+            'pickup_ts': t.pickup_ts,
+            'dropoff_ts': t.dropoff_ts,
+            'passenger_count': t.passenger_count,
+            'trip_distance': t.trip_distance,
+            'duration_seconds': DATEDIFF('second', t.pickup_ts, t.dropoff_ts),
+            'trip_co2_kgs': t.trip_co2_kgs,
+            'avg_mph': t.avg_mph
+        } AS trip
+
+    FROM {{ ref('trips_transformed') }} t
+
+    {% if is_incremental() %}
+    -- Only recompute months trips_transformed rewrote since the last refresh
+    WHERE {{ month_filter(rewritten_months('refreshed_at'), 't.cab_type', 't.pickup_ts') }}
+    {% endif %}
+),
+
+over_cap AS (
+    SELECT
+        r.cab_type,
+        strftime(r.pickup_ts, '%Y-%m') AS year_month,
+        {
+            'vendorid': r.vendorid,
+            'pickup_ts': r.pickup_ts,
+            'dropoff_ts': r.dropoff_ts,
+            'passenger_count': r.passenger_count,
+            'trip_distance': r.trip_distance,
+            'duration_seconds': DATEDIFF('second', r.pickup_ts, r.dropoff_ts),
+            'trip_co2_kgs': r.trip_distance * e.co2_grams_per_mile / 1000,
+            'avg_mph': CASE
+                WHEN DATEDIFF('second', r.pickup_ts, r.dropoff_ts) > 0
+                THEN r.trip_distance / (DATEDIFF('second', r.pickup_ts, r.dropoff_ts) / 3600.0)
+                ELSE 0
+            END
+        } AS trip
+
+    FROM {{ source('main', 'trips') }} r
+    JOIN {{ source('main', 'emissions') }} e
+      ON e.vehicle_type = CAST(r.cab_type AS VARCHAR) || '_taxi'
+    WHERE r.trip_distance > 100
+      AND r.pickup_ts IS NOT NULL
+
+    {% if is_incremental() %}
+      -- The same months as the trips above, so no rebuilt month loses its over-cap rows
+      AND {{ month_filter(rewritten_months('refreshed_at'), 'r.cab_type', 'r.pickup_ts') }}
+    {% endif %}
+),
+
+top_trips AS (
+    SELECT
+        cab_type,
+        year_month,
+        arg_max(trip, trip.trip_co2_kgs, {{ var('extreme_trips_per_month', 10) }})     AS co2,
+        arg_max(trip, trip.trip_distance, {{ var('extreme_trips_per_month', 10) }})    AS distance,
+        arg_max(trip, trip.duration_seconds, {{ var('extreme_trips_per_month', 10) }}) AS duration,
+        arg_max(trip, trip.avg_mph, {{ var('extreme_trips_per_month', 10) }})          AS avg_mph
+    FROM trips
+    GROUP BY ALL
+),
+
+top_over_cap AS (
+    SELECT
+        cab_type,
+        year_month,
+        arg_max(trip, trip.trip_distance, {{ var('extreme_trips_per_month', 10) }}) AS distance_over_cap
+    FROM over_cap
+    GROUP BY ALL
+),
+
+-- One row per (metric, rank); arg_max lists are ordered from the most extreme trip down
+ranked AS (
+    SELECT cab_type, year_month, 'co2' AS metric,
+           UNNEST(co2) AS trip, UNNEST(range(1, len(co2) + 1)) AS metric_rank
+    FROM top_trips
+    UNION ALL
+    SELECT cab_type, year_month, 'distance',
+           UNNEST(distance), UNNEST(range(1, len(distance) + 1))
+    FROM top_trips
+    UNION ALL
+    SELECT cab_type, year_month, 'duration',
+           UNNEST(duration), UNNEST(range(1, len(duration) + 1))
+    FROM top_trips
+    UNION ALL
+    SELECT cab_type, year_month, 'avg_mph',
+           UNNEST(avg_mph), UNNEST(range(1, len(avg_mph) + 1))
+    FROM top_trips
+    UNION ALL
+    SELECT cab_type, year_month, 'distance_over_cap',
+           UNNEST(distance_over_cap), UNNEST(range(1, len(distance_over_cap) + 1))
+    FROM top_over_cap
+)
+
+SELECT
+    cab_type,
+    year_month,
+    metric,
+    CAST(metric_rank AS INTEGER) AS metric_rank,
+    CAST(CASE metric
+        WHEN 'co2' THEN trip.trip_co2_kgs
+        WHEN 'duration' THEN trip.duration_seconds
+        WHEN 'avg_mph' THEN trip.avg_mph
+        ELSE trip.trip_distance
+    END AS DOUBLE) AS metric_value,
+    trip.vendorid,
+    trip.pickup_ts,
+    trip.dropoff_ts,
+    trip.passenger_count,
+    trip.trip_distance,
+    trip.duration_seconds,
+    trip.trip_co2_kgs,
+    trip.avg_mph,
+    CAST(now() AS TIMESTAMP) AS refreshed_at
+
+FROM ranked
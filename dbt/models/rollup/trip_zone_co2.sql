@@ -0,0 +1,28 @@
+{{ config(
+    materialized='incremental',
+    incremental_strategy='delete+insert',
+    unique_key=['cab_type', 'year_month']
+) }}
+
+-- CO2 per cab type, pickup month, pickup zone and hour of day, backing the zone heatmaps
+-- (queries.py co2_zones). zone_id is the TLC LocationID, a SMALLINT code into taxi_zones,
+-- so no borough or zone names are stored per row. Trips without zone IDs (loaded without
+-- load.py --zones, or from files before mid-2016) are left out.
+SELECT
+    t.cab_type,
+    t.year_month,
+    t.pu_location_id                  AS zone_id,
+    CAST(t.hour_of_day AS TINYINT)    AS hour_of_day,
+    SUM(t.trip_co2_kgs)               AS co2_kgs_sum,
+    COUNT(*)                          AS trip_count,
+    CAST(now() AS TIMESTAMP)          AS refreshed_at
+
+FROM {{ ref('trips_transformed') }} t
+WHERE t.pu_location_id IS NOT NULL
+
+{% if is_incremental() %}
+-- Only re-aggregate months trips_transformed rewrote since the last refresh
+  AND {{ month_filter(rewritten_months('refreshed_at'), 't.cab_type', 't.pickup_ts') }}
+{% endif %}
+
+GROUP BY ALL
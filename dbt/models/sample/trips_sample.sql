@@ -0,0 +1,40 @@
+{{ config(
+    materialized='incremental',
+    incremental_strategy='delete+insert',
+    unique_key=['cab_type', 'year_month'],
+    on_schema_change='append_new_columns'
+) }}
+
+-- Stratified sample of trips_transformed for analysis.py --approx: up to
+-- sample_rows_per_stratum trips per cab type and pickup month. Trips are ranked by a hash
+-- of the trip key, so a month's sample only changes when the month is reloaded.
+-- stratum_rows is the month's trip count; stratum_rows / COUNT(*) weights a sampled trip.
+-- vendorid and passenger_count complete the trip key approx.py counts distinct trips by;
+-- months sampled before they were added have them NULL until resampled.
+SELECT * EXCLUDE (sample_rank)
+FROM (
+    SELECT
+        t.cab_type,
+        t.year_month,
+        t.vendorid,
+        t.pickup_ts,
+        t.dropoff_ts,
+        t.passenger_count,
+        t.trip_distance,
+        t.trip_co2_kgs,
+        t.avg_mph,
+        COUNT(*) OVER (PARTITION BY t.cab_type, t.year_month) AS stratum_rows,
+        ROW_NUMBER() OVER (
+            PARTITION BY t.cab_type, t.year_month
+            ORDER BY hash(t.vendorid, t.pickup_ts, t.dropoff_ts, t.passenger_count, t.trip_distance)
+        ) AS sample_rank,
+        CAST(now() AS TIMESTAMP) AS sampled_at
+
+    FROM {{ ref('trips_transformed') }} t
+
+    {% if is_incremental() %}
+    -- Only resample months trips_transformed rewrote since the last refresh
+    WHERE {{ month_filter(rewritten_months('sampled_at'), 't.cab_type', 't.pickup_ts') }}
+    {% endif %}
+)
+WHERE sample_rank <= {{ var('sample_rows_per_stratum', 10000) }}
@@ -0,0 +1,49 @@
+{{ config(
+    materialized='incremental',
+    incremental_strategy='delete+insert',
+    unique_key=['cab_type', 'year_month'],
+    on_schema_change='append_new_columns'
+) }}
+
+SELECT
+    t.*,
+    
+    -- CO2 per trip in kilograms
+    t.trip_distance * e.co2_grams_per_mile / 1000 AS trip_co2_kgs,
+    
+    -- Average MPH per trip
+    CASE 
+        WHEN DATEDIFF('second', t.pickup_ts, t.dropoff_ts) > 0
+        THEN t.trip_distance / (DATEDIFF('second', t.pickup_ts, t.dropoff_ts) / 3600.0)
+        ELSE 0
+    END AS avg_mph,
+    
+    -- Time breakdowns
+    EXTRACT('hour' FROM t.pickup_ts)  AS hour_of_day,
+    EXTRACT('dow'  FROM t.pickup_ts)  AS day_of_week,
+    EXTRACT('week' FROM t.pickup_ts)  AS week_of_year,
+    EXTRACT('month' FROM t.pickup_ts) AS month_of_year,
+
+    -- Incremental partition key and the run that wrote the row
+    strftime(t.pickup_ts, '%Y-%m') AS year_month,
+    CAST(now() AS TIMESTAMP) AS transformed_at
+
+FROM {{ source('main', 'trips_clean') }} t
+JOIN {{ source('main', 'emissions') }} e
+  ON e.vehicle_type = CAST(t.cab_type AS VARCHAR) || '_taxi'
+
+{% if is_incremental() %}
+-- Only rebuild cab type/pickup months holding trips of files (re)loaded since this model
+-- last ran, by the files' source_month: the months of the reloaded trips, and the months
+-- those files contributed to before (a trip dropped from a file leaves its month too).
+-- Use `dbt run --full-refresh` after re-cleaning or changing the emissions lookup.
+{%- set columns = adapter.get_columns_in_relation(this) | map(attribute='name') | list %}
+{%- set months_sql %}
+    {{ reloaded_months(source('main', 'trips_clean'), 'transformed_at') }}
+    {%- if 'source_month' in columns %}
+    UNION
+    {{ reloaded_months(this, 'transformed_at') }}
+    {%- endif %}
+{%- endset %}
+WHERE {{ month_filter(months_sql, 't.cab_type', 't.pickup_ts') }}
+{% endif %}
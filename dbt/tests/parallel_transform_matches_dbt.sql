@@ -0,0 +1,39 @@
+{#
+    Rows that differ between the dbt-built trips_transformed and the table written by the
+    parallel DuckDB transform (scripts/transform.py), compared as multisets of rows without
+    the run timestamp. The test fails with one row per difference, side = 'missing' (only in
+    trips_transformed) or 'extra' (only in the parallel table).
+
+    Opt-in, since the parallel table is only current right after it was written:
+
+        python scripts/transform.py --target trips_transformed_parallel --full-refresh
+        dbt test --select parallel_transform_matches_dbt \
+            --vars '{parallel_transform_target: trips_transformed_parallel}'
+
+    Without the var, or when the table does not exist, there is nothing to compare.
+#}
+{%- set reference = ref('trips_transformed') %}
+{%- set target_name = var('parallel_transform_target', none) %}
+{%- set parallel = none %}
+{%- if execute and target_name %}
+    {%- set parallel = adapter.get_relation(database=reference.database, schema=reference.schema,
+                                            identifier=target_name) %}
+{%- endif %}
+
+{%- if parallel is none %}
+SELECT NULL AS side WHERE FALSE
+{%- else %}
+{%- set columns = adapter.get_columns_in_relation(reference) | map(attribute='name')
+                  | reject('equalto', 'transformed_at') | join(', ') %}
+(
+    SELECT 'missing' AS side, {{ columns }} FROM {{ reference }}
+    EXCEPT ALL
+    SELECT 'missing', {{ columns }} FROM {{ parallel }}
+)
+UNION ALL
+(
+    SELECT 'extra', {{ columns }} FROM {{ parallel }}
+    EXCEPT ALL
+    SELECT 'extra', {{ columns }} FROM {{ reference }}
+)
+{%- endif %}
@@ -1,8 +1,21 @@
-import duckdb
+import os
+import sys
 import logging
+import argparse
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
 from pathlib import Path
 import calendar
+from datetime import date
+
+from tracing import Tracer
+from queries import CO2Queries, DEFAULT_START, DEFAULT_END, zone_labels, zones_available
+from approx import SAMPLE_METHODS, approx_summary, exact_summary, format_summary
+from extremes import largest_trips, extremes_available
+from db_config import add_db_arguments, settings_from_args, load_settings, describe
 
 # Configure logging for analysis
 logging.basicConfig(
@@ -17,153 +30,308 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def analyze_trips():
+# Plots are rendered off-screen; one figure is reused for every chart
+DEFAULT_PLOT_DIR = "plots"
+DEFAULT_DPI = 300
+CAB_STYLES = {"yellow": ("Yellow", "gold"), "green": ("Green", "green")}
+# Pickup zones shown in the zone x hour heatmap (those with the most CO2)
+HEATMAP_ZONES = 20
+
+# Rollup buckets reported and plotted: name -> (column, report label, plot title)
+BUCKETS = {
+    "hour": ("hour_of_day", "HOUR", "Average CO₂ per Trip by Hour of Day (kg)"),
+    "day": ("day_of_week", "DAY", "Average CO₂ per Trip by Day of Week (kg)"),
+    "week": ("week_of_year", "WEEK", "Average CO₂ per Trip by Week of Year (kg)"),
+    "month": ("month_of_year", "MONTH", "Average CO₂ per Trip by Month (kg)"),
+}
+
+
+def both_cabs(per_cab):
+    # Long-format series {cab, ...} from one result of arrays per cab type
+    series = {"cab": np.concatenate([np.full(len(next(iter(arrays.values()))), cab, dtype=object)
+                                     for cab, arrays in per_cab.items()])}
+    for key in next(iter(per_cab.values())):
+        series[key] = np.concatenate([arrays[key] for arrays in per_cab.values()])
+    return series
+
+
+def cab_slice(series, cab, x, y):
+    # The (x, y) arrays of one cab type from a long-format series
+    mask = series["cab"] == cab
+    return series[x][mask], series[y][mask]
+
+
+def write_series(con, series, path, fmt):
+    # Write a fetched series next to its plot, through DuckDB (no pyarrow needed)
+    con.register("series_frame", pd.DataFrame(series))
+    try:
+        con.execute(f"COPY (SELECT * FROM series_frame) TO '{path}' (FORMAT {fmt.upper()});")
+    finally:
+        con.unregister("series_frame")
+
+
+def render_plot(fig, series, x, y, title, xlabel, ylabel, path, dpi, tick_step=1, tick_labels=None):
+    # Draw yellow and green lines of one series on the shared figure and save it
+    fig.clf()
+    ax = fig.add_subplot()
+    for cab, (label, color) in CAB_STYLES.items():
+        xs, ys = cab_slice(series, cab, x, y)
+        ax.plot(xs, ys, marker="o", markersize=3, label=label, color=color, linewidth=1)
+
+    # Title and axis labels
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+
+    # Sparse ticks for long axes (e.g. yearly on the month-year axis), named labels for buckets
+    xs = np.unique(series[x])
+    ticks = xs[::tick_step]
+    ax.set_xticks(ticks, labels=[tick_labels.get(int(t), t) for t in ticks] if tick_labels else ticks,
+                  rotation=45 if tick_step > 1 else 0)
+
+    # Cleaner grid (major only), no top/right borders
+    ax.grid(True, linestyle="--", linewidth=0.5, alpha=0.7, which="major")
+    ax.minorticks_off()
+    ax.spines["top"].set_visible(False)
+    ax.spines["right"].set_visible(False)
+
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(path, dpi=dpi)
+
+
+def zone_hour_matrix(series, top=HEATMAP_ZONES):
+    # (zone ids, top x 24 matrix of CO2 kg) of the `top` pickup zones with the most CO2,
+    # summed over the rows of a zone series
+    ids, rows = np.unique(series["zone_id"], return_inverse=True)
+    matrix = np.zeros((len(ids), 24))
+    np.add.at(matrix, (rows, series["hour_of_day"].astype(int)), series["co2_kgs"])
+    order = np.argsort(matrix.sum(axis=1))[::-1][:top]
+    return ids[order], matrix[order]
+
+
+def render_heatmap(fig, zone_ids, matrix, labels, title, path, dpi):
+    # Pickup zone x hour of day heatmap of CO2 on the shared figure
+    fig.clf()
+    ax = fig.add_subplot()
+    image = ax.imshow(matrix, aspect="auto", cmap="viridis")
+    ax.set_title(title)
+    ax.set_xlabel("Hour of day")
+    ax.set_ylabel("Pickup zone")
+    ax.set_xticks(range(24))
+    ax.set_yticks(range(len(zone_ids)), labels=[labels.get(int(z), f"zone {z}") for z in zone_ids], fontsize=7)
+    fig.colorbar(image, ax=ax, label="Total CO₂ (kg)")
+    fig.tight_layout()
+    fig.savefig(path, dpi=dpi)
+
+
+def run_analysis(con, tracer, plot_dir=DEFAULT_PLOT_DIR, dpi=DEFAULT_DPI, series_format=None,
+                 start=DEFAULT_START, end=DEFAULT_END, summary=False, approx=False, sample="stratified",
+                 sample_size=None):
+    # Report the largest trips and carbon-heavy buckets between start and end, and plot the
+    # series behind them (raises on error). With series_format ("parquet" or "csv"), every
+    # plotted series is also written to plot_dir so dashboards can read it without querying
+    # the database. With summary, trip-level averages, quantiles and distinct counts are
+    # reported too; approx estimates them (and the largest trips) from a sample instead (see
+    # approx.py), each with its error bound.
+    cab_names = [("YELLOW", "yellow"), ("GREEN", "green")]
+    period = f"{start.year}–{end.year}" if start.year != end.year else f"{start.year}"
+
+    # Maps numeric day/month values to human-readable labels
+    dow_map = {i: name for i, name in enumerate(calendar.day_abbr)}  # 0=Sun, 6=Sat
+    month_map = {i: name for i, name in enumerate(calendar.month_abbr) if i > 0}  # 1=Jan, 12=Dec
+    bucket_labels = {"day": dow_map, "month": month_map}
+
+    # Trip-level statistics, exact or estimated from a sample
+    trip_stats = None
+    if summary or approx:
+        with tracer.step("trip summary"):
+            if approx:
+                trip_stats = approx_summary(con, start, end, method=sample, size=sample_size)
+            else:
+                trip_stats = exact_summary(con, start, end)
+
+    # Find the single largest carbon-producing trip for each cab type, from the per-month top
+    # trips in trip_extremes when the range covers whole months (see extremes.py). The exact
+    # summary found it in its own scan; in approx mode without trip_extremes the largest
+    # sampled trip stands in as a lower bound.
+    sampled_largest = approx and not extremes_available(con, start, end)
+    if trip_stats and (sampled_largest or not approx):
+        largest = {cab: stats["largest"] for cab, stats in trip_stats.items()}
+    else:
+        with tracer.step("largest trips"):
+            largest = largest_trips(con, start, end)
+
+    for name, cab in cab_names:
+        row = largest.get(cab)
+        if row is None:
+            print(f"No {name} trips ({period})")
+            logger.info(f"No {name} trips ({period})")
+            continue
+        bound = "at least " if sampled_largest else ""
+        msg = (f"Largest {name} CO2 trip ({period}): {bound}"
+               f"{row['co2']:.2f} kg, {row['distance']:.2f} miles, {row['pickup']} --> {row['dropoff']}")
+        print(msg)
+        logger.info(msg)
+
+    if trip_stats:
+        mode = f"approximate, {sample} sample, 95% bounds" if approx else "exact"
+        print(f"Trip summary ({period}, {mode}):")
+        logger.info(f"Trip summary ({period}, {mode}):")
+        for name, cab in cab_names:
+            if cab in trip_stats:
+                for line in format_summary(name, trip_stats[cab], approx):
+                    print(f"  {line}")
+                    logger.info(line)
+
+    # Every bucket report below is answered from the hourly rollup maintained by dbt
+    # (trip_co2_rollup) through the cached queries in queries.py. Each bucket's full profile
+    # is fetched once as NumPy arrays; extremes are picked from it and it is plotted as is.
+    queries = CO2Queries(con)
+
+    with tracer.step("bucket series"):
+        buckets = {bucket: both_cabs({cab: queries.co2_profile(cab, bucket, start, end) for _, cab in cab_names})
+                   for bucket in BUCKETS}
+
+    # Report most/least carbon-heavy hours, days, weeks, and months (days and months by name)
+    for name, cab in cab_names:
+        for bucket, (_, label, _) in BUCKETS.items():
+            extremes = queries.co2_extremes(cab, bucket, start, end)
+            if extremes is None:
+                continue
+            (max_bucket, max_avg), (min_bucket, min_avg) = extremes
+            names = bucket_labels.get(bucket)
+            max_name = names[int(max_bucket)] if names else int(max_bucket)
+            min_name = names[int(min_bucket)] if names else int(min_bucket)
+            prefix = "Week " if bucket == "week" else ""
+            print(f"{name} most carbon-heavy {label} ({period}): {prefix}{max_name}, avg {max_avg:.2f} kg")
+            print(f"{name} least carbon-heavy {label} ({period}): {prefix}{min_name}, avg {min_avg:.2f} kg")
+
+    # Calculate monthly totals across the whole range (for plotting)
+    with tracer.step("monthly totals"):
+        monthly = both_cabs({cab: queries.co2_series(cab, "month", start, end) for _, cab in cab_names})
+
+    # CO2 by pickup zone and hour, from trip_zone_co2 when zone IDs were loaded (load.py --zones)
+    zones = None
+    if zones_available(con):
+        with tracer.step("zone totals"):
+            zones = both_cabs({cab: queries.co2_zones(cab, start, end) for _, cab in cab_names})
+        if len(zones["zone_id"]) == 0:
+            zones = None
+    logger.info(f"Query cache: {queries.cache_info()}")
+
+    # Report the most carbon-heavy pickup zone of each cab type (by total CO2), named from
+    # taxi_zones when the lookup was loaded
+    labels = {}
+    if zones is not None:
+        labels = zone_labels(con)
+        for name, cab in cab_names:
+            ids, co2 = cab_slice(zones, cab, "zone_id", "co2_kgs")
+            if len(ids) == 0:
+                continue
+            zone_ids, rows = np.unique(ids, return_inverse=True)
+            totals = np.bincount(rows, weights=co2)
+            top = np.argmax(totals)
+            zone = labels.get(int(zone_ids[top]), f"zone {zone_ids[top]}")
+            msg = f"{name} most carbon-heavy pickup ZONE ({period}): {zone}, {totals[top]:,.2f} kg total"
+            print(msg)
+            logger.info(msg)
+
+    # Create plots/ folder if it doesn’t exist
+    Path(plot_dir).mkdir(parents=True, exist_ok=True)
+
+    # (file name, series, x, y, title, x label, y label, tick step, tick labels)
+    plots = [("decade_monthly_co2_totals", monthly, "period", "co2_kgs", f"Monthly CO₂ Totals (kg) — {period}",
+              "Month-Year", "Total CO₂ (kg)", 12, None)]
+    for bucket, (column, _, title) in BUCKETS.items():
+        plots.append((f"avg_co2_by_{column}", buckets[bucket], "bucket", "avg_co2", f"{title} — {period}",
+                      column.replace("_", " ").capitalize(), "Avg CO₂ per trip (kg)", 4 if bucket == "week" else 1,
+                      bucket_labels.get(bucket)))
+
+    with tracer.step("plots"):
+        fig = plt.figure(figsize=(12, 6))
+        try:
+            for file_name, series, x, y, title, xlabel, ylabel, tick_step, tick_labels in plots:
+                out_path = os.path.join(plot_dir, f"{file_name}.png")
+                render_plot(fig, series, x, y, title, xlabel, ylabel, out_path, dpi, tick_step, tick_labels)
+                print(f"Saved plot: {out_path}")
+                logger.info(f"Saved plot: {out_path}")
+
+                if series_format:
+                    series_path = os.path.join(plot_dir, f"{file_name}.{series_format}")
+                    write_series(con, series, series_path, series_format)
+                    logger.info(f"Saved series: {series_path}")
+
+            if zones is not None:
+                out_path = os.path.join(plot_dir, "co2_by_pickup_zone_and_hour.png")
+                zone_ids, matrix = zone_hour_matrix(zones)
+                render_heatmap(fig, zone_ids, matrix, labels,
+                               f"CO₂ by Pickup Zone and Hour (kg), top {len(zone_ids)} zones — {period}",
+                               out_path, dpi)
+                print(f"Saved plot: {out_path}")
+                logger.info(f"Saved plot: {out_path}")
+
+                if series_format:
+                    series_path = os.path.join(plot_dir, f"co2_by_pickup_zone_and_hour.{series_format}")
+                    write_series(con, zones, series_path, series_format)
+                    logger.info(f"Saved series: {series_path}")
+        finally:
+            plt.close(fig)
+
+
+def analyze_trips(profile=False, settings=None, plot_dir=DEFAULT_PLOT_DIR, dpi=DEFAULT_DPI, series_format=None,
+                  start=DEFAULT_START, end=DEFAULT_END, summary=False, approx=False, sample="stratified",
+                  sample_size=None):
+    # Returns False if the analysis failed
+    ok = True
     con = None
+    # Every statement is timed into logs/traces.jsonl under this stage's run id
+    tracer = Tracer("analysis", profile=profile)
     try:
         # Connect to DuckDB database
-        con = duckdb.connect(database="emissions.duckdb", read_only=False)
+        settings = settings or load_settings()
+        con = tracer.connect(settings)
         print("Connected to DuckDB for analysis")
         logger.info("Connected to DuckDB for analysis")
+        logger.info(f"DuckDB settings: {describe(settings)}")
 
-        yellow_tbl = "main.yellow_trips_transformed"
-        green_tbl = "main.green_trips_transformed"
-
-        # Maps numeric day/month values to human-readable labels
-        dow_map = {i: name for i, name in enumerate(calendar.day_abbr)}  # 0=Sun, 6=Sat
-        month_map = {i: name for i, name in enumerate(calendar.month_abbr) if i > 0}  # 1=Jan, 12=Dec
-
-        # Find the single largest carbon-producing trip for each cab type (2015–2024)
-        for name, tbl, pickup, dropoff in [
-            ("YELLOW", yellow_tbl, "tpep_pickup_datetime", "tpep_dropoff_datetime"),
-            ("GREEN", green_tbl, "lpep_pickup_datetime", "lpep_dropoff_datetime"),
-        ]:
-            row = con.execute(f"""
-                SELECT trip_co2_kgs, trip_distance, {pickup}, {dropoff}
-                FROM {tbl}
-                WHERE {pickup} BETWEEN '2015-01-01' AND '2024-12-31'
-                ORDER BY trip_co2_kgs DESC
-                LIMIT 1
-            """).fetchone()
-
-            msg = (f"Largest {name} CO2 trip (2015–2024): "
-                   f"{row[0]:.2f} kg, {row[1]:.2f} miles, {row[2]} --> {row[3]}")
-            print(msg)
-            logger.info(msg)
-
-        # Helper: calculate most and least carbon-heavy buckets (hour, day, week, month)
-        def report_for_table(table, bucket_sql, pickup):
-            max_row = con.execute(f"""
-                SELECT {bucket_sql} AS bucket, AVG(trip_co2_kgs) AS avg_co2
-                FROM {table}
-                WHERE {pickup} BETWEEN '2015-01-01' AND '2024-12-31'
-                GROUP BY bucket
-                ORDER BY avg_co2 DESC
-                LIMIT 1
-            """).fetchone()
-
-            min_row = con.execute(f"""
-                SELECT {bucket_sql} AS bucket, AVG(trip_co2_kgs) AS avg_co2
-                FROM {table}
-                WHERE {pickup} BETWEEN '2015-01-01' AND '2024-12-31'
-                GROUP BY bucket
-                ORDER BY avg_co2 ASC
-                LIMIT 1
-            """).fetchone()
-
-            return max_row, min_row
-
-        # Report most/least carbon-heavy hours, days, weeks, and months
-        for name, tbl, pickup in [
-            ("YELLOW", yellow_tbl, "tpep_pickup_datetime"),
-            ("GREEN", green_tbl, "lpep_pickup_datetime"),
-        ]:
-            # Hour of day (numeric)
-            max_row, min_row = report_for_table(tbl, f"EXTRACT('hour' FROM {pickup})", pickup)
-            print(f"{name} most carbon-heavy HOUR (2015–2024): {int(max_row[0])}, avg {max_row[1]:.2f} kg")
-            print(f"{name} least carbon-heavy HOUR (2015–2024): {int(min_row[0])}, avg {min_row[1]:.2f} kg")
-
-            # Day of week (map to names like Mon, Tue, etc.)
-            max_row, min_row = report_for_table(tbl, f"EXTRACT('dow' FROM {pickup})", pickup)
-            print(f"{name} most carbon-heavy DAY (2015–2024): {dow_map[int(max_row[0])]}, avg {max_row[1]:.2f} kg")
-            print(f"{name} least carbon-heavy DAY (2015–2024): {dow_map[int(min_row[0])]}, avg {min_row[1]:.2f} kg")
-
-            # Week of year (numeric only)
-            max_row, min_row = report_for_table(tbl, f"EXTRACT('week' FROM {pickup})", pickup)
-            print(f"{name} most carbon-heavy WEEK (2015–2024): Week {int(max_row[0])}, avg {max_row[1]:.2f} kg")
-            print(f"{name} least carbon-heavy WEEK (2015–2024): Week {int(min_row[0])}, avg {min_row[1]:.2f} kg")
-
-            # Month of year (map to names like Jan, Feb, etc.)
-            max_row, min_row = report_for_table(tbl, f"EXTRACT('month' FROM {pickup})", pickup)
-            print(f"{name} most carbon-heavy MONTH (2015–2024): {month_map[int(max_row[0])]}, avg {max_row[1]:.2f} kg")
-            print(f"{name} least carbon-heavy MONTH (2015–2024): {month_map[int(min_row[0])]}, avg {min_row[1]:.2f} kg")
-
-        # Calculate monthly totals across all 10 years (for plotting)
-        monthly_yellow = con.execute(f"""
-            SELECT strftime('%Y-%m', tpep_pickup_datetime) AS ym, SUM(trip_co2_kgs)
-            FROM {yellow_tbl}
-            WHERE tpep_pickup_datetime BETWEEN '2015-01-01' AND '2024-12-31'
-            GROUP BY ym
-            ORDER BY ym
-        """).fetchall()
-
-        monthly_green = con.execute(f"""
-            SELECT strftime('%Y-%m', lpep_pickup_datetime) AS ym, SUM(trip_co2_kgs)
-            FROM {green_tbl}
-            WHERE lpep_pickup_datetime BETWEEN '2015-01-01' AND '2024-12-31'
-            GROUP BY ym
-            ORDER BY ym
-        """).fetchall()
-
-        # Convert DuckDB rows into x and y lists for plotting
-        def to_series(rows):
-            xs = [r[0] for r in rows]
-            ys = [float(r[1]) for r in rows]
-            return xs, ys
-
-        x_y, y_y = to_series(monthly_yellow)
-        x_g, y_g = to_series(monthly_green)
-
-        # Create plots/ folder if it doesn’t exist
-        Path("plots").mkdir(exist_ok=True)
-        plt.figure(figsize=(12, 6))
-
-        # Plot Yellow and Green monthly totals
-        plt.plot(x_y, y_y, marker="o", markersize=3, label="Yellow", color="gold", linewidth=1)
-        plt.plot(x_g, y_g, marker="o", markersize=3, label="Green", color="green", linewidth=1)
-
-        # Title and axis labels
-        plt.title("Monthly CO₂ Totals (kg) — 2015–2024")
-        plt.xlabel("Month-Year")
-        plt.ylabel("Total CO₂ (kg)")
-
-        # Show only yearly ticks on x-axis (every 12 months)
-        plt.xticks(ticks=range(0, len(x_y), 12), labels=[x_y[i] for i in range(0, len(x_y), 12)], rotation=45)
-
-        # Cleaner grid (major only)
-        plt.grid(True, linestyle="--", linewidth=0.5, alpha=0.7, which="major")
-        plt.minorticks_off()
-
-        # Remove top/right borders
-        plt.gca().spines["top"].set_visible(False)
-        plt.gca().spines["right"].set_visible(False)
-
-        # Finalize and save plot
-        plt.legend()
-        plt.tight_layout()
-        out_path = "plots/decade_monthly_co2_totals.png"
-        plt.savefig(out_path, dpi=300)
-        plt.close()
-
-        print(f"Saved plot: {out_path}")
-        logger.info(f"Saved plot: {out_path}")
+        run_analysis(con, tracer, plot_dir=plot_dir, dpi=dpi, series_format=series_format, start=start, end=end,
+                     summary=summary, approx=approx, sample=sample, sample_size=sample_size)
 
     except Exception as e:
         # Catch and log errors
         print(f"An error occurred: {e}")
         logger.error(f"An error occurred: {e}")
+        ok = False
+    finally:
+        tracer.close()
+    return ok
 
 
 if __name__ == "__main__":
-    analyze_trips()
-    print("Analysis process completed")
-    logger.info("Analysis process completed")
+    parser = argparse.ArgumentParser(description="Report CO2 extremes and plot monthly totals")
+    parser.add_argument("--profile", action="store_true",
+                        help="keep DuckDB's EXPLAIN ANALYZE profile of every statement under logs/profiles/")
+    parser.add_argument("--plot-dir", default=DEFAULT_PLOT_DIR, help="directory for the PNG plots")
+    parser.add_argument("--dpi", type=int, default=DEFAULT_DPI, help="resolution of the saved plots")
+    parser.add_argument("--series-format", choices=["parquet", "csv"],
+                        help="also write the data behind each plot in this format")
+    parser.add_argument("--start", type=date.fromisoformat, default=DEFAULT_START, help="first pickup date")
+    parser.add_argument("--end", type=date.fromisoformat, default=DEFAULT_END, help="last pickup date")
+    parser.add_argument("--summary", action="store_true",
+                        help="also report exact trip averages, quantiles and distinct counts")
+    parser.add_argument("--approx", action="store_true",
+                        help="estimate the trip summary and largest trips from a sample, with error bounds")
+    parser.add_argument("--sample", choices=SAMPLE_METHODS, default="stratified",
+                        help="sample for --approx: the persisted trips_sample table or a TABLESAMPLE method")
+    parser.add_argument("--sample-size", type=float,
+                        help="TABLESAMPLE size: percent for system/bernoulli, rows for reservoir")
+    add_db_arguments(parser)
+    args = parser.parse_args()
+
+    ok = analyze_trips(profile=args.profile, settings=settings_from_args(args), plot_dir=args.plot_dir,
+                       dpi=args.dpi, series_format=args.series_format, start=args.start, end=args.end,
+                       summary=args.summary, approx=args.approx, sample=args.sample, sample_size=args.sample_size)
+    print("Analysis process completed" if ok else "Analysis process failed")
+    logger.info("Analysis process completed" if ok else "Analysis process failed")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,333 @@
+import logging
+import math
+
+import numpy as np
+
+from trip_rules import dedup_key
+
+# Approximate trip statistics for interactive exploration (analysis.py --approx). Means and
+# quantiles of trip_co2_kgs and avg_mph are estimated from a sample of trips_transformed:
+# the persisted stratified sample (dbt model trips_sample, refreshed with the transformed
+# models) or an ad-hoc TABLESAMPLE. Every sample is post-stratified by cab type and pickup
+# month against the exact trip counts of trip_co2_rollup, and distinct counts are scaled up
+# from the values seen in each stratum's sample. Every estimate is reported with a 95% error
+# bound; exact_summary computes the same statistics exactly, with bounds of zero.
+
+# Uses the calling stage's logging configuration (e.g. logs/analysis.log)
+logger = logging.getLogger(__name__)
+
+SAMPLE_METHODS = ("stratified", "system", "bernoulli", "reservoir")
+# Default sample size: percent of rows for system/bernoulli, rows for reservoir
+DEFAULT_SAMPLE_SIZE = {"system": 1, "bernoulli": 1, "reservoir": 1_000_000}
+SAMPLE_SEED = 42
+
+QUANTILES = (0.5, 0.9, 0.99)
+Z_95 = 1.96
+
+TRIPS_TBL = "main.trips_transformed"
+SAMPLE_TBL = "main.trips_sample"
+ROLLUP_TBL = "main.trip_co2_rollup"
+
+SAMPLE_COLUMNS = f"""
+    CAST(cab_type AS VARCHAR) AS cab,
+    year_month AS ym,
+    trip_co2_kgs AS co2,
+    avg_mph AS mph,
+    trip_distance AS distance,
+    pickup_ts,
+    dropoff_ts,
+    {dedup_key(fingerprint=True)} AS trip_key
+"""
+
+
+def sample_sql(method, size=None):
+    # Sampled trips {cab, ym, co2, mph, distance, pickup_ts, dropoff_ts, trip_key}; dates
+    # bound as ?, ?
+    if method not in SAMPLE_METHODS:
+        raise ValueError(f"Unknown sample method {method!r}; expected one of {', '.join(SAMPLE_METHODS)}")
+    if method == "stratified":
+        source = SAMPLE_TBL
+    else:
+        size = size or DEFAULT_SAMPLE_SIZE[method]
+        # system samples whole vectors (blocks of rows), bernoulli single rows, reservoir a fixed
+        # row count. Bounds treat sampled rows as independent, so they understate a system
+        # sample's error when neighbouring rows are alike.
+        amount = f"{int(size)} ROWS" if method == "reservoir" else f"{float(size)}%"
+        source = f"{TRIPS_TBL} TABLESAMPLE {amount} ({method}, {SAMPLE_SEED})"
+    return f"""
+        SELECT {SAMPLE_COLUMNS}
+        FROM {source}
+        WHERE pickup_ts >= ? AND pickup_ts < ? + INTERVAL 1 DAY
+    """
+
+
+def weighted_quantiles(values, weights, quantiles=QUANTILES):
+    # [(q, estimate, low, high)] from a weighted sample. The bounds are the sample quantiles at
+    # q -/+ 1.96 * sqrt(q(1-q)/n), with n the effective sample size of the weights.
+    order = np.argsort(values)
+    values, weights = values[order], weights[order]
+    cumulative = np.cumsum(weights) / weights.sum()
+    n_eff = weights.sum() ** 2 / (weights ** 2).sum()
+
+    def at(q):
+        return values[min(np.searchsorted(cumulative, q), len(values) - 1)]
+
+    results = []
+    for q in quantiles:
+        delta = Z_95 * math.sqrt(q * (1 - q) / n_eff)
+        results.append((q, at(q), at(max(q - delta, 0)), at(min(q + delta, 1))))
+    return results
+
+
+def distinct_counts(con, start, end, cabs=None):
+    # cab -> {name: (count, 0)} of distinct pickup times and distinct trips, over every trip
+    # (of `cabs`, default all)
+    cab_filter = "" if cabs is None else f"AND cab_type IN ({', '.join(repr(cab) for cab in cabs)})"
+    rows = con.execute(f"""
+        SELECT
+            CAST(cab_type AS VARCHAR),
+            COUNT(DISTINCT pickup_ts),
+            COUNT(DISTINCT {dedup_key(fingerprint=True)})
+        FROM {TRIPS_TBL}
+        WHERE pickup_ts >= ? AND pickup_ts < ? + INTERVAL 1 DAY
+          {cab_filter}
+        GROUP BY ALL
+    """, [start, end]).fetchall()
+    return {cab: {"distinct pickup times": (pickups, 0), "distinct trips": (trips, 0)}
+            for cab, pickups, trips in rows}
+
+
+def extrapolated_bound(sampling_var, uncovered, spread):
+    # 95% bound of an estimate from the sampled strata that is extended to `uncovered` (rows,
+    # or a share of rows) in strata the sample missed. Those strata are assumed to differ from
+    # the sampled ones by up to `spread` per row, all in the same direction; a trend across
+    # months that the sampled months do not show is not covered.
+    return Z_95 * math.sqrt(sampling_var + (uncovered * (spread or 0)) ** 2)
+
+
+def sample_distinct_counts(con, strata_sql, params):
+    # cab -> {name: (estimate, bound)} of distinct pickup times and distinct trips, from the
+    # sample alone. Pickup months never share a value, so each sampled stratum is estimated on
+    # its own with the Haas-Stokes estimator n * d / (n - f1 + f1 * n / N) (d values seen in n
+    # sampled rows, f1 of them once, N rows in the stratum) and the strata are summed. Strata
+    # the sample missed get the sampled strata's distinct values per row, and the bound widens
+    # by the spread of that ratio between sampled strata, padded with one stratum's worth of
+    # the largest possible variance (0.25) so a few sampled strata that happen to agree do not
+    # give a zero bound. The sampling part of the bound is the error of the distinct share
+    # d / n; it does not cover the estimator's bias, which grows when most values repeat only
+    # a few times.
+    counts = {}
+    for name, column in (("distinct pickup times", "pickup_ts"), ("distinct trips", "trip_key")):
+        rows = con.execute(f"""
+            {strata_sql},
+            frequencies AS (
+                SELECT cab, ym, {column} AS value, COUNT(*) AS seen
+                FROM approx_sample
+                GROUP BY ALL
+            ),
+            stratum_values AS (
+                SELECT
+                    st.cab, st.pop_rows AS pop, st.rows AS n,
+                    COUNT(f.seen) AS d, COUNT(*) FILTER (WHERE f.seen = 1) AS f1
+                FROM strata st
+                LEFT JOIN frequencies f USING (cab, ym)
+                GROUP BY st.cab, st.ym, st.pop_rows, st.rows
+            ),
+            estimates AS (
+                SELECT
+                    cab, pop, n,
+                    CASE WHEN n > 0 THEN n * d / (n - f1 + f1 * n / pop) END AS est,
+                    CASE WHEN n > 0 THEN pop * pop * (1 - n / pop) * (d / n) * (1 - d / n) / n END AS est_var
+                FROM stratum_values
+            )
+            SELECT
+                cab,
+                SUM(est),
+                SUM(est_var),
+                SUM(pop) FILTER (WHERE n > 0),
+                COALESCE(SUM(pop) FILTER (WHERE n = 0), 0),
+                SQRT((COALESCE(VAR_POP(est / pop) * COUNT(est), 0) + 0.25) / COUNT(est))
+            FROM estimates
+            GROUP BY cab
+            HAVING SUM(n) > 0
+        """, params).fetchall()
+        for cab, sampled_est, sampled_var, sampled_pop, uncovered, ratio_spread in rows:
+            ratio = sampled_est / sampled_pop
+            scale = (sampled_pop + uncovered) / sampled_pop
+            bound = extrapolated_bound(sampled_var * scale ** 2, uncovered, ratio_spread)
+            counts.setdefault(cab, {})[name] = (round(sampled_est + ratio * uncovered), bound)
+    return counts
+
+
+def approx_summary(con, start, end, method="stratified", size=None):
+    # cab -> estimated statistics of the trips picked up between start and end (see module note).
+    # The sample is drawn once into a temp table so every estimate below sees the same rows.
+    con.execute(f"CREATE OR REPLACE TEMP TABLE approx_sample AS {sample_sql(method, size)}", [start, end])
+    try:
+        if con.execute("SELECT COUNT(*) FROM approx_sample").fetchone()[0] == 0:
+            # e.g. trips_sample not refreshed since the range was loaded, or a tiny TABLESAMPLE
+            logger.warning(f"The {method} sample has no trips between {start} and {end}; "
+                           f"computing the exact summary instead")
+            return exact_summary(con, start, end)
+        return summarize_sample(con, start, end, method)
+    finally:
+        con.execute("DROP TABLE IF EXISTS approx_sample")
+
+
+def summarize_sample(con, start, end, method):
+    # Every stratum with trips, from the exact counts of the rollup (so partial months and
+    # uneven samples weigh right), with the sample's statistics where it has any (rows = 0
+    # for strata the sample missed, possible with small system samples or a stale trips_sample)
+    strata_sql = f"""
+        WITH population AS (
+            SELECT CAST(cab_type AS VARCHAR) AS cab, year_month AS ym, SUM(trip_count) AS pop_rows
+            FROM {ROLLUP_TBL}
+            WHERE pickup_date BETWEEN ? AND ?
+            GROUP BY ALL
+        ),
+        sampled AS (
+            SELECT
+                cab, ym, COUNT(*) AS rows,
+                AVG(co2) AS co2_mean, COALESCE(VAR_SAMP(co2), 0) AS co2_var,
+                AVG(mph) AS mph_mean, COALESCE(VAR_SAMP(mph), 0) AS mph_var
+            FROM approx_sample
+            GROUP BY ALL
+        ),
+        strata AS (
+            SELECT
+                p.cab, p.ym, p.pop_rows, COALESCE(s.rows, 0) AS rows,
+                s.co2_mean, s.co2_var, s.mph_mean, s.mph_var
+            FROM population p
+            LEFT JOIN sampled s USING (cab, ym)
+        )
+    """
+    params = [start, end]
+
+    # Stratified means over the sampled strata with a finite-population-corrected variance,
+    # the spread of those strata's means (or, with one stratum, of its trips) for the strata
+    # the sample missed, and how many trips those hold
+    def mean_columns(value):
+        return f"""
+            SUM(pop_rows * {value}_mean) / SUM(pop_rows) FILTER (WHERE rows > 0),
+            SUM(pop_rows * pop_rows * (1 - rows / pop_rows) * {value}_var / rows) FILTER (WHERE rows > 0)
+                / POW(SUM(pop_rows) FILTER (WHERE rows > 0), 2),
+            CASE WHEN COUNT({value}_mean) > 1 THEN STDDEV_SAMP({value}_mean)
+                 ELSE SQRT(MAX({value}_var)) END
+        """
+
+    rows = con.execute(f"""
+        {strata_sql}
+        SELECT
+            cab,
+            CAST(SUM(pop_rows) AS BIGINT) AS trips,
+            CAST(SUM(rows) AS BIGINT) AS sampled,
+            CAST(COALESCE(SUM(pop_rows) FILTER (WHERE rows = 0), 0) AS BIGINT) AS uncovered,
+            {mean_columns("co2")},
+            {mean_columns("mph")}
+        FROM strata
+        GROUP BY cab
+    """, params).fetchall()
+    summary = {}
+    unsampled = []
+    for cab, trips, sampled, uncovered, co2, co2_var, co2_spread, mph, mph_var, mph_spread in rows:
+        if sampled == 0:
+            unsampled.append(cab)
+            continue
+        share = uncovered / trips
+        summary[cab] = {"trips": trips, "sampled": sampled, "uncovered": uncovered,
+                        "avg_co2": (co2, extrapolated_bound(co2_var, share, co2_spread)),
+                        "avg_mph": (mph, extrapolated_bound(mph_var, share, mph_spread))}
+
+    # Sampled trips with their weight (stratum trips per sampled trip) for the quantiles
+    trips = con.execute(f"""
+        {strata_sql}
+        SELECT s.cab, s.co2, s.mph, st.pop_rows / st.rows AS weight
+        FROM approx_sample s
+        JOIN strata st USING (cab, ym)
+    """, params).fetchnumpy()
+
+    # The largest sampled trip is only a lower bound on the largest trip
+    largest = dict(con.execute(f"""
+        SELECT cab, arg_max({{'co2': co2, 'distance': distance, 'pickup': pickup_ts, 'dropoff': dropoff_ts}}, co2)
+        FROM approx_sample
+        GROUP BY cab
+    """).fetchall())
+
+    for cab, stats in summary.items():
+        mask = trips["cab"] == cab
+        stats["co2_quantiles"] = weighted_quantiles(trips["co2"][mask], trips["weight"][mask])
+        stats["mph_quantiles"] = weighted_quantiles(trips["mph"][mask], trips["weight"][mask])
+        stats["largest"] = largest.get(cab)
+
+    for cab, counts in sample_distinct_counts(con, strata_sql, params).items():
+        if cab in summary:
+            summary[cab].update(counts)
+    logger.info(f"Approximate summary from {method} sample: "
+                f"{ {cab: stats['sampled'] for cab, stats in summary.items()} } sampled trips, "
+                f"{ {cab: stats['uncovered'] for cab, stats in summary.items()} } trips in strata not sampled")
+
+    # A cab type the sample missed entirely has nothing to extrapolate from
+    if unsampled:
+        logger.warning(f"The {method} sample has no {', '.join(unsampled)} trips between {start} and {end}; "
+                       f"computing their exact summary instead")
+        summary.update(exact_summary(con, start, end, cabs=unsampled))
+    return summary
+
+
+def exact_summary(con, start, end, cabs=None):
+    # The statistics of approx_summary computed over every trip (of `cabs`, default all), with
+    # zero bounds
+    cab_filter = "" if cabs is None else f"AND cab_type IN ({', '.join(repr(cab) for cab in cabs)})"
+    quantiles = ", ".join(str(q) for q in QUANTILES)
+    rows = con.execute(f"""
+        SELECT
+            CAST(cab_type AS VARCHAR),
+            COUNT(*),
+            AVG(trip_co2_kgs),
+            AVG(avg_mph),
+            quantile_disc(trip_co2_kgs, [{quantiles}]),
+            quantile_disc(avg_mph, [{quantiles}]),
+            arg_max({{'co2': trip_co2_kgs, 'distance': trip_distance, 'pickup': pickup_ts, 'dropoff': dropoff_ts}},
+                    trip_co2_kgs)
+        FROM {TRIPS_TBL}
+        WHERE pickup_ts >= ? AND pickup_ts < ? + INTERVAL 1 DAY
+          {cab_filter}
+        GROUP BY ALL
+    """, [start, end]).fetchall()
+    summary = {}
+    for cab, trips, co2, mph, co2_q, mph_q, largest in rows:
+        summary[cab] = {
+            "trips": trips,
+            "sampled": trips,
+            "uncovered": 0,
+            "avg_co2": (co2, 0.0),
+            "avg_mph": (mph, 0.0),
+            "co2_quantiles": [(q, v, v, v) for q, v in zip(QUANTILES, co2_q)],
+            "mph_quantiles": [(q, v, v, v) for q, v in zip(QUANTILES, mph_q)],
+            "largest": largest,
+        }
+    for cab, counts in distinct_counts(con, start, end, cabs).items():
+        summary[cab].update(counts)
+    return summary
+
+
+def format_summary(name, stats, approx):
+    # Report lines for one cab type's summary
+    def pm(value, bound):
+        return f"{value:,.2f} ± {bound:,.2f}" if approx else f"{value:,.2f}"
+
+    sampled = f" ({stats['sampled']:,} sampled"
+    if stats.get("uncovered"):
+        sampled += f"; {stats['uncovered']:,} in months the sample missed, extrapolated"
+    lines = [f"{name} trips: {stats['trips']:,}" + (sampled + ")" if approx else "")]
+    lines.append(f"{name} avg CO2 per trip: {pm(*stats['avg_co2'])} kg")
+    lines.append(f"{name} avg mph: {pm(*stats['avg_mph'])}")
+    for label, key, unit in (("CO2", "co2_quantiles", " kg"), ("mph", "mph_quantiles", "")):
+        for q, value, low, high in stats[key]:
+            bound = f" [{low:,.2f}, {high:,.2f}]" if approx else ""
+            lines.append(f"{name} p{round(q * 100)} {label}: {value:,.2f}{unit}{bound}")
+    for label in ("distinct pickup times", "distinct trips"):
+        if label in stats:
+            value, bound = stats[label]
+            lines.append(f"{name} {label}: {value:,}" + (f" ± {bound:,.0f}" if approx else ""))
+    return lines
@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from db_config import settings_env
+
+# Make sure logs/ folder exists
+os.makedirs("logs", exist_ok=True)
+
+# Configure logging for the benchmark harness
+logging.basicConfig(
+    filename="logs/benchmark.log",
+    encoding="utf-8",
+    filemode="a",
+    format="{asctime} - {levelname} - {message}",
+    style="{",
+    datefmt="%Y-%m-%d %H:%M",
+    level="DEBUG"
+)
+
+logger = logging.getLogger(__name__)
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+SCRIPTS_DIR = REPO_ROOT / "scripts"
+DBT_DIR = REPO_ROOT / "dbt"
+
+DEFAULT_SCALES = [1_000_000, 10_000_000, 100_000_000]
+
+# DuckDB settings compared by --sweep: DuckDB's own defaults, then each db_config setting on
+# its own, then all of them together. {workdir} is replaced with the scale's working directory.
+SETTINGS_SWEEP = [
+    ("duckdb defaults", {"preserve_insertion_order": True}),
+    ("preserve_insertion_order=false", {"preserve_insertion_order": False}),
+    ("threads=2", {"preserve_insertion_order": True, "threads": 2}),
+    ("memory_limit=2GB", {"preserve_insertion_order": True, "memory_limit": "2GB"}),
+    ("memory_limit=2GB + temp_directory", {"preserve_insertion_order": True, "memory_limit": "2GB",
+                                           "temp_directory": "{workdir}/spill"}),
+    ("all", {"preserve_insertion_order": False, "threads": 2, "memory_limit": "2GB",
+             "temp_directory": "{workdir}/spill"}),
+]
+
+
+def pipeline_stages(data_dir, workdir):
+    # (stage name, command) for every timed stage, run from inside workdir
+    python = sys.executable
+    dbt = ["dbt", "run", "--project-dir", str(DBT_DIR), "--profiles-dir", str(DBT_DIR),
+           "--target-path", str(workdir / "dbt_target"), "--log-path", str(workdir / "logs")]
+    return [
+        ("load_parquet_files", [python, str(SCRIPTS_DIR / "load.py"), "--base-url", data_dir.as_uri(),
+                                "--mirror-dir", str(workdir / "mirror"), "--workers", "8",
+                                "--rate", "1000", "--burst", "1000"]),
+        ("clean_trips", [python, str(SCRIPTS_DIR / "clean.py")]),
+        ("dbt_trips_transformed", dbt + ["--select", "trips_transformed"]),
+        # The parallel DuckDB transform into a side table, checked row by row against dbt's
+        ("transform_parallel", [python, str(SCRIPTS_DIR / "transform.py"), "--target",
+                                "trips_transformed_parallel", "--full-refresh", "--verify"]),
+        ("dbt_trip_co2_rollup", dbt + ["--select", "trip_co2_rollup"]),
+        ("analyze_trips", [python, str(SCRIPTS_DIR / "analysis.py")]),
+    ]
+
+
+def run_stage(command, cwd, env=None):
+    # Run one stage as a child process; returns (exit code, wall seconds, peak RSS in MB)
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # wait4 reports the resource usage of this child alone
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    peak_mb = usage.ru_maxrss / (1024 ** 2 if sys.platform == "darwin" else 1024)
+    return proc.returncode, elapsed, peak_mb
+
+
+def stage_result(name, rows, label, status, code=None, elapsed=None, peak_mb=None, error=None):
+    return {
+        "stage": name,
+        "rows": rows,
+        "settings": label,
+        "status": status,
+        "exit_code": code,
+        "wall_seconds": round(elapsed, 3) if elapsed is not None else None,
+        "peak_rss_mb": round(peak_mb, 1) if peak_mb is not None else None,
+        "rows_per_sec": round(rows / elapsed) if elapsed else None,
+        "error": error,
+    }
+
+
+def benchmark_scale(rows, results, keep=False, variants=(("configured", None),)):
+    # Generate `rows` synthetic trips, then time every pipeline stage on a fresh database once
+    # per (label, DuckDB settings) variant; None runs with the settings configured for the repo.
+    # Results are appended to `results` as each stage finishes, so an error keeps what was
+    # measured before it. A stage that fails (exits non-zero or cannot be started) is recorded
+    # as failed and the variant's later stages as skipped.
+    workdir = Path(tempfile.mkdtemp(prefix=f"taxi_bench_{rows}_"))
+    data_dir = workdir / "tlc"
+    try:
+        # Stages use paths relative to the working directory (logs/, data/, emissions.duckdb)
+        (workdir / "data").mkdir()
+        (workdir / "logs").mkdir()
+        shutil.copy(REPO_ROOT / "data" / "vehicle_emissions.csv", workdir / "data" / "vehicle_emissions.csv")
+
+        gen_start = time.perf_counter()
+        subprocess.run([sys.executable, str(SCRIPTS_DIR / "generate_data.py"), "--rows", str(rows),
+                        "--output-dir", str(data_dir)], cwd=workdir, check=True, stdout=subprocess.DEVNULL)
+        logger.info(f"Generated {rows:,} rows in {time.perf_counter() - gen_start:.1f}s")
+
+        for label, settings in variants:
+            # Every variant starts from an empty database and parquet mirror
+            for path in (workdir / "emissions.duckdb", workdir / "emissions.duckdb.wal"):
+                path.unlink(missing_ok=True)
+            shutil.rmtree(workdir / "mirror", ignore_errors=True)
+            shutil.rmtree(workdir / "spill", ignore_errors=True)
+
+            settings = {key: value.format(workdir=workdir) if isinstance(value, str) else value
+                        for key, value in (settings or {}).items()}
+            # A variant's settings replace any DUCKDB_* variables of the calling environment
+            env = {key: value for key, value in os.environ.items() if not (settings and key.startswith("DUCKDB_"))}
+            env.update(settings_env({**settings, "database": workdir / "emissions.duckdb"}))
+
+            failed = None
+            for name, command in pipeline_stages(data_dir, workdir):
+                if failed is not None:
+                    result = stage_result(name, rows, label, "skipped", error=f"{failed} failed")
+                else:
+                    try:
+                        code, elapsed, peak_mb = run_stage(command, workdir, env)
+                        status = "ok" if code == 0 else "failed"
+                        result = stage_result(name, rows, label, status, code, elapsed, peak_mb,
+                                              None if code == 0 else f"exit code {code}")
+                    except Exception as e:
+                        result = stage_result(name, rows, label, "failed", error=str(e))
+                    if result["status"] == "failed":
+                        failed = name
+                results.append(result)
+
+                if result["status"] == "ok":
+                    logger.info(f"Benchmark {json.dumps(result)}")
+                    print(f"{rows:>13,} rows  {label:<34} {name:<24} {result['wall_seconds']:8.2f}s  "
+                          f"{result['peak_rss_mb']:8.1f} MB")
+                else:
+                    logger.error(f"Benchmark {json.dumps(result)}")
+                    print(f"{rows:>13,} rows  {label:<34} {name:<24} {result['status']}: {result['error']}")
+    finally:
+        if keep:
+            print(f"Kept benchmark working directory: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_benchmarks(scales=DEFAULT_SCALES, output=None, keep=False, sweep=False):
+    # Returns the report; "ok" is False if any stage or scale failed
+    report = {"started_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": [], "errors": []}
+    variants = SETTINGS_SWEEP if sweep else (("configured", None),)
+    for rows in scales:
+        try:
+            benchmark_scale(rows, report["results"], keep=keep, variants=variants)
+        except Exception as e:
+            # e.g. data generation failed; stages already measured stay in the report
+            print(f"An error occurred: {e}")
+            logger.error(f"An error occurred at {rows:,} rows: {e}")
+            report["errors"].append({"rows": rows, "error": str(e)})
+    report["ok"] = not report["errors"] and all(result["status"] == "ok" for result in report["results"])
+
+    text = json.dumps(report, indent=2)
+    if output:
+        Path(output).write_text(text)
+        logger.info(f"Wrote benchmark report to {output}")
+    print(text)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time load → clean → dbt → analysis on synthetic data")
+    parser.add_argument("--scales", type=int, nargs="+", default=DEFAULT_SCALES, help="total synthetic rows per run")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--keep", action="store_true", help="keep each scale's working directory")
+    parser.add_argument("--sweep", action="store_true",
+                        help="repeat each scale under every DuckDB settings variant in SETTINGS_SWEEP")
+    args = parser.parse_args()
+
+    report = run_benchmarks(scales=args.scales, output=args.output, keep=args.keep, sweep=args.sweep)
+    logger.info("Benchmark completed" if report["ok"] else "Benchmark completed with failures")
+    sys.exit(0 if report["ok"] else 1)
@@ -1,5 +1,13 @@
-import duckdb
+import sys
 import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from quality import record_table_stats
+from tracing import Tracer
+from db_config import add_db_arguments, settings_from_args, load_settings, describe
+from trip_rules import (CAB_COLUMNS, PICKUP, valid_trip_predicate, dedup_key, month_partitions, drop_relation,
+                        ensure_clean_table, create_compat_views)
 
 # Configure logging for cleaning process
 logging.basicConfig(
@@ -14,165 +22,244 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_DEDUP_WORKERS = 1
+
+
+def ingest_rejections(con, cab):
+    # Rows rejected while loading with --clean-on-ingest or --stream: (removed, bad passengers,
+    # bad distance, bad duration); duplicates dropped by --stream are not counted as removed
+    return con.execute("""
+        SELECT
+            COALESCE(SUM(total_rows - kept_rows - COALESCE(duplicate_rows, 0)), 0),
+            COALESCE(SUM(bad_passengers), 0),
+            COALESCE(SUM(bad_distance), 0),
+            COALESCE(SUM(bad_duration), 0)
+        FROM ingest_rejections
+        WHERE cab_type = ?
+    """, [cab]).fetchone()
+
+
+def dedup_partition(con, source, target, predicate, valid_sql, fingerprint):
+    # Insert the valid, de-duplicated trips of one pickup month into target; returns rows kept.
+    # Duplicates share a pickup timestamp, so they can never span two partitions. The raw
+    # table is appended one source month at a time, so zone maps prune most row groups.
+    return con.execute(f"""
+        INSERT INTO {target}
+        SELECT * EXCLUDE rn
+        FROM (
+            SELECT *,
+                ROW_NUMBER() OVER (
+                    PARTITION BY {dedup_key(fingerprint)}
+                    ORDER BY {PICKUP}
+                ) AS rn
+            FROM {source}
+            WHERE {predicate}
+              AND {valid_sql}
+        )
+        WHERE rn = 1;
+    """).fetchone()[0]
+
+
+def remaining_duplicates(con, table, predicate):
+    # Sanity check: duplicate keys left in one pickup month of table
+    return con.execute(f"""
+        SELECT COUNT(*) FROM (
+            SELECT {dedup_key()}, COUNT(*) AS c
+            FROM {table}
+            WHERE {predicate}
+            GROUP BY ALL
+            HAVING c > 1
+        )
+    """).fetchone()[0]
+
+
+def dedup_trips(con, source, target, validate=True, workers=DEFAULT_DEDUP_WORKERS, fingerprint=False,
+                cabs=None):
+    # Rebuild target from source one cab type and pickup month at a time, dropping invalid
+    # rows (when validate) and duplicates. Partitions run in sequence, or on `workers` cursors
+    # in parallel under the connection's memory_limit. With `cabs`, only those cab types'
+    # rows of an existing target are replaced. Partitions are written to a staging table that
+    # replaces target (or its cab types' rows) in one transaction once every partition has
+    # succeeded, so a failed run leaves target as it was. Returns cab type ->
+    # (invalid removed, duplicates removed, duplicates remaining).
+    valid_sql = valid_trip_predicate() if validate else "TRUE"
+    partitions = month_partitions(con, source, valid_sql, cabs or CAB_COLUMNS)
+
+    staging = f"{target}__new" if cabs is None else f"{target}__{'_'.join(cabs)}"
+    con.execute(f"DROP TABLE IF EXISTS {staging};")
+    con.execute(f"CREATE TABLE {staging} AS SELECT * FROM {source} LIMIT 0;")
+
+    def run(partition):
+        cab, predicate, ym, total, valid = partition
+        cursor = con.cursor()
+        try:
+            kept = dedup_partition(cursor, source, staging, predicate, valid_sql, fingerprint)
+            remaining = remaining_duplicates(cursor, staging, predicate)
+        finally:
+            cursor.close()
+        dupes = valid - kept
+        logger.info(f"{cab.capitalize()} {ym}: {total} rows, {total - valid} invalid, {dupes} duplicates removed")
+        return cab, (total - valid, dupes, remaining)
 
-def clean_trips():
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(run, partitions))
+    except Exception:
+        con.execute(f"DROP TABLE IF EXISTS {staging};")
+        raise
+
+    # Swap the staged rows in
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        if cabs is None:
+            drop_relation(con, target)
+            con.execute(f"ALTER TABLE {staging} RENAME TO {target};")
+        else:
+            con.execute(f"DELETE FROM {target} WHERE cab_type IN ({', '.join(repr(cab) for cab in cabs)});")
+            con.execute(f"INSERT INTO {target} BY NAME SELECT * FROM {staging};")
+            con.execute(f"DROP TABLE {staging};")
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+
+    totals = {cab: (0, 0, 0) for cab in cabs or CAB_COLUMNS}
+    for cab, counts in results:
+        totals[cab] = tuple(a + b for a, b in zip(totals[cab], counts))
+    return totals
+
+
+def streamed_counts(con, target, workers=DEFAULT_DEDUP_WORKERS, cabs=None):
+    # Trips loaded with load.py --stream were validated and de-duplicated on their way into
+    # target, so it is only checked, one pickup month at a time. Returns cab type ->
+    # (invalid removed, duplicates removed, duplicates remaining), as dedup_trips does.
+    cabs = cabs or CAB_COLUMNS
+    partitions = month_partitions(con, target, "TRUE", cabs)
+
+    def run(partition):
+        cab, predicate, _, _, _ = partition
+        cursor = con.cursor()
+        try:
+            return cab, remaining_duplicates(cursor, target, predicate)
+        finally:
+            cursor.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run, partitions))
+
+    # Rows dropped on the way in, as recorded per source file by the streaming load
+    rows = con.execute(f"""
+        SELECT cab_type, SUM(total_rows - kept_rows - duplicate_rows), SUM(duplicate_rows)
+        FROM ingest_rejections
+        WHERE cab_type IN ({', '.join(repr(cab) for cab in cabs)})
+        GROUP BY cab_type
+    """).fetchall()
+    rejected = {cab: (invalid, dupes) for cab, invalid, dupes in rows}
+
+    totals = {}
+    for cab in cabs:
+        invalid, dupes = rejected.get(cab, (0, 0))
+        totals[cab] = (invalid, dupes, sum(n for c, n in results if c == cab))
+    return totals
+
+
+def report_cab(con, cab, counts, stats, clean_on_ingest):
+    # Log removal counts and the post-clean sanity checks for one cab type
+    label = cab.capitalize()
+    invalid_removed, dupes_removed, remaining_dupes = counts
+
+    if clean_on_ingest:
+        invalid_removed, rej_pass, rej_dist, rej_dur = ingest_rejections(con, cab)
+        print(f"{label} trips rejected on ingest: {rej_pass} bad passengers, {rej_dist} bad distance, {rej_dur} bad duration")
+        logger.info(f"{label} trips rejected on ingest: {rej_pass} bad passengers, {rej_dist} bad distance, {rej_dur} bad duration")
+
+    print(f"Number of {label} duplicates removed: {dupes_removed}")
+    logger.info(f"Number of {label} duplicates removed: {dupes_removed}")
+
+    print(f"Number of {label} trips removed: {invalid_removed}")
+    logger.info(f"Number of {label} trips removed: {invalid_removed}")
+
+    # Sanity checks: no duplicates or rule violations remain
+    print(f"Number of {label} duplicates remaining: {remaining_dupes}")
+    logger.info(f"Number of {label} duplicates remaining: {remaining_dupes}")
+
+    bad_pass = stats["bad_passengers"]
+    bad_dist = stats["bad_distance"]
+    bad_dur = stats["bad_duration"]
+
+    print(f"Number of {label} bad passengers remaining: {bad_pass}")
+    logger.info(f"Number of {label} bad passengers remaining: {bad_pass}")
+    print(f"Number of {label} bad distance remaining: {bad_dist}")
+    logger.info(f"Number of {label} bad distance remaining: {bad_dist}")
+    print(f"Number of {label} bad duration remaining: {bad_dur}")
+    logger.info(f"Number of {label} bad duration remaining: {bad_dur}")
+
+
+def clean_cab(con, run_id, cab, clean_on_ingest=False, workers=DEFAULT_DEDUP_WORKERS, fingerprint=False,
+              streamed=False):
+    # Rebuild one cab type's rows of an existing trips_clean (see ensure_clean_table), so the
+    # pipeline runner can clean yellow and green concurrently; returns the cleaned row count.
+    # Streamed loads wrote trips_clean themselves and are only checked.
+    if streamed:
+        counts = streamed_counts(con, "trips_clean", workers=workers, cabs=[cab])
+    else:
+        record_table_stats(con, run_id, "clean_before", "trips", cabs=[cab])
+        counts = dedup_trips(con, "trips", "trips_clean", validate=not clean_on_ingest,
+                             workers=workers, fingerprint=fingerprint, cabs=[cab])
+    stats = record_table_stats(con, run_id, "clean_after", "trips_clean", cabs=[cab])
+    report_cab(con, cab, counts[cab], stats[cab], clean_on_ingest or streamed)
+    return stats[cab]["row_count"]
+
+
+def clean_trips(clean_on_ingest=False, workers=DEFAULT_DEDUP_WORKERS, fingerprint=False, streamed=False,
+                profile=False, settings=None):
+    # Returns False if cleaning failed
+    ok = True
     con = None
+    # Every statement (including those on the dedup cursors) is timed into logs/traces.jsonl
+    tracer = Tracer("clean", profile=profile)
     try:
         # Connect to DuckDB database file
-        con = duckdb.connect(database='emissions.duckdb', read_only=False)
+        # Dedup runs one pickup month at a time, so memory_limit (with temp_directory to spill
+        # to) bounds the window's working set
+        settings = settings or load_settings()
+        con = tracer.connect(settings)
 
         logger.info("Connected to DuckDB for cleaning")
+        logger.info(f"DuckDB settings: {describe(settings)}")
         print("Started data cleaning process")
 
-        # Remove duplicates from yellow_trips
-        # NOTE: This section is commented out due to local machine constraints, but logic is included
-        '''
-        yellow_before_dupes = con.execute("SELECT COUNT(*) FROM yellow_trips").fetchone()[0]
-
-        con.execute("""
-            CREATE OR REPLACE TABLE yellow_trips_clean AS
-            SELECT * EXCLUDE rn
-            FROM (
-                SELECT *,
-                    ROW_NUMBER() OVER (
-                        PARTITION BY 
-                            vendorid,
-                            tpep_pickup_datetime,
-                            tpep_dropoff_datetime,
-                            passenger_count,
-                            trip_distance
-                        ORDER BY tpep_pickup_datetime
-                    ) AS rn
-                FROM yellow_trips
-            )
-            WHERE rn = 1;
-        """)
-
-        yellow_after_dupes = con.execute("SELECT COUNT(*) FROM yellow_trips_clean").fetchone()[0]
-        yellow_removed_dupes = yellow_before_dupes - yellow_after_dupes
-
-        print(f"Number of Yellow duplicates removed: {yellow_removed_dupes}")
-        logger.info(f"Number of Yellow duplicates removed: {yellow_removed_dupes}")
-
-        remaining_dupes = con.execute("""
-            SELECT COUNT(*) FROM (
-                SELECT vendorid, tpep_pickup_datetime, tpep_dropoff_datetime, passenger_count, trip_distance, COUNT(*) AS c
-                FROM yellow_trips_clean
-                GROUP BY 1,2,3,4,5
-                HAVING c > 1
-            )
-        """).fetchone()[0]
-
-        print(f"Number of Yellow duplicates remaining: {remaining_dupes}")
-        logger.info(f"Number of Yellow duplicates remaining: {remaining_dupes}")
-        '''
-
-        # Filter out invalid yellow trips: passenger_count <= 0, distance <= 0 or >100, trips >24hr
-        yellow_before = con.execute("SELECT COUNT(*) FROM yellow_trips").fetchone()[0]
-
-        con.execute("""
-            CREATE OR REPLACE TABLE yellow_trips_clean AS
-            SELECT *
-            FROM yellow_trips
-            WHERE passenger_count > 0
-              AND trip_distance > 0
-              AND trip_distance <= 100
-              AND DATEDIFF('hour', tpep_pickup_datetime, tpep_dropoff_datetime) <= 24;
-        """)
-
-        yellow_after = con.execute("SELECT COUNT(*) FROM yellow_trips_clean").fetchone()[0]
-        yellow_removed = yellow_before - yellow_after
-
-        print(f"Number of Yellow trips removed: {yellow_removed}")
-        logger.info(f"Number of Yellow trips removed: {yellow_removed}")
-
-        # Sanity checks for yellow trips
-        bad_pass = con.execute("SELECT COUNT(*) FROM yellow_trips_clean WHERE passenger_count <= 0").fetchone()[0]
-        bad_dist = con.execute("SELECT COUNT(*) FROM yellow_trips_clean WHERE trip_distance <= 0 OR trip_distance > 100").fetchone()[0]
-        bad_dur = con.execute("SELECT COUNT(*) FROM yellow_trips_clean WHERE DATEDIFF('hour', tpep_pickup_datetime, tpep_dropoff_datetime) > 24").fetchone()[0]
-
-        print(f"Number of Yellow bad passengers remaining: {bad_pass}")
-        logger.info(f"Number of Yellow bad passengers remaining: {bad_pass}")
-        print(f"Number of Yellow bad distance remaining: {bad_dist}")
-        logger.info(f"Number of Yellow bad distance remaining: {bad_dist}")
-        print(f"Number of Yellow bad duration remaining: {bad_dur}")
-        logger.info(f"Number of Yellow bad duration remaining: {bad_dur}")
-
-        # Remove duplicates from green_trips (active version, unlike yellow above)
-        green_before_dupes = con.execute("SELECT COUNT(*) FROM green_trips").fetchone()[0]
-
-        con.execute("""
-            CREATE OR REPLACE TABLE green_trips_clean AS
-            SELECT * EXCLUDE rn
-            FROM (
-                SELECT *,
-                    ROW_NUMBER() OVER (
-                        PARTITION BY 
-                            vendorid,
-                            lpep_pickup_datetime,
-                            lpep_dropoff_datetime,
-                            passenger_count,
-                            trip_distance
-                        ORDER BY lpep_pickup_datetime
-                    ) AS rn
-                FROM green_trips
-            )
-            WHERE rn = 1;
-        """)
-
-        green_after_dupes = con.execute("SELECT COUNT(*) FROM green_trips_clean").fetchone()[0]
-        green_removed_dupes = green_before_dupes - green_after_dupes
-
-        print(f"Number of Green duplicates removed: {green_removed_dupes}")
-        logger.info(f"Number of Green duplicates removed: {green_removed_dupes}")
-
-        # Sanity check: count any remaining duplicates in green_trips_clean
-        remaining_dupes = con.execute("""
-            SELECT COUNT(*) FROM (
-                SELECT vendorid, lpep_pickup_datetime, lpep_dropoff_datetime, passenger_count, trip_distance, COUNT(*) AS c
-                FROM green_trips_clean
-                GROUP BY 1,2,3,4,5
-                HAVING c > 1
-            )
-        """).fetchone()[0]
-
-        print(f"Number of Green duplicates remaining: {remaining_dupes}")
-        logger.info(f"Number of Green duplicates remaining: {remaining_dupes}")
-
-        # Filter out invalid green trips: passenger_count <= 0, distance <= 0 or >100, trips >24hr
-        green_before = con.execute("SELECT COUNT(*) FROM green_trips_clean").fetchone()[0]
-
-        con.execute("""
-            CREATE OR REPLACE TABLE green_trips_clean AS
-            SELECT *
-            FROM green_trips_clean
-            WHERE passenger_count > 0
-              AND trip_distance > 0
-              AND trip_distance <= 100
-              AND DATEDIFF('hour', lpep_pickup_datetime, lpep_dropoff_datetime) <= 24;
-        """)
-
-        green_after = con.execute("SELECT COUNT(*) FROM green_trips_clean").fetchone()[0]
-        green_removed = green_before - green_after
-
-        print(f"Number of Green trips removed: {green_removed}")
-        logger.info(f"Number of Green trips removed: {green_removed}")
-
-        # Sanity checks for green trips
-        bad_pass = con.execute("SELECT COUNT(*) FROM green_trips_clean WHERE passenger_count <= 0").fetchone()[0]
-        bad_dist = con.execute("SELECT COUNT(*) FROM green_trips_clean WHERE trip_distance <= 0 OR trip_distance > 100").fetchone()[0]
-        bad_dur = con.execute("SELECT COUNT(*) FROM green_trips_clean WHERE DATEDIFF('hour', lpep_pickup_datetime, lpep_dropoff_datetime) > 24").fetchone()[0]
-
-        print(f"Number of Green bad passengers remaining: {bad_pass}")
-        logger.info(f"Number of Green bad passengers remaining: {bad_pass}")
-        print(f"Number of Green bad distance remaining: {bad_dist}")
-        logger.info(f"Number of Green bad distance remaining: {bad_dist}")
-        print(f"Number of Green bad duration remaining: {bad_dur}")
-        logger.info(f"Number of Green bad duration remaining: {bad_dur}")
+        # Counts and rule violations are gathered in one aggregate scan per table and
+        # recorded in quality_metrics under this run id
+        run_id = tracer.run_id
+        logger.info(f"Cleaning run id: {run_id}")
+
+        if streamed:
+            # load.py --stream validated and de-duplicated every batch into trips_clean already
+            ensure_clean_table(con)
+            with tracer.step("check"):
+                counts = streamed_counts(con, "trips_clean", workers=workers)
+        else:
+            # Both cab types are cleaned in one pass over trips into trips_clean; yellow_trips_clean
+            # and green_trips_clean remain as views with the original column names
+            with tracer.step("stats before"):
+                record_table_stats(con, run_id, "clean_before", "trips")
+
+            # Filter out invalid trips (passenger_count <= 0, distance <= 0 or >100, trips >24hr) and
+            # duplicates in the same partitioned pass; with clean-on-ingest the rules were applied at load
+            with tracer.step("dedup"):
+                counts = dedup_trips(con, "trips", "trips_clean", validate=not clean_on_ingest,
+                                     workers=workers, fingerprint=fingerprint)
+            create_compat_views(con, "trips_clean", suffix="_clean")
+
+        with tracer.step("stats after"):
+            stats = record_table_stats(con, run_id, "clean_after", "trips_clean")
+        for cab in CAB_COLUMNS:
+            report_cab(con, cab, counts[cab], stats[cab], clean_on_ingest or streamed)
 
         # Final counts after cleaning process
-        yellow_total_clean = con.execute("SELECT COUNT(*) FROM yellow_trips_clean").fetchone()[0]
-        green_total_clean = con.execute("SELECT COUNT(*) FROM green_trips_clean").fetchone()[0]
+        yellow_total_clean = stats["yellow"]["row_count"]
+        green_total_clean = stats["green"]["row_count"]
 
         print(f"Total Yellow trips after cleaning: {yellow_total_clean}")
         print(f"Total Green trips after cleaning: {green_total_clean}")
@@ -183,9 +270,29 @@ def clean_trips():
     except Exception as e:
         print(f"An error occurred: {e}")
         logger.error(f"An error occurred: {e}")
+        ok = False
+    finally:
+        tracer.close()
+    return ok
 
 
 if __name__ == "__main__":
-    clean_trips()
-    print("Data cleaning process completed")
-    logger.info("Data cleaning process completed")
+    parser = argparse.ArgumentParser(description="Clean yellow and green trip tables")
+    parser.add_argument("--clean-on-ingest", action="store_true",
+                        help="trip tables were loaded with load.py --clean-on-ingest; skip the filter rules")
+    parser.add_argument("--workers", type=int, default=DEFAULT_DEDUP_WORKERS,
+                        help="pickup-month partitions de-duplicated in parallel")
+    parser.add_argument("--fingerprint", action="store_true",
+                        help="de-duplicate on a 64-bit hash of the trip key instead of the raw columns")
+    parser.add_argument("--streamed", action="store_true",
+                        help="trips_clean was written by load.py --stream; only check and report it")
+    parser.add_argument("--profile", action="store_true",
+                        help="keep DuckDB's EXPLAIN ANALYZE profile of every statement under logs/profiles/")
+    add_db_arguments(parser)
+    args = parser.parse_args()
+
+    ok = clean_trips(clean_on_ingest=args.clean_on_ingest, workers=args.workers, fingerprint=args.fingerprint,
+                     streamed=args.streamed, profile=args.profile, settings=settings_from_args(args))
+    print("Data cleaning process completed" if ok else "Data cleaning process failed")
+    logger.info("Data cleaning process completed" if ok else "Data cleaning process failed")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,115 @@
+import os
+import json
+import argparse
+
+import duckdb
+
+# One place to open emissions.duckdb with the same resource settings in every stage.
+# Settings are resolved lowest to highest precedence from: DEFAULT_SETTINGS, a JSON
+# settings file (duckdb_settings.json or $DUCKDB_CONFIG), DUCKDB_* environment variables
+# and command line flags. dbt picks up the same values through the environment
+# (see dbt_env and dbt/macros/duckdb_settings.sql).
+
+DEFAULT_CONFIG_PATH = "duckdb_settings.json"
+
+DEFAULT_SETTINGS = {
+    "database": "emissions.duckdb",
+    "memory_limit": None,  # e.g. "6GB"; None keeps DuckDB's default (80% of RAM)
+    "threads": None,  # None keeps DuckDB's default (all cores)
+    "temp_directory": None,  # where larger-than-memory operators spill; None is <database>.tmp
+    "preserve_insertion_order": False,  # lets DuckDB reorder unordered results to stream and spill
+}
+
+# Settings passed to duckdb.connect(config=...)
+SETTING_NAMES = ("memory_limit", "threads", "temp_directory", "preserve_insertion_order")
+
+ENV_VARS = {name: f"DUCKDB_{name.upper()}" for name in DEFAULT_SETTINGS}
+
+
+def parse_setting(name, value):
+    # Settings from the environment or a file arrive as strings
+    if value is None or value == "":
+        return None
+    if name == "threads":
+        return int(value)
+    if name == "preserve_insertion_order" and isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return value
+
+
+def load_settings(config_path=None, overrides=None):
+    # Resolved settings: defaults < settings file < environment < overrides (None = not given)
+    settings = dict(DEFAULT_SETTINGS)
+
+    path = config_path or os.environ.get("DUCKDB_CONFIG") or DEFAULT_CONFIG_PATH
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            file_settings = json.load(f)
+        unknown = set(file_settings) - set(DEFAULT_SETTINGS)
+        if unknown:
+            raise ValueError(f"Unknown settings in {path}: {', '.join(sorted(unknown))}")
+        settings.update({name: parse_setting(name, value) for name, value in file_settings.items()})
+    elif config_path:
+        raise FileNotFoundError(f"DuckDB settings file not found at {config_path}")
+
+    for name, var in ENV_VARS.items():
+        if os.environ.get(var):
+            settings[name] = parse_setting(name, os.environ[var])
+
+    for name, value in (overrides or {}).items():
+        if value is not None:
+            settings[name] = value
+    return settings
+
+
+def add_db_arguments(parser):
+    # Command line flags shared by every stage script
+    group = parser.add_argument_group("DuckDB settings")
+    group.add_argument("--db-config", help=f"JSON settings file (default: {DEFAULT_CONFIG_PATH} if present)")
+    group.add_argument("--database", help="DuckDB database file")
+    group.add_argument("--memory-limit", help="DuckDB memory_limit, e.g. 6GB")
+    group.add_argument("--threads", type=int, help="DuckDB worker threads")
+    group.add_argument("--temp-directory", help="directory DuckDB spills to when over memory_limit")
+    group.add_argument("--preserve-insertion-order", action=argparse.BooleanOptionalAction, default=None,
+                       help="keep result order for queries without ORDER BY (slower, more memory)")
+    return group
+
+
+def settings_from_args(args):
+    return load_settings(args.db_config, {name: getattr(args, name) for name in DEFAULT_SETTINGS})
+
+
+def connection_config(settings):
+    config = {name: settings[name] for name in SETTING_NAMES if settings.get(name) is not None}
+    if config.get("temp_directory"):
+        os.makedirs(config["temp_directory"], exist_ok=True)
+    return config
+
+
+def connect(settings=None, read_only=False):
+    # duckdb.connect with the resolved settings applied
+    settings = settings or load_settings()
+    return duckdb.connect(database=settings["database"], read_only=read_only, config=connection_config(settings))
+
+
+def settings_env(settings):
+    # DUCKDB_* variables carrying `settings` to child processes (stage scripts and dbt)
+    env = {}
+    for name, var in ENV_VARS.items():
+        value = settings.get(name)
+        if value is None:
+            continue
+        if name in ("database", "temp_directory"):
+            value = os.path.abspath(value)
+        env[var] = str(value).lower() if isinstance(value, bool) else str(value)
+    return env
+
+
+def dbt_env(settings):
+    # Environment for a dbt subprocess: the profile reads the database path and the thread
+    # count, and the on-run-start hook applies the rest of the settings
+    return {**os.environ, **settings_env(settings)}
+
+
+def describe(settings):
+    return ", ".join(f"{name}={settings[name]}" for name in DEFAULT_SETTINGS)
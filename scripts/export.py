@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import shutil
+import time
+
+from tracing import Tracer
+from db_config import add_db_arguments, settings_from_args, load_settings, describe
+
+# Make sure logs/ folder exists
+os.makedirs("logs", exist_ok=True)
+
+# Configure logging for the export stage
+logging.basicConfig(
+    filename="logs/export.log",
+    encoding="utf-8",
+    filemode="a",
+    format="{asctime} - {levelname} - {message}",
+    style="{",
+    datefmt="%Y-%m-%d %H:%M",
+    level="DEBUG"
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EXPORT_DIR = os.path.join("exports", "trips")
+DEFAULT_ROW_GROUP_SIZE = 1_000_000  # rows per parquet row group
+SOURCE_TABLE = "trips_transformed"
+
+
+def ensure_export_manifest(con):
+    # One row per exported (cab type, month) parquet file
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS export_manifest (
+            cab_type VARCHAR,
+            year_month VARCHAR,
+            path VARCHAR,
+            row_count BIGINT,
+            size_bytes BIGINT,
+            source_transformed_at TIMESTAMP,
+            exported_at TIMESTAMP,
+            PRIMARY KEY (cab_type, year_month)
+        );
+    """)
+
+
+def partition_path(export_dir, cab, ym):
+    # Hive-style partition directory: cab_type=<cab>/year=<yyyy>/month=<m>
+    year, month = ym.split("-")
+    return os.path.join(export_dir, f"cab_type={cab}", f"year={int(year)}", f"month={int(month)}")
+
+
+def changed_partitions(con):
+    # Partitions whose rows were (re)written by dbt since their last export, plus
+    # exported partitions that no longer exist in the source
+    current = con.execute(f"""
+        SELECT CAST(cab_type AS VARCHAR), year_month, MAX(transformed_at)
+        FROM {SOURCE_TABLE}
+        WHERE year_month IS NOT NULL
+        GROUP BY ALL
+    """).fetchall()
+    exported = {
+        (cab, ym): transformed_at
+        for cab, ym, transformed_at in con.execute(
+            "SELECT cab_type, year_month, source_transformed_at FROM export_manifest"
+        ).fetchall()
+    }
+
+    changed = [(cab, ym, ts) for cab, ym, ts in current if exported.get((cab, ym)) != ts]
+    removed = set(exported) - {(cab, ym) for cab, ym, _ in current}
+    return changed, sorted(removed)
+
+
+def export_partition(con, export_dir, cab, ym, row_group_size):
+    # Write one partition as a single ZSTD parquet file, swapped in atomically.
+    # Returns (path, row count, size in bytes).
+    directory = partition_path(export_dir, cab, ym)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "data.parquet")
+    tmp_path = path + ".tmp"
+
+    con.execute(f"""
+        COPY (
+            SELECT * EXCLUDE (cab_type, year_month)
+            FROM {SOURCE_TABLE}
+            WHERE cab_type = '{cab}' AND year_month = '{ym}'
+            ORDER BY pickup_ts
+        ) TO '{tmp_path}' (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE {int(row_group_size)});
+    """)
+    os.replace(tmp_path, path)
+
+    row_count = con.execute(f"SELECT COUNT(*) FROM read_parquet('{path}')").fetchone()[0]
+    return path, row_count, os.path.getsize(path)
+
+
+def write_manifest_file(con, export_dir):
+    # JSON copy of export_manifest next to the data, for readers that never open the database
+    rows = con.execute("""
+        SELECT cab_type, year_month, path, row_count, size_bytes, CAST(exported_at AS VARCHAR)
+        FROM export_manifest
+        ORDER BY cab_type, year_month
+    """).fetchall()
+    keys = ("cab_type", "year_month", "path", "row_count", "size_bytes", "exported_at")
+    manifest_path = os.path.join(export_dir, "_manifest.json")
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump([dict(zip(keys, row)) for row in rows], f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def export_trips(export_dir=DEFAULT_EXPORT_DIR, row_group_size=DEFAULT_ROW_GROUP_SIZE, full_refresh=False,
+                 profile=False, settings=None):
+    # Returns False if the export failed
+    ok = True
+    con = None
+    # Every statement is timed into logs/traces.jsonl under this stage's run id
+    tracer = Tracer("export", profile=profile)
+    try:
+        # Connect to DuckDB database file
+        settings = settings or load_settings()
+        con = tracer.connect(settings)
+        logger.info("Connected to DuckDB for export")
+        logger.info(f"DuckDB settings: {describe(settings)}")
+        print("Started export process")
+
+        if full_refresh:
+            con.execute("DROP TABLE IF EXISTS export_manifest;")
+            shutil.rmtree(export_dir, ignore_errors=True)
+            logger.info(f"Full refresh: removed {export_dir} and export_manifest")
+        ensure_export_manifest(con)
+        os.makedirs(export_dir, exist_ok=True)
+
+        changed, removed = changed_partitions(con)
+        logger.info(f"{len(changed)} partitions to export, {len(removed)} to remove")
+
+        start = time.perf_counter()
+        total_rows = 0
+        total_bytes = 0
+        for cab, ym, transformed_at in changed:
+            with tracer.step(f"export {cab} {ym}"):
+                path, row_count, size = export_partition(con, export_dir, cab, ym, row_group_size)
+            con.execute("""
+                INSERT OR REPLACE INTO export_manifest
+                VALUES (?, ?, ?, ?, ?, ?, current_timestamp);
+            """, [cab, ym, path, row_count, size, transformed_at])
+            total_rows += row_count
+            total_bytes += size
+            logger.info(f"Exported {cab} {ym}: {row_count} rows, {size:,} bytes -> {path}")
+
+        for cab, ym in removed:
+            shutil.rmtree(partition_path(export_dir, cab, ym), ignore_errors=True)
+            con.execute("DELETE FROM export_manifest WHERE cab_type = ? AND year_month = ?;", [cab, ym])
+            logger.info(f"Removed exported partition {cab} {ym}: no longer in {SOURCE_TABLE}")
+
+        write_manifest_file(con, export_dir)
+
+        elapsed = time.perf_counter() - start
+        msg = (f"Exported {len(changed)} partitions ({total_rows:,} rows, {total_bytes:,} bytes) "
+               f"in {elapsed:.1f}s; removed {len(removed)}")
+        print(msg)
+        logger.info(msg)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        logger.error(f"An error occurred: {e}")
+        ok = False
+    finally:
+        tracer.close()
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export transformed trips as Hive-partitioned parquet")
+    parser.add_argument("--export-dir", default=DEFAULT_EXPORT_DIR, help="root of the cab_type=/year=/month= tree")
+    parser.add_argument("--row-group-size", type=int, default=DEFAULT_ROW_GROUP_SIZE, help="rows per parquet row group")
+    parser.add_argument("--full-refresh", action="store_true", help="rewrite every partition")
+    parser.add_argument("--profile", action="store_true",
+                        help="keep DuckDB's EXPLAIN ANALYZE profile of every statement under logs/profiles/")
+    add_db_arguments(parser)
+    args = parser.parse_args()
+
+    ok = export_trips(export_dir=args.export_dir, row_group_size=args.row_group_size,
+                      full_refresh=args.full_refresh, profile=args.profile, settings=settings_from_args(args))
+    print("Export process completed" if ok else "Export process failed")
+    logger.info("Export process completed" if ok else "Export process failed")
+    sys.exit(0 if ok else 1)
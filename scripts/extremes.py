@@ -0,0 +1,124 @@
+import sys
+import logging
+import argparse
+from datetime import date, timedelta
+
+from db_config import add_db_arguments, settings_from_args, connect
+from trip_rules import CAB_COLUMNS, relation_type
+from queries import DEFAULT_START, DEFAULT_END
+
+# Largest-trip and outlier reports from trip_extremes, the dbt model keeping the top trips of
+# every cab type and pickup month by each metric. Any top-n over whole months with n no
+# larger than the per-month depth (extreme_trips_per_month) is exact, since each month's
+# share of the overall top n is among that month's own top n.
+
+# Uses the calling stage's logging configuration (e.g. logs/analysis.log)
+logger = logging.getLogger(__name__)
+
+EXTREMES_TBL = "main.trip_extremes"
+TRIPS_TBL = "main.trips_transformed"
+METRICS = ("co2", "distance", "duration", "avg_mph", "distance_over_cap")
+DEFAULT_TOP = 10
+
+
+def whole_months(start, end):
+    # True if start..end covers whole pickup months, so per-month extremes answer the range
+    return start.day == 1 and (end + timedelta(days=1)).day == 1
+
+
+def extremes_available(con, start, end):
+    return whole_months(start, end) and relation_type(con, "trip_extremes") == "BASE TABLE"
+
+
+def extremes_depth(con):
+    # Trips kept per cab type, month and metric (the largest rank present)
+    return con.execute(f"SELECT COALESCE(MAX(metric_rank), 0) FROM {EXTREMES_TBL}").fetchone()[0]
+
+
+def largest_trips(con, start=DEFAULT_START, end=DEFAULT_END):
+    # cab -> {co2, distance, pickup, dropoff} of the largest CO2 trip picked up between start
+    # and end: the months' rank-1 trips in trip_extremes, or a scan of every trip when the
+    # range splits a month or the model has not been built yet
+    if extremes_available(con, start, end):
+        source = EXTREMES_TBL
+        where = "metric = 'co2' AND metric_rank = 1 AND year_month BETWEEN ? AND ?"
+        params = [start.strftime("%Y-%m"), end.strftime("%Y-%m")]
+    else:
+        logger.info(f"Scanning {TRIPS_TBL} for the largest trips between {start} and {end}")
+        source = TRIPS_TBL
+        where = "pickup_ts >= ? AND pickup_ts < ? + INTERVAL 1 DAY"
+        params = [start, end]
+    return dict(con.execute(f"""
+        SELECT
+            CAST(cab_type AS VARCHAR),
+            arg_max({{'co2': trip_co2_kgs, 'distance': trip_distance,
+                      'pickup': pickup_ts, 'dropoff': dropoff_ts}},
+                    trip_co2_kgs)
+        FROM {source}
+        WHERE {where}
+        GROUP BY cab_type
+    """, params).fetchall())
+
+
+def outlier_trips(con, metric, top=DEFAULT_TOP, start=DEFAULT_START, end=DEFAULT_END, cabs=CAB_COLUMNS):
+    # The `top` most extreme trips by metric per cab type, whole months start..end, as
+    # (cab, year_month, metric_value, pickup, dropoff, distance, duration s, avg mph, co2 kg)
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric {metric!r}; expected one of {', '.join(METRICS)}")
+    if not extremes_available(con, start, end):
+        raise ValueError(f"{EXTREMES_TBL} is missing or {start}..{end} does not cover whole months")
+    depth = extremes_depth(con)
+    if top > depth:
+        logger.warning(f"trip_extremes keeps {depth} trips per month; the top {top} may miss trips")
+
+    return con.execute(f"""
+        SELECT
+            CAST(cab_type AS VARCHAR) AS cab, year_month, metric_value, pickup_ts, dropoff_ts,
+            trip_distance, duration_seconds, avg_mph, trip_co2_kgs
+        FROM {EXTREMES_TBL}
+        WHERE metric = ?
+          AND year_month BETWEEN ? AND ?
+          AND cab_type IN ({', '.join(repr(cab) for cab in cabs)})
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY cab_type ORDER BY metric_value DESC, pickup_ts) <= ?
+        ORDER BY cab, metric_value DESC
+    """, [metric, start.strftime("%Y-%m"), end.strftime("%Y-%m"), top]).fetchall()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        filename="logs/extremes.log",
+        encoding="utf-8",
+        filemode="a",
+        format="{asctime} - {levelname} - {message}",
+        style="{",
+        datefmt="%Y-%m-%d %H:%M",
+        level="DEBUG"
+    )
+
+    parser = argparse.ArgumentParser(description="Most extreme trips per cab type from trip_extremes")
+    parser.add_argument("--metric", choices=METRICS, default="co2",
+                        help="ranking; distance_over_cap lists raw trips clean.py drops for trip_distance > 100")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP, help="trips listed per cab type")
+    parser.add_argument("--cab", choices=CAB_COLUMNS, nargs="+", default=list(CAB_COLUMNS))
+    parser.add_argument("--start", type=date.fromisoformat, default=DEFAULT_START,
+                        help="first pickup date (first day of a month)")
+    parser.add_argument("--end", type=date.fromisoformat, default=DEFAULT_END,
+                        help="last pickup date (last day of a month)")
+    add_db_arguments(parser)
+    args = parser.parse_args()
+
+    ok = True
+    try:
+        con = connect(settings_from_args(args), read_only=True)
+        rows = outlier_trips(con, args.metric, top=args.top, start=args.start, end=args.end, cabs=args.cab)
+        print(f"{'cab':<7} {'month':<8} {args.metric:>18}  {'pickup':<19}  {'dropoff':<19} "
+              f"{'miles':>8} {'minutes':>8} {'mph':>8} {'CO2 kg':>8}")
+        for cab, ym, value, pickup, dropoff, distance, seconds, mph, co2 in rows:
+            print(f"{cab:<7} {ym:<8} {value:>18,.2f}  {pickup:%Y-%m-%d %H:%M:%S}  {dropoff:%Y-%m-%d %H:%M:%S} "
+                  f"{distance:>8,.2f} {seconds / 60:>8,.1f} {mph:>8,.1f} {co2:>8,.2f}")
+        logger.info(f"Listed {len(rows)} {args.metric} outliers")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        logger.error(f"An error occurred: {e}")
+        ok = False
+    sys.exit(0 if ok else 1)
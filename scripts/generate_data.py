@@ -0,0 +1,179 @@
+import duckdb
+import os
+import logging
+import argparse
+
+# Make sure logs/ folder exists
+os.makedirs("logs", exist_ok=True)
+
+# Configure logging for the synthetic data generator
+logging.basicConfig(
+    filename="logs/generate_data.log",
+    encoding="utf-8",
+    filemode="a",
+    format="{asctime} - {levelname} - {message}",
+    style="{",
+    datefmt="%Y-%m-%d %H:%M",
+    level="DEBUG"
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTPUT_DIR = os.path.join("data", "synthetic")
+YEARS = range(2015, 2025)
+
+# Share of rows per cab type (yellow carries most of the real TLC volume)
+CAB_SHARE = {"yellow": 0.9, "green": 0.1}
+
+# Default share of rows breaking each clean_trips rule, and of rows written twice
+DEFAULT_RATES = {
+    "bad_passengers": 0.01,
+    "bad_distance": 0.01,
+    "bad_duration": 0.001,
+    "duplicates": 0.005,
+}
+
+
+def trip_columns(cab):
+    # SELECT list producing the real TLC column names and parquet types for a cab type,
+    # from a `base` CTE of synthetic pickup/dropoff/distance/passenger values
+    pre = "tpep" if cab == "yellow" else "lpep"
+    common_head = f"""
+        CAST(vendor AS INTEGER) AS VendorID,
+        pickup AS {pre}_pickup_datetime,
+        dropoff AS {pre}_dropoff_datetime,
+    """
+    fares = """
+        CAST(2.5 + distance * 2.5 AS DOUBLE) AS fare_amount,
+        CAST(0.5 AS DOUBLE) AS extra,
+        CAST(0.5 AS DOUBLE) AS mta_tax,
+        CAST(round(random() * 4, 2) AS DOUBLE) AS tip_amount,
+        CAST(0 AS DOUBLE) AS tolls_amount,
+    """
+    if cab == "yellow":
+        return common_head + f"""
+        CAST(passengers AS DOUBLE) AS passenger_count,
+        CAST(distance AS DOUBLE) AS trip_distance,
+        CAST(1 AS DOUBLE) AS RatecodeID,
+        'N' AS store_and_fwd_flag,
+        CAST(pu_location AS INTEGER) AS PULocationID,
+        CAST(do_location AS INTEGER) AS DOLocationID,
+        CAST(1 + floor(random() * 2) AS BIGINT) AS payment_type,
+        {fares}
+        CAST(0.3 AS DOUBLE) AS improvement_surcharge,
+        CAST(3.8 + distance * 2.5 AS DOUBLE) AS total_amount,
+        CAST(2.5 AS DOUBLE) AS congestion_surcharge,
+        CAST(0 AS DOUBLE) AS airport_fee
+        """
+    return common_head + f"""
+        'N' AS store_and_fwd_flag,
+        CAST(1 AS DOUBLE) AS RatecodeID,
+        CAST(pu_location AS INTEGER) AS PULocationID,
+        CAST(do_location AS INTEGER) AS DOLocationID,
+        CAST(passengers AS DOUBLE) AS passenger_count,
+        CAST(distance AS DOUBLE) AS trip_distance,
+        {fares}
+        CAST(NULL AS DOUBLE) AS ehail_fee,
+        CAST(0.3 AS DOUBLE) AS improvement_surcharge,
+        CAST(3.8 + distance * 2.5 AS DOUBLE) AS total_amount,
+        CAST(1 + floor(random() * 2) AS DOUBLE) AS payment_type,
+        CAST(1 AS DOUBLE) AS trip_type,
+        CAST(2.5 AS DOUBLE) AS congestion_surcharge
+    """
+
+
+def write_month(con, path, cab, ym, rows, rates):
+    # Write one TLC-shaped monthly parquet file with injected invalid and duplicate rows
+    p_pass = rates["bad_passengers"]
+    p_dist = p_pass + rates["bad_distance"]
+    p_dur = p_dist + rates["bad_duration"]
+    con.execute(f"""
+        COPY (
+            WITH draws AS (
+                SELECT
+                    TIMESTAMP '{ym}-01' + to_microseconds(
+                        CAST(random() * date_diff('microsecond', TIMESTAMP '{ym}-01',
+                                                  TIMESTAMP '{ym}-01' + INTERVAL 1 MONTH) AS BIGINT)
+                    ) AS pickup,
+                    random() AS rule_draw,
+                    1 + floor(random() * 2) AS vendor,
+                    1 + floor(random() * 263) AS pu_location,
+                    1 + floor(random() * 263) AS do_location,
+                    1 + floor(random() * 4) AS pass_draw,
+                    round(-ln(1 - random()) * 3, 2) + 0.01 AS dist_draw,
+                    to_microseconds(CAST((2 + random() * 58) * 60 * 1e6 AS BIGINT)) AS duration
+                FROM range({int(rows)})
+            ),
+            base AS (
+                SELECT
+                    vendor, pu_location, do_location, pickup,
+                    -- Rule breakers: 0 passengers, 0 or >100 miles, or longer than a day
+                    CASE WHEN rule_draw < {p_pass} THEN 0 ELSE pass_draw END AS passengers,
+                    CASE WHEN rule_draw >= {p_pass} AND rule_draw < {p_dist}
+                         THEN CASE WHEN random() < 0.5 THEN 0 ELSE 150 END
+                         ELSE dist_draw END AS distance,
+                    CASE WHEN rule_draw >= {p_dist} AND rule_draw < {p_dur}
+                         THEN pickup + INTERVAL 30 HOUR
+                         ELSE pickup + duration END AS dropoff
+                FROM draws
+            ),
+            -- Materialized so the sampled copies below are exact duplicates
+            trips AS MATERIALIZED (
+                SELECT {trip_columns(cab)} FROM base
+            )
+            SELECT * FROM trips
+            UNION ALL
+            SELECT * FROM trips USING SAMPLE {rates['duplicates'] * 100} PERCENT (bernoulli)
+        ) TO '{path}' (FORMAT PARQUET);
+    """)
+
+
+def generate_data(total_rows, output_dir=DEFAULT_OUTPUT_DIR, years=YEARS, rates=None, seed=0.42):
+    # Spread total_rows over every (cab type, month) file of the given years
+    rates = {**DEFAULT_RATES, **(rates or {})}
+    months = [f"{year}-{month:02d}" for year in years for month in range(1, 13)]
+    con = None
+    try:
+        con = duckdb.connect()
+        con.execute(f"SELECT setseed({seed});")
+        os.makedirs(output_dir, exist_ok=True)
+        logger.info(f"Generating {total_rows:,} synthetic trips into {output_dir} with rates {rates}")
+
+        for cab, share in CAB_SHARE.items():
+            rows_per_month = max(1, int(total_rows * share / len(months)))
+            for ym in months:
+                path = os.path.join(output_dir, f"{cab}_tripdata_{ym}.parquet")
+                write_month(con, path, cab, ym, rows_per_month, rates)
+            logger.info(f"Wrote {len(months)} {cab} files of {rows_per_month:,} rows (+ duplicates)")
+            print(f"Wrote {len(months)} {cab} files of {rows_per_month:,} rows (+ duplicates)")
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        logger.error(f"An error occurred: {e}")
+        raise
+    finally:
+        if con is not None:
+            con.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic TLC-shaped yellow/green parquet files")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="total trips across all files")
+    parser.add_argument("--output-dir", default=DEFAULT_OUTPUT_DIR, help="directory for *_tripdata_YYYY-MM.parquet")
+    parser.add_argument("--start-year", type=int, default=YEARS.start)
+    parser.add_argument("--end-year", type=int, default=YEARS.stop - 1)
+    parser.add_argument("--seed", type=float, default=0.42, help="DuckDB random seed in [0, 1]")
+    for name, rate in DEFAULT_RATES.items():
+        parser.add_argument(f"--{name.replace('_', '-')}-rate", type=float, default=rate,
+                            help=f"share of rows ({name.replace('_', ' ')})")
+    args = parser.parse_args()
+
+    generate_data(
+        args.rows,
+        output_dir=args.output_dir,
+        years=range(args.start_year, args.end_year + 1),
+        rates={name: getattr(args, f"{name}_rate") for name in DEFAULT_RATES},
+        seed=args.seed,
+    )
+    print("Synthetic data generation completed")
+    logger.info("Synthetic data generation completed")
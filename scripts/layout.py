@@ -0,0 +1,164 @@
+import os
+import sys
+import logging
+import argparse
+import statistics
+import time
+
+from trip_rules import PICKUP, relation_type
+from tracing import Tracer
+from db_config import add_db_arguments, settings_from_args, load_settings, describe
+
+# Make sure logs/ folder exists
+os.makedirs("logs", exist_ok=True)
+
+# Configure logging for the layout stage
+logging.basicConfig(
+    filename="logs/layout.log",
+    encoding="utf-8",
+    filemode="a",
+    format="{asctime} - {levelname} - {message}",
+    style="{",
+    datefmt="%Y-%m-%d %H:%M",
+    level="DEBUG"
+)
+
+logger = logging.getLogger(__name__)
+
+# Tables rewritten in (cab_type, pickup_ts) order so DuckDB's per-row-group min/max
+# zone maps can skip everything outside a queried date range
+LAYOUT_TABLES = ("trips_clean", "trips_transformed")
+
+# Date ranges used to compare query latency before and after the layout stage
+BENCHMARK_RANGES = [
+    ("one day", "2019-06-15", "2019-06-16"),
+    ("one month", "2019-06-01", "2019-07-01"),
+    ("one quarter", "2022-01-01", "2022-04-01"),
+    ("one year", "2024-01-01", "2025-01-01"),
+]
+
+
+def layout_table(con, table):
+    # Rewrite table sorted by cab type and pickup time. Rows are copied one (cab type,
+    # pickup month) partition at a time so the sort never has to hold more than a month;
+    # insertion order is preserved, so the result is globally ordered.
+    partitions = con.execute(f"""
+        SELECT DISTINCT cab_type, date_trunc('month', {PICKUP}) AS month_start
+        FROM {table}
+        ORDER BY ALL
+    """).fetchall()
+
+    sorted_table = f"{table}__sorted"
+    con.execute(f"DROP TABLE IF EXISTS {sorted_table};")
+    con.execute(f"CREATE TABLE {sorted_table} AS SELECT * FROM {table} LIMIT 0;")
+
+    for cab, month_start in partitions:
+        if month_start is None:
+            predicate = f"{PICKUP} IS NULL"
+            params = [cab]
+        else:
+            predicate = f"{PICKUP} >= ? AND {PICKUP} < ? + INTERVAL 1 MONTH"
+            params = [cab, month_start, month_start]
+        con.execute(f"""
+            INSERT INTO {sorted_table}
+            SELECT * FROM {table}
+            WHERE cab_type = ? AND {predicate}
+            ORDER BY {PICKUP};
+        """, params)
+
+    # Swap the sorted copy in under the original name
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        con.execute(f"DROP TABLE {table};")
+        con.execute(f"ALTER TABLE {sorted_table} RENAME TO {table};")
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+
+    logger.info(f"Rewrote {table} in (cab_type, {PICKUP}) order across {len(partitions)} partitions")
+    return len(partitions)
+
+
+def benchmark_range_queries(con, table, repeats=5):
+    # Median latency (seconds) of an aggregate over each benchmark date range
+    timings = {}
+    for name, start, end in BENCHMARK_RANGES:
+        samples = []
+        for _ in range(repeats):
+            begin = time.perf_counter()
+            con.execute(f"""
+                SELECT cab_type, COUNT(*), SUM(trip_distance)
+                FROM {table}
+                WHERE {PICKUP} >= ? AND {PICKUP} < ?
+                GROUP BY cab_type
+            """, [start, end]).fetchall()
+            samples.append(time.perf_counter() - begin)
+        timings[name] = statistics.median(samples)
+    return timings
+
+
+def layout_tables(tables=LAYOUT_TABLES, benchmark=False, repeats=5, profile=False, settings=None):
+    # Returns False if the layout failed
+    ok = True
+    con = None
+    # Every statement is timed into logs/traces.jsonl under this stage's run id
+    tracer = Tracer("layout", profile=profile)
+    try:
+        # Connect to DuckDB database file
+        # The sorted copy relies on insertion order, whatever the configured setting
+        settings = {**(settings or load_settings()), "preserve_insertion_order": True}
+        con = tracer.connect(settings)
+        logger.info("Connected to DuckDB for layout")
+        logger.info(f"DuckDB settings: {describe(settings)}")
+        print("Started layout process")
+
+        for table in tables:
+            if relation_type(con, table) != "BASE TABLE":
+                print(f"Skipping {table}: not a table")
+                logger.warning(f"Skipping {table}: not a table")
+                continue
+
+            before = benchmark_range_queries(con, table, repeats) if benchmark else None
+
+            start = time.perf_counter()
+            with tracer.step(f"sort {table}"):
+                partitions = layout_table(con, table)
+            elapsed = time.perf_counter() - start
+            print(f"Sorted {table} ({partitions} partitions) in {elapsed:.1f}s")
+            logger.info(f"Sorted {table} ({partitions} partitions) in {elapsed:.1f}s")
+
+            if benchmark:
+                after = benchmark_range_queries(con, table, repeats)
+                for name in before:
+                    msg = (f"{table} {name} range query: {before[name] * 1000:.1f} ms before, "
+                           f"{after[name] * 1000:.1f} ms after layout "
+                           f"({before[name] / after[name] if after[name] > 0 else 0:.1f}x)")
+                    print(msg)
+                    logger.info(msg)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        logger.error(f"An error occurred: {e}")
+        ok = False
+    finally:
+        tracer.close()
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rewrite trip tables in pickup-time order")
+    parser.add_argument("--tables", nargs="+", default=list(LAYOUT_TABLES), help="tables to rewrite")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="time date-range queries before and after the rewrite")
+    parser.add_argument("--repeats", type=int, default=5, help="runs per benchmark query (median is reported)")
+    parser.add_argument("--profile", action="store_true",
+                        help="keep DuckDB's EXPLAIN ANALYZE profile of every statement under logs/profiles/")
+    add_db_arguments(parser)
+    args = parser.parse_args()
+
+    ok = layout_tables(tables=args.tables, benchmark=args.benchmark, repeats=args.repeats, profile=args.profile,
+                       settings=settings_from_args(args))
+    print("Layout process completed" if ok else "Layout process failed")
+    logger.info("Layout process completed" if ok else "Layout process failed")
+    sys.exit(0 if ok else 1)
@@ -1,7 +1,20 @@
-import duckdb
 import os
+import sys
 import logging
 import time
+import argparse
+import threading
+import urllib.request
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from mirror_cache import ParquetMirror, DEFAULT_MIRROR_DIR, DEFAULT_MAX_BYTES
+from trip_rules import (CAB_COLUMNS, PICKUP, SOURCE_MONTH, DEDUP_COLUMNS, LOCATION_COLUMNS, raw_trip_select,
+                        valid_trip_predicate, rejection_counts_sql, dedup_key, ensure_trips_table, ensure_clean_table,
+                        create_compat_views, drop_relation)
+from quality import record_table_stats
+from tracing import Tracer
+from db_config import add_db_arguments, settings_from_args, load_settings, describe
 
 # Make sure logs/ folder exists
 os.makedirs("logs", exist_ok=True)
@@ -19,11 +32,465 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-
-def load_parquet_files():
+# Remote source of the monthly TLC parquet files. Can be pointed at a local
+# HTTP server or a file:// directory of fixture files for testing.
+TLC_BASE_URL = "https://d37ci6vzurychx.cloudfront.net/trip-data"
+
+YEARS = range(2015, 2025)
+
+EMISSIONS_PATH = os.path.join("data", "vehicle_emissions.csv")
+# TLC taxi zone lookup (LocationID, Borough, Zone, service_zone), read with --zones and
+# downloaded from ZONES_URL when it is not there
+ZONES_PATH = os.path.join("data", "taxi_zone_lookup.csv")
+ZONES_URL = "https://d37ci6vzurychx.cloudfront.net/misc/taxi_zone_lookup.csv"
+
+DEFAULT_WORKERS = 4
+DEFAULT_RATE = 1.0  # requests per second, per host
+DEFAULT_BURST = 2
+
+# Rows read per batch by the streaming load (rounded to whole parquet row groups)
+DEFAULT_BATCH_ROWS = 1_000_000
+
+
+class TokenBucket:
+    # Simple thread-safe token bucket: `rate` tokens are added per second, up to `capacity`
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Block until a token is available, then take it
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostRateLimiter:
+    # One token bucket per host so a local fixture server and the CDN don't share a budget
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, url):
+        host = urlparse(url).netloc or "local"
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = self.buckets[host] = TokenBucket(self.rate, self.burst)
+        bucket.acquire()
+
+
+def month_sources(cab, base_url=TLC_BASE_URL):
+    # (year-month, url) for every monthly file of a cab type, in chronological order
+    for year in YEARS:
+        for month in range(1, 13):
+            ym = f"{year}-{month:02d}"
+            yield ym, f"{base_url}/{cab}_tripdata_{ym}.parquet"
+
+
+def probe_source(url, limiter):
+    # HEAD the source for its ETag (or Last-Modified) and size without downloading it
+    limiter.acquire(url)
+    req = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(req) as resp:
+        etag = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+        size = resp.headers.get("Content-Length")
+    return etag, int(size) if size is not None else None
+
+
+def fetch_month(url, mirror, limiter, known=None):
+    # Make one month available as a local file in the parquet mirror; runs on a worker thread.
+    # Returns None when the manifest entry `known` shows the source is unchanged.
+    if mirror.offline:
+        etag, size = mirror.cached_etag(url), None
+    else:
+        etag, size = probe_source(url, limiter)
+    if known is not None and etag is not None and etag == known[0] and size in (None, known[1]):
+        return None
+
+    return mirror.fetch(url, etag=etag, size=size, limiter=limiter)
+
+
+def ensure_manifest(con):
+    # One row per source file that has been committed into the trips table
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS load_manifest (
+            url VARCHAR PRIMARY KEY,
+            cab_type VARCHAR,
+            year_month VARCHAR,
+            row_count BIGINT,
+            etag VARCHAR,
+            size_bytes BIGINT,
+            checksum VARCHAR,
+            loaded_at TIMESTAMP
+        );
+    """)
+
+    # Per-rule rejection counts for months loaded with clean-on-ingest or streamed, and the
+    # duplicates a streamed month dropped
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS ingest_rejections (
+            url VARCHAR PRIMARY KEY,
+            cab_type VARCHAR,
+            year_month VARCHAR,
+            total_rows BIGINT,
+            kept_rows BIGINT,
+            bad_passengers BIGINT,
+            bad_distance BIGINT,
+            bad_duration BIGINT,
+            duplicate_rows BIGINT
+        );
+    """)
+    # Databases created before streaming loads existed
+    con.execute("ALTER TABLE ingest_rejections ADD COLUMN IF NOT EXISTS duplicate_rows BIGINT DEFAULT 0;")
+
+
+def read_manifest(con, cab):
+    # url -> (etag, size_bytes, checksum, row_count) for every committed month of a cab type
+    rows = con.execute(
+        "SELECT url, etag, size_bytes, checksum, row_count FROM load_manifest WHERE cab_type = ?", [cab]
+    ).fetchall()
+    return {url: tuple(rest) for url, *rest in rows}
+
+
+def has_location_ids(con, path):
+    # True if a parquet file has the pickup/dropoff zone ID columns (files from mid-2016 on)
+    names = {row[0].lower() for row in con.execute("SELECT name FROM parquet_schema(?)", [path]).fetchall()}
+    return all(raw.lower() in names for raw in LOCATION_COLUMNS.values())
+
+
+def insert_month(con, cab, ym, url, local_path, etag, checksum, clean_on_ingest=False, zones=False):
+    # Replace one month of a cab type in trips and record it in the manifest, atomically.
+    # With clean_on_ingest the clean_trips validity rules are applied while reading the
+    # parquet and rejected rows are only counted; with zones the zone IDs are kept.
+    # Only ever called from the writer thread.
+    parquet_sql = f"read_parquet('{local_path}')"
+    select_sql = raw_trip_select(cab, parquet_sql, ym, locations=zones and has_location_ids(con, local_path))
+
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        # A changed file replaces whatever an earlier run loaded from it, by source month, so
+        # stray pickups of other months (in this file or another) are neither lost nor doubled
+        con.execute(f"DELETE FROM trips WHERE cab_type = ? AND {SOURCE_MONTH} = ?;", [cab, ym])
+        if clean_on_ingest:
+            # The file is read once, into a temp table that gives both the per-rule rejection
+            # counts and the valid rows; rules apply to the trips columns, as in clean_trips
+            con.execute(f"CREATE OR REPLACE TEMP TABLE staged_trips AS {select_sql};")
+            total, bad_pass, bad_dist, bad_dur = con.execute(f"""
+                SELECT
+                    COUNT(*),
+                    {rejection_counts_sql()}
+                FROM staged_trips;
+            """).fetchone()
+            rows = con.execute(f"""
+                INSERT INTO trips BY NAME
+                SELECT * FROM staged_trips
+                WHERE {valid_trip_predicate()};
+            """).fetchone()[0]
+            con.execute("DROP TABLE staged_trips;")
+            con.execute("INSERT OR REPLACE INTO ingest_rejections VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0);",
+                        [url, cab, ym, total, rows, bad_pass, bad_dist, bad_dur])
+            logger.info(f"Rejected {total - rows} {cab} trips from {ym} on ingest: "
+                        f"{bad_pass} bad passengers, {bad_dist} bad distance, {bad_dur} bad duration")
+        else:
+            rows = con.execute(f"INSERT INTO trips BY NAME {select_sql};").fetchone()[0]
+            con.execute("DELETE FROM ingest_rejections WHERE url = ?;", [url])
+
+        con.execute("""
+            INSERT OR REPLACE INTO load_manifest
+            VALUES (?, ?, ?, ?, ?, ?, ?, current_timestamp);
+        """, [url, cab, ym, rows, etag, os.path.getsize(local_path), checksum])
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+    return rows
+
+
+def parquet_batches(con, path, batch_rows=DEFAULT_BATCH_ROWS):
+    # [(first row, end row)] of a parquet file in runs of whole row groups of at most
+    # batch_rows rows (a larger row group is a batch of its own)
+    groups = con.execute("""
+        SELECT row_group_id, ANY_VALUE(row_group_num_rows)
+        FROM parquet_metadata(?)
+        GROUP BY ALL
+        ORDER BY ALL
+    """, [path]).fetchall()
+    batches = []
+    first = end = 0
+    for _, rows in groups:
+        if end > first and end - first + rows > batch_rows:
+            batches.append((first, end))
+            first = end
+        end += rows
+    if end > first:
+        batches.append((first, end))
+    return batches
+
+
+def stream_month(con, cab, ym, url, local_path, etag, checksum, batch_rows=DEFAULT_BATCH_ROWS, zones=False):
+    # Replace the trips of one source file (cab type and source_month) in trips_clean straight
+    # from the parquet file, without going through trips. The file is read in batches of whole row groups (a file_row_number
+    # range, which DuckDB prunes to those row groups); each batch is validated, de-duplicated
+    # within itself and against the kept trips of the same pickup months (the scope of
+    # clean.py's dedup), and appended. The anti-join hashes the batch, not the kept trips.
+    # Every batch commits on its own, since uncommitted appends are held in memory: DuckDB's
+    # working set is one batch rather than one month, so memory_limit holds on any month size.
+    valid_sql = valid_trip_predicate(*CAB_COLUMNS[cab])
+    locations = zones and has_location_ids(con, local_path)
+    same_trip = " AND ".join(f"c.{column} IS NOT DISTINCT FROM b.{column}" for column in DEDUP_COLUMNS)
+    # total, valid, bad passengers, bad distance and bad duration rows, summed over batches
+    counts = [0] * 5
+    kept = 0
+
+    # The file leaves the manifest with its old rows, so a run interrupted between batches
+    # streams it again from the start. Rows are matched by source_month, not pickup date, so
+    # stray pickups of other files in this month are kept and this file's own strays go.
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        con.execute(f"DELETE FROM trips_clean WHERE cab_type = ? AND {SOURCE_MONTH} = ?;", [cab, ym])
+        con.execute("DELETE FROM load_manifest WHERE url = ?;", [url])
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+
+    for first, end in parquet_batches(con, local_path, batch_rows):
+        batch_sql = f"""(
+            SELECT * FROM read_parquet('{local_path}', file_row_number = true)
+            WHERE file_row_number >= {first} AND file_row_number < {end}
+        )"""
+        *batch_counts, months = con.execute(f"""
+            SELECT
+                COUNT(*),
+                COUNT(*) FILTER (WHERE {valid_sql}),
+                {rejection_counts_sql(*CAB_COLUMNS[cab])},
+                list(DISTINCT strftime(CAST({CAB_COLUMNS[cab][0]} AS TIMESTAMP), '%Y-%m'))
+                    FILTER (WHERE {valid_sql})
+            FROM {batch_sql};
+        """).fetchone()
+        counts = [a + b for a, b in zip(counts, batch_counts)]
+        if not months:
+            continue
+
+        # Kept trips of the batch's pickup months, one range scan per month so each is pruned
+        # by zone maps (stray pickups outside the file's month add a month each)
+        kept_trips = " UNION ALL ".join(f"""
+            SELECT * FROM trips_clean
+            WHERE cab_type = '{cab}'
+              AND {PICKUP} >= DATE '{month}-01' AND {PICKUP} < DATE '{month}-01' + INTERVAL 1 MONTH
+        """ for month in months)
+        kept += con.execute(f"""
+            INSERT INTO trips_clean BY NAME
+            SELECT *
+            FROM (
+                SELECT *
+                FROM ({raw_trip_select(cab, batch_sql, ym, locations)} WHERE {valid_sql})
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY {dedup_key()} ORDER BY {PICKUP}) = 1
+            ) b
+            ANTI JOIN ({kept_trips}) c ON {same_trip};
+        """).fetchone()[0]
+
+    total, valid, bad_pass, bad_dist, bad_dur = counts
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        con.execute("INSERT OR REPLACE INTO ingest_rejections VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                    [url, cab, ym, total, kept, bad_pass, bad_dist, bad_dur, valid - kept])
+        con.execute("""
+            INSERT OR REPLACE INTO load_manifest
+            VALUES (?, ?, ?, ?, ?, ?, ?, current_timestamp);
+        """, [url, cab, ym, kept, etag, os.path.getsize(local_path), checksum])
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+    logger.info(f"Streamed {cab} {ym}: {total} rows, {total - valid} invalid, {valid - kept} duplicates removed")
+    return kept
+
+
+def load_cab_trips(con, cab, workers=DEFAULT_WORKERS, limiter=None, base_url=TLC_BASE_URL, mirror=None,
+                   clean_on_ingest=False, stream=False, batch_rows=DEFAULT_BATCH_ROWS, zones=False):
+    # Fetch new or changed months of a cab type through a worker pool; the calling
+    # thread is the single DuckDB writer. Months already in the manifest are skipped,
+    # so an interrupted run resumes from the last committed month. With stream, months
+    # go straight into trips_clean (see stream_month).
+    limiter = limiter or HostRateLimiter()
+    mirror = mirror or ParquetMirror()
+    label = cab.capitalize()
+    table = f"{cab}_trips_clean" if stream else f"{cab}_trips"
+    rows_loaded = 0
+    bytes_loaded = 0
+    skipped = 0
+    start = time.perf_counter()
+
+    ensure_manifest(con)
+    manifest = read_manifest(con, cab)
+
+    # Running total kept from inserted row counts rather than a COUNT(*) per month
+    table_total = sum(entry[3] for entry in manifest.values())
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(fetch_month, url, mirror, limiter, manifest.get(url)): (ym, url)
+            for ym, url in month_sources(cab, base_url)
+        }
+
+        for future in as_completed(futures):
+            ym, url = futures[future]
+            try:
+                fetched = future.result()
+                if fetched is None:
+                    skipped += 1
+                    logger.info(f"Skipping unchanged {cab} trip data for {ym}")
+                    continue
+
+                local_path, size, etag, checksum = fetched
+                try:
+                    known = manifest.get(url)
+                    if known is not None and known[2] == checksum:
+                        skipped += 1
+                        logger.info(f"Skipping {cab} trip data for {ym}: checksum unchanged")
+                        continue
+
+                    logger.info(f"Loading {cab} trip data from {ym} ({local_path})")
+                    if stream:
+                        rows = stream_month(con, cab, ym, url, local_path, etag, checksum, batch_rows, zones)
+                    else:
+                        rows = insert_month(con, cab, ym, url, local_path, etag, checksum, clean_on_ingest,
+                                            zones)
+                finally:
+                    mirror.release(local_path)
+                rows_loaded += rows
+                bytes_loaded += size
+                logger.info(f"Inserted {rows} rows ({size:,} bytes) into {table} from {url}")
+
+                # Track growing record count (a reloaded month replaces its previous rows)
+                table_total += rows - (known[3] if known is not None else 0)
+                logger.info(f"Total records in {table} after loading {url}: {table_total}")
+                print(f"Total records in {table} after loading {ym}: {table_total}")
+
+            except Exception as e:
+                print(f"[{label}] Skipping {ym} ({e})")
+                logger.warning(f"{label} trip data missing or failed: {url}")
+
+    elapsed = time.perf_counter() - start
+    rows_per_sec = rows_loaded / elapsed if elapsed > 0 else 0.0
+    bytes_per_sec = bytes_loaded / elapsed if elapsed > 0 else 0.0
+    msg = (f"{label} load: {rows_loaded:,} rows, {bytes_loaded:,} bytes in {elapsed:.1f}s "
+           f"({rows_per_sec:,.0f} rows/sec, {bytes_per_sec / 1e6:,.2f} MB/sec, {workers} workers), "
+           f"{skipped} months unchanged")
+    print(msg)
+    logger.info(msg)
+
+    return rows_loaded, bytes_loaded, elapsed
+
+
+def prepare_trips(con, full_refresh=False, stream=False):
+    # Create the trips table, load manifest and compat views (and trips_clean, which streamed
+    # loads write to); a full refresh starts from scratch
+    if full_refresh:
+        names = ["yellow_trips", "green_trips", "trips", "load_manifest", "ingest_rejections"]
+        if stream:
+            names.append("trips_clean")
+        for name in names:
+            drop_relation(con, name)
+        logger.info(f"Full refresh: dropped relations if existed: {', '.join(names)}")
+
+    # Both cab types load into one normalized trips table; yellow_trips and green_trips
+    # remain as views with the original column names
+    ensure_manifest(con)
+    if ensure_trips_table(con):
+        # A new trips table (e.g. first run after the per-cab layout) has nothing committed yet
+        con.execute("DELETE FROM load_manifest; DELETE FROM ingest_rejections;")
+        logger.info("Created table trips")
+    create_compat_views(con, "trips")
+    if stream and ensure_clean_table(con):
+        logger.info("Created table trips_clean")
+
+
+def load_emissions(con, emissions_path=EMISSIONS_PATH):
+    # (Re)create the emissions lookup from the local CSV; returns its row count
+    if not os.path.exists(emissions_path):
+        raise FileNotFoundError(f"Emissions data file not found at {emissions_path}")
+
+    con.execute(f"""
+        CREATE OR REPLACE TABLE emissions AS
+        SELECT * FROM read_csv_auto('{emissions_path}', header=True);
+    """)
+    logger.info("Created table emissions from local CSV file")
+
+    return con.execute("SELECT COUNT(*) FROM emissions").fetchone()[0]
+
+
+def fetch_zones(zones_path=ZONES_PATH, url=ZONES_URL):
+    # Download the zone lookup to zones_path through a temp file, so a failed download
+    # leaves no partial CSV behind
+    os.makedirs(os.path.dirname(zones_path) or ".", exist_ok=True)
+    tmp_path = f"{zones_path}.part"
+    try:
+        with urllib.request.urlopen(url) as resp, open(tmp_path, "wb") as out:
+            while chunk := resp.read(1 << 20):
+                out.write(chunk)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, zones_path)
+    logger.info(f"Downloaded taxi zone lookup from {url} to {zones_path}")
+
+
+def load_zones(con, zones_path=ZONES_PATH, url=ZONES_URL, offline=False):
+    # (Re)create the taxi zone lookup from the local CSV, downloading it first if it is
+    # missing; returns its row count. Raises FileNotFoundError if there is no CSV and it could
+    # not be downloaded. location_id is the zone key stored in trips (pu_location_id,
+    # do_location_id) and trip_zone_co2.
+    if not os.path.exists(zones_path):
+        if offline:
+            raise FileNotFoundError(f"Taxi zone lookup file not found at {zones_path} (offline mode)")
+        try:
+            fetch_zones(zones_path, url)
+        except Exception as e:
+            raise FileNotFoundError(f"Taxi zone lookup file not found at {zones_path} "
+                                    f"and could not be downloaded from {url}: {e}") from e
+
+    con.execute(f"""
+        CREATE OR REPLACE TABLE taxi_zones AS
+        SELECT
+            CAST(LocationID AS SMALLINT) AS location_id,
+            CAST(Borough AS VARCHAR) AS borough,
+            CAST(Zone AS VARCHAR) AS zone,
+            CAST(service_zone AS VARCHAR) AS service_zone
+        FROM read_csv_auto('{zones_path}', header=True)
+        ORDER BY location_id;
+    """)
+    logger.info("Created table taxi_zones from local CSV file")
+
+    return con.execute("SELECT COUNT(*) FROM taxi_zones").fetchone()[0]
+
+
+def load_parquet_files(workers=DEFAULT_WORKERS, rate=DEFAULT_RATE, burst=DEFAULT_BURST, base_url=TLC_BASE_URL,
+                       full_refresh=False, mirror_dir=DEFAULT_MIRROR_DIR, mirror_max_bytes=DEFAULT_MAX_BYTES,
+                       offline=False, clean_on_ingest=False, stream=False, batch_rows=DEFAULT_BATCH_ROWS,
+                       zones=False, profile=False, settings=None):
+    # Returns False if the load failed (months that could not be fetched are only skipped)
     print("load_parquet_files() has started")
 
+    ok = True
     con = None
+    # Every statement is timed into logs/traces.jsonl under this stage's run id
+    tracer = Tracer("load", profile=profile)
 
     # Sample data links for reference:
     # green: https://d37ci6vzurychx.cloudfront.net/trip-data/green_tripdata_2024-01.parquet
@@ -33,158 +500,71 @@ def load_parquet_files():
         logger.info("Starting data load process")
 
         # Connect to local DuckDB instance
-        con = duckdb.connect(database='emissions.duckdb', read_only=False)
-        logger.info("Connected to DuckDB instance")
-
-        # Enable httpfs for remote parquet file reading
-        con.execute("INSTALL httpfs;")
-        con.execute("LOAD httpfs;")
-        logger.info("Installed and loaded httpfs extension")
-
-        # Drop tables if they already exist (fresh load each time)
-        con.execute(f"""
-            DROP TABLE IF EXISTS yellow_trips;
-            DROP TABLE IF EXISTS green_trips;
-            DROP TABLE IF EXISTS emissions;
-        """)
-        logger.info("Dropped tables if existed: yellow_trips, green_trips, emissions")
-
-        # Load yellow trip data (2015–2024)
-        yellow_total = 0
-        yellow_table_created = False
-
-        for year in range(2015, 2025):
-            year_str = f"{year}"
-            for month in range(1, 13):
-                month_str = f"{month:02d}"
-                file_path = f"https://d37ci6vzurychx.cloudfront.net/trip-data/yellow_tripdata_{year_str}-{month_str}.parquet"
-                logger.info(f"Loading yellow trip data from {year_str}-{month_str}")
-
-                try:
-                    # Create table on first file, insert on later ones
-                    if not yellow_table_created:
-                        con.execute(f"""
-                            CREATE TABLE yellow_trips AS
-                            SELECT 
-                                vendorid,
-                                tpep_pickup_datetime,
-                                tpep_dropoff_datetime,
-                                passenger_count,
-                                trip_distance
-                            FROM read_parquet('{file_path}');
-                        """)
-                        yellow_table_created = True
-                        logger.info("Created table yellow_trips")
-
-                    else:
-                        con.execute(f"""
-                            INSERT INTO yellow_trips
-                            SELECT 
-                                vendorid,
-                                tpep_pickup_datetime,
-                                tpep_dropoff_datetime,
-                                passenger_count,
-                                trip_distance
-                            FROM read_parquet('{file_path}');
-                        """)
-                        logger.info(f"Inserted data into yellow_trips from {file_path}")
-
-                    # Track growing record count
-                    count = con.execute("SELECT COUNT(*) FROM yellow_trips").fetchone()[0]
-                    yellow_total = count
-                    logger.info(f"Total records in yellow_trips after loading {file_path}: {yellow_total}")
-                    print(f"Total records in yellow_trips after loading {year_str}-{month_str}: {yellow_total}")
-
-                except Exception as e:
-                    print(f"[Yellow] Skipping {year_str}-{month_str} ({e})")
-                    logger.warning(f"Yellow trip data missing or failed: {file_path}")
-                time.sleep(15)  # Pause to avoid hammering the server
-
-        # Load green trip data (2015–2024)
-        green_total = 0
-        green_table_created = False
-
-        for year in range(2015, 2025):
-            year_str = f"{year}"
-            for month in range(1, 13):
-                month_str = f"{month:02d}"
-                file_path = f"https://d37ci6vzurychx.cloudfront.net/trip-data/green_tripdata_{year_str}-{month_str}.parquet"
-                logger.info(f"Loading green trip data from {year_str}-{month_str}")
-
-                try:
-                    # Create table on first file, insert on later ones
-                    if not green_table_created:
-                        con.execute(f"""
-                            CREATE TABLE green_trips AS
-                            SELECT 
-                                vendorid,
-                                lpep_pickup_datetime,
-                                lpep_dropoff_datetime,
-                                passenger_count,
-                                trip_distance
-                            FROM read_parquet('{file_path}');
-                        """)
-                        green_table_created = True
-                        logger.info("Created table green_trips")
-
-                    else:
-                        con.execute(f"""
-                            INSERT INTO green_trips
-                            SELECT 
-                                vendorid,
-                                lpep_pickup_datetime,
-                                lpep_dropoff_datetime,
-                                passenger_count,
-                                trip_distance
-                            FROM read_parquet('{file_path}');
-                        """)
-                        logger.info(f"Inserted data into green_trips from {file_path}")
-
-                    # Track growing record count
-                    count = con.execute("SELECT COUNT(*) FROM green_trips").fetchone()[0]
-                    green_total = count
-                    logger.info(f"Total records in green_trips after loading {file_path}: {green_total}")
-                    print(f"Total records in green_trips after loading {year_str}-{month_str}: {green_total}")
-
-                except Exception as e:
-                    print(f"[Green] Skipping {year_str}-{month_str} ({e})")
-                    logger.warning(f"Green trip data missing or failed: {file_path}")
-                time.sleep(15)
-
-        # Load emissions data from csv
-
-        emissions_path = os.path.join("data", "vehicle_emissions.csv")
-        if not os.path.exists(emissions_path):
-            raise FileNotFoundError(f"Emissions data file not found at {emissions_path}")
-
-        con.execute(f"""
-            CREATE TABLE emissions AS
-            SELECT * FROM read_csv_auto('{emissions_path}', header=True);
-        """)
-        logger.info("Created table emissions from local CSV file")
-
-        # Verify emissions row count
-        count = con.execute("SELECT COUNT(*) FROM emissions").fetchone()[0]
-        print(f"Total records in emissions table: {count}")
-        logger.info(f"Total records in emissions table: {count}")
-
-        # Final totals + basic summaries
-        yellow_total = con.execute("SELECT COUNT(*) FROM yellow_trips").fetchone()[0]
-        green_total = con.execute("SELECT COUNT(*) FROM green_trips").fetchone()[0]
-        emissions_total = con.execute("SELECT COUNT(*) FROM emissions").fetchone()[0]
+        settings = settings or load_settings()
+        con = tracer.connect(settings)
+        logger.info(f"Connected to DuckDB instance (run {tracer.run_id})")
+        logger.info(f"DuckDB settings: {describe(settings)}")
+        if stream and not settings.get("memory_limit"):
+            logger.warning("Streaming load without a memory_limit; DuckDB may use up to 80% of RAM")
+
+        # Loads are incremental against load_manifest; a full refresh starts from scratch
+        prepare_trips(con, full_refresh=full_refresh, stream=stream)
+
+        # Load yellow and green trip data (2015–2024); months are fetched concurrently,
+        # rate limited per host instead of sleeping between files
+        # Files are read from a local parquet mirror, which downloads only on a miss
+        limiter = HostRateLimiter(rate=rate, burst=burst)
+        mirror = ParquetMirror(root=mirror_dir, max_bytes=mirror_max_bytes, offline=offline)
+        for cab in CAB_COLUMNS:
+            with tracer.step(f"load {cab}"):
+                load_cab_trips(con, cab, workers=workers, limiter=limiter, base_url=base_url, mirror=mirror,
+                               clean_on_ingest=clean_on_ingest, stream=stream, batch_rows=batch_rows, zones=zones)
+
+        stats = mirror.stats()
+        msg = (f"Parquet mirror: {stats['hits']} hits, {stats['misses']} misses, "
+               f"{stats['bytes_saved']:,} bytes saved, {stats['bytes_downloaded']:,} bytes downloaded")
+        print(msg)
+        logger.info(msg)
+
+        # Load emissions data from csv, and verify its row count
+        emissions_total = load_emissions(con)
+        print(f"Total records in emissions table: {emissions_total}")
+        logger.info(f"Total records in emissions table: {emissions_total}")
+
+        # Taxi zone lookup for the zone IDs kept with --zones. Trips keep their zone IDs
+        # without it, so a missing lookup is skipped and a bad one does not stop the summaries
+        if zones:
+            try:
+                zones_total = load_zones(con, offline=offline)
+                print(f"Total records in taxi_zones table: {zones_total}")
+                logger.info(f"Total records in taxi_zones table: {zones_total}")
+            except FileNotFoundError as e:
+                print(f"Skipping taxi_zones: {e}")
+                logger.warning(f"Skipping taxi_zones: {e}")
+            except Exception as e:
+                print(f"An error occurred loading taxi_zones: {e}")
+                logger.error(f"An error occurred loading taxi_zones: {e}")
+                ok = False
+
+        # Final totals + basic summaries, one grouped aggregate scan of trips (kept in quality_metrics)
+        run_id = tracer.run_id
+        with tracer.step("quality stats"):
+            stats = record_table_stats(con, run_id, "load", "trips_clean" if stream else "trips")
+        yellow_stats, green_stats = stats["yellow"], stats["green"]
+        logger.info(f"Recorded quality metrics for load run {run_id}")
 
         print("Final Counts")
-        print(f"Yellow trips: {yellow_total:,}")
-        print(f"Green trips: {green_total:,}")
+        print(f"Yellow trips: {yellow_stats['row_count']:,}")
+        print(f"Green trips: {green_stats['row_count']:,}")
         print(f"Emissions records: {emissions_total:,}")
 
         # Compute basic descriptive stats
         print("Basic Summaries:")
-        avg_yellow_distance = con.execute("SELECT AVG(trip_distance) FROM yellow_trips").fetchone()[0]
-        total_yellow_passengers = con.execute("SELECT SUM(passenger_count) FROM yellow_trips").fetchone()[0]
+        avg_yellow_distance = yellow_stats["avg_distance"]
+        total_yellow_passengers = yellow_stats["total_passengers"]
 
-        avg_green_distance = con.execute("SELECT AVG(trip_distance) FROM green_trips").fetchone()[0]
-        total_green_passengers = con.execute("SELECT SUM(passenger_count) FROM green_trips").fetchone()[0]
+        avg_green_distance = green_stats["avg_distance"]
+        total_green_passengers = green_stats["total_passengers"]
 
         print(f"Avg Yellow trip distance: {avg_yellow_distance:.2f}")
         print(f"Total Yellow passengers: {total_yellow_passengers:,}")
@@ -199,7 +579,42 @@ def load_parquet_files():
     except Exception as e:
         print(f"An error occurred: {e}")
         logger.error(f"An error occurred: {e}")
+        ok = False
+    finally:
+        tracer.close()
+    return ok
 
 
 if __name__ == "__main__":
-    load_parquet_files()
+    parser = argparse.ArgumentParser(description="Load TLC trip parquet files into DuckDB")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="number of concurrent downloads")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="requests per second allowed per host")
+    parser.add_argument("--burst", type=int, default=DEFAULT_BURST, help="token bucket capacity per host")
+    parser.add_argument("--base-url", default=TLC_BASE_URL, help="source of the monthly files (https://, http:// or file://)")
+    parser.add_argument("--full-refresh", action="store_true", help="drop trip tables and the load manifest first")
+    parser.add_argument("--mirror-dir", default=DEFAULT_MIRROR_DIR, help="local parquet mirror directory")
+    parser.add_argument("--mirror-max-gb", type=float, default=DEFAULT_MAX_BYTES / 1024 ** 3,
+                        help="size bound of the parquet mirror (least recently used files are evicted)")
+    parser.add_argument("--offline", action="store_true", help="only read files already in the parquet mirror")
+    parser.add_argument("--clean-on-ingest", action="store_true",
+                        help="apply the clean_trips validity rules while reading (use with --full-refresh when switching)")
+    parser.add_argument("--stream", action="store_true",
+                        help="validate, de-duplicate and append each month to trips_clean in bounded batches "
+                             "(then run clean.py --streamed; use with --full-refresh when switching)")
+    parser.add_argument("--batch-rows", type=int, default=DEFAULT_BATCH_ROWS,
+                        help="rows read per batch with --stream (whole parquet row groups)")
+    parser.add_argument("--zones", action="store_true",
+                        help=f"keep the pickup/dropoff zone IDs and load the zone lookup from {ZONES_PATH}, "
+                             "downloading it if missing (use with --full-refresh when switching)")
+    parser.add_argument("--profile", action="store_true",
+                        help="keep DuckDB's EXPLAIN ANALYZE profile of every statement under logs/profiles/")
+    add_db_arguments(parser)
+    args = parser.parse_args()
+
+    ok = load_parquet_files(workers=args.workers, rate=args.rate, burst=args.burst, base_url=args.base_url,
+                           full_refresh=args.full_refresh, mirror_dir=args.mirror_dir,
+                           mirror_max_bytes=int(args.mirror_max_gb * 1024 ** 3), offline=args.offline,
+                           clean_on_ingest=args.clean_on_ingest, stream=args.stream, batch_rows=args.batch_rows,
+                           zones=args.zones, profile=args.profile,
+                           settings=settings_from_args(args))
+    sys.exit(0 if ok else 1)
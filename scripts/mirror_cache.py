@@ -0,0 +1,161 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+from urllib.parse import urlparse
+
+# Uses the calling stage's logging configuration (e.g. logs/load.log)
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIRROR_DIR = os.path.join("data", "mirror")
+DEFAULT_MAX_BYTES = 50 * 1024 ** 3  # 50 GB
+
+
+def file_checksum(path):
+    # sha256 of a local file, read in 1 MB chunks
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ParquetMirror:
+    # On-disk mirror of the monthly TLC parquet files with size-bounded LRU eviction.
+    # Entries are validated by size (and sha256 when verify=True) before being served;
+    # in offline mode only mirrored files are returned and nothing is downloaded.
+    def __init__(self, root=DEFAULT_MIRROR_DIR, max_bytes=DEFAULT_MAX_BYTES, offline=False, verify=True):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.verify = verify
+        self.index_path = os.path.join(root, "index.json")
+        self.lock = threading.Lock()
+        self.pinned = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.bytes_downloaded = 0
+
+        os.makedirs(root, exist_ok=True)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                self.index = json.load(f)
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def _name(self, url):
+        return os.path.basename(urlparse(url).path)
+
+    def _valid(self, name, entry):
+        # Entry is usable if the file is present with the recorded size (and checksum)
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path) or os.path.getsize(path) != entry["size"]:
+            return False
+        return not self.verify or file_checksum(path) == entry["checksum"]
+
+    def _evict(self):
+        # Drop least recently used, unpinned files until the mirror fits in max_bytes
+        total = sum(entry["size"] for entry in self.index.values())
+        for name, entry in sorted(self.index.items(), key=lambda item: item[1]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            if name in self.pinned:
+                continue
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+            del self.index[name]
+            total -= entry["size"]
+            logger.info(f"Evicted {name} from parquet mirror ({entry['size']:,} bytes)")
+
+    def fetch(self, url, etag=None, size=None, limiter=None):
+        # Return (local_path, size, etag, checksum) for url, downloading on a miss.
+        # The returned file is pinned against eviction until release() is called.
+        name = self._name(url)
+        path = os.path.join(self.root, name)
+
+        with self.lock:
+            entry = self.index.get(name)
+        fresh = entry is not None and (self.offline or (etag is not None and entry["etag"] == etag
+                                                         and (size is None or entry["size"] == size)))
+        if fresh and self._valid(name, entry):
+            with self.lock:
+                entry["last_access"] = time.time()
+                self.pinned.add(name)
+                self.hits += 1
+                self.bytes_saved += entry["size"]
+                self._save_index()
+            logger.info(f"Parquet mirror hit: {name}")
+            return path, entry["size"], entry["etag"], entry["checksum"]
+
+        if self.offline:
+            raise FileNotFoundError(f"{name} is not in the parquet mirror (offline mode)")
+
+        # Miss: download to a temp file next to the mirror copy, then swap it in
+        if limiter is not None:
+            limiter.acquire(url)
+        tmp_path = f"{path}.{threading.get_ident()}.part"
+        digest = hashlib.sha256()
+        try:
+            with urllib.request.urlopen(url) as resp, open(tmp_path, "wb") as out:
+                while chunk := resp.read(1 << 20):
+                    digest.update(chunk)
+                    out.write(chunk)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        downloaded = os.path.getsize(tmp_path)
+        if size is not None and downloaded != size:
+            os.remove(tmp_path)
+            raise IOError(f"Size mismatch for {url}: expected {size:,} bytes, got {downloaded:,}")
+
+        with self.lock:
+            os.replace(tmp_path, path)
+            entry = {
+                "url": url,
+                "etag": etag,
+                "size": downloaded,
+                "checksum": digest.hexdigest(),
+                "last_access": time.time(),
+            }
+            self.index[name] = entry
+            self.pinned.add(name)
+            self.misses += 1
+            self.bytes_downloaded += downloaded
+            self._evict()
+            self._save_index()
+        logger.info(f"Parquet mirror miss: downloaded {name} ({downloaded:,} bytes)")
+        return path, downloaded, etag, entry["checksum"]
+
+    def cached_etag(self, url):
+        # ETag recorded for a mirrored file, or None
+        with self.lock:
+            entry = self.index.get(self._name(url))
+        return entry["etag"] if entry else None
+
+    def release(self, path):
+        # Unpin a file returned by fetch() so it may be evicted again
+        with self.lock:
+            self.pinned.discard(os.path.basename(path))
+            self._evict()
+            self._save_index()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_saved": self.bytes_saved,
+            "bytes_downloaded": self.bytes_downloaded,
+        }
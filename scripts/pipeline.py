@@ -0,0 +1,401 @@
+import os
+import sys
+import json
+import hashlib
+import logging
+import argparse
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from trip_rules import CAB_COLUMNS, relation_type, ensure_clean_table
+from mirror_cache import ParquetMirror, DEFAULT_MIRROR_DIR, DEFAULT_MAX_BYTES, file_checksum
+from load import (TLC_BASE_URL, EMISSIONS_PATH, ZONES_PATH, DEFAULT_WORKERS, DEFAULT_RATE, DEFAULT_BURST,
+                  DEFAULT_BATCH_ROWS, HostRateLimiter, prepare_trips, load_cab_trips, load_emissions, load_zones)
+from clean import DEFAULT_DEDUP_WORKERS, clean_cab
+from analysis import run_analysis
+from quality import record_table_stats
+from tracing import Tracer
+from db_config import add_db_arguments, settings_from_args, dbt_env, describe
+
+# Make sure logs/ folder exists
+os.makedirs("logs", exist_ok=True)
+
+# The stage modules configure their own log files on import; a pipeline run logs to pipeline.log
+logging.basicConfig(
+    filename="logs/pipeline.log",
+    encoding="utf-8",
+    filemode="a",
+    format="{asctime} - {levelname} - {message}",
+    style="{",
+    datefmt="%Y-%m-%d %H:%M",
+    level="DEBUG",
+    force=True
+)
+
+logger = logging.getLogger(__name__)
+
+DBT_DIR = "dbt"
+DBT_MODELS_DIR = os.path.join(DBT_DIR, "models")
+DEFAULT_MAX_PARALLEL = 4
+
+# dbt models built by each dbt stage
+DBT_SELECT = {
+    "transform": ["trips_transformed", "yellow_trips_transformed", "green_trips_transformed", "trips_sample"],
+    "rollup": ["trip_co2_rollup", "trip_extremes", "trip_zone_co2"],
+}
+
+
+def pipeline_stages():
+    # Stage name -> (upstream stages, kind), in dependency order. "duckdb" stages run
+    # concurrently, each on its own cursor of the runner's connection; "main" stages run
+    # alone on the main thread; "dbt" stages run alone with the connection closed, since
+    # dbt opens emissions.duckdb itself.
+    stages = {"prepare": ((), "main")}
+    for cab in CAB_COLUMNS:
+        stages[f"load_{cab}"] = (("prepare",), "duckdb")
+    stages["load_emissions"] = (("prepare",), "duckdb")
+    stages["load_zones"] = (("prepare",), "duckdb")
+    for cab in CAB_COLUMNS:
+        stages[f"clean_{cab}"] = ((f"load_{cab}",), "duckdb")
+    stages["transform"] = (tuple(f"clean_{cab}" for cab in CAB_COLUMNS) + ("load_emissions",), "dbt")
+    stages["rollup"] = (("transform",), "dbt")
+    stages["analyze"] = (("rollup", "load_zones"), "main")
+    return stages
+
+
+STAGES = pipeline_stages()
+
+# Stages that always run: they are incremental against load_manifest themselves
+ALWAYS_RUN = {"prepare"} | {f"load_{cab}" for cab in CAB_COLUMNS}
+
+
+def expand_stage(name):
+    # A stage name, or a group prefix such as "load" or "clean" for every cab type's stage
+    matches = [stage for stage in STAGES if stage == name or stage.startswith(f"{name}_")]
+    if not matches:
+        raise ValueError(f"Unknown stage {name!r}; stages are: {', '.join(STAGES)}")
+    return matches
+
+
+def downstream(names):
+    # The given stages and every stage that depends on them, in dependency order
+    selected = set(names)
+    for stage, (deps, _) in STAGES.items():
+        if any(dep in selected for dep in deps):
+            selected.add(stage)
+    return [stage for stage in STAGES if stage in selected]
+
+
+def select_stages(only=None, start=None):
+    if only:
+        names = {stage for name in only for stage in expand_stage(name)}
+        return [stage for stage in STAGES if stage in names]
+    if start:
+        return downstream(expand_stage(start))
+    return list(STAGES)
+
+
+def models_checksum():
+    # Changes to any dbt model or schema file invalidate the dbt stages
+    digest = hashlib.sha256()
+    for root, _, files in sorted(os.walk(DBT_MODELS_DIR)):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(path.encode())
+            digest.update(file_checksum(path).encode())
+    return digest.hexdigest()
+
+
+def ensure_pipeline_state(con):
+    # Last successful run of each stage, with the key of the inputs it ran on
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS pipeline_state (
+            stage VARCHAR PRIMARY KEY,
+            input_key VARCHAR,
+            output_key VARCHAR,
+            run_id VARCHAR,
+            finished_at TIMESTAMP
+        );
+    """)
+
+
+def read_pipeline_state(con):
+    rows = con.execute("SELECT stage, input_key, output_key FROM pipeline_state").fetchall()
+    return {stage: (input_key, output_key) for stage, input_key, output_key in rows}
+
+
+class PipelineRunner:
+    # Runs the selected stages of STAGES, independent branches in parallel, on one DuckDB
+    # instance whose threads and memory_limit are shared by every concurrent stage
+    def __init__(self, options, settings):
+        self.options = options
+        self.settings = settings
+        self.tracer = Tracer("pipeline", profile=options.profile)
+        self.run_id = self.tracer.run_id
+        self.limiter = HostRateLimiter(rate=options.rate, burst=options.burst)
+        self.mirror = ParquetMirror(root=options.mirror_dir, max_bytes=int(options.mirror_max_gb * 1024 ** 3),
+                                    offline=options.offline)
+        self.con = None
+        self.input_keys = {}
+        self.output_keys = {}
+        self.status = {}
+        self.seconds = {}
+
+    def connect(self):
+        self.con = self.tracer.connect(self.settings)
+        ensure_pipeline_state(self.con)
+
+    def stage_options(self, name):
+        # Settings and source files, besides upstream stages, that change a stage's output
+        if name.startswith("clean_"):
+            return {"clean_on_ingest": self.options.clean_on_ingest, "fingerprint": self.options.fingerprint,
+                    "stream": self.options.stream}
+        if name == "load_emissions":
+            return file_checksum(EMISSIONS_PATH)
+        if name == "load_zones":
+            return file_checksum(ZONES_PATH) if self.options.zones and os.path.exists(ZONES_PATH) else None
+        if name in DBT_SELECT:
+            return models_checksum()
+        return None
+
+    def input_key(self, name):
+        deps, _ = STAGES[name]
+        parts = {"upstream": {dep: self.output_keys.get(dep) for dep in deps}, "options": self.stage_options(name)}
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+    def output_key(self, name):
+        # Loads report what they committed (so unchanged months keep downstream stages skipped);
+        # every other stage's output is determined by its inputs
+        if name.startswith("load_") and name.split("_", 1)[1] in CAB_COLUMNS:
+            if relation_type(self.con, "load_manifest") is None:
+                return None
+            cab = name.split("_", 1)[1]
+            row = self.con.execute("""
+                SELECT COUNT(*), SUM(row_count), MAX(loaded_at) FROM load_manifest WHERE cab_type = ?
+            """, [cab]).fetchone()
+            return json.dumps(row, default=str)
+        return self.input_keys.get(name)
+
+    def stage_function(self, name):
+        options = self.options
+        if name == "prepare":
+            def run(con):
+                prepare_trips(con, full_refresh=options.full_refresh, stream=options.stream)
+                ensure_clean_table(con)
+            return run
+        if name == "load_emissions":
+            return lambda con: load_emissions(con)
+        if name == "load_zones":
+            # The zone lookup is only needed with --zones; without the CSV (and no way to
+            # download it) the stage is skipped with a warning rather than blocking analyze
+            def run(con):
+                if not options.zones:
+                    return
+                try:
+                    load_zones(con, offline=options.offline)
+                except FileNotFoundError as e:
+                    print(f"Skipping taxi_zones: {e}")
+                    logger.warning(f"Skipping taxi_zones: {e}")
+            return run
+        if name in DBT_SELECT:
+            return lambda con: self.run_dbt(DBT_SELECT[name])
+        if name == "analyze":
+            return lambda con: run_analysis(con, self.tracer)
+
+        step, cab = name.split("_", 1)
+        if step == "load":
+            def run(con):
+                load_cab_trips(con, cab, workers=options.workers, limiter=self.limiter, base_url=options.base_url,
+                               mirror=self.mirror, clean_on_ingest=options.clean_on_ingest, stream=options.stream,
+                               batch_rows=options.batch_rows, zones=options.zones)
+                record_table_stats(con, self.run_id, "load", "trips_clean" if options.stream else "trips",
+                                   cabs=[cab])
+            return run
+        return lambda con: clean_cab(con, self.run_id, cab, clean_on_ingest=options.clean_on_ingest,
+                                     workers=options.dedup_workers, fingerprint=options.fingerprint,
+                                     streamed=options.stream)
+
+    def run_dbt(self, models):
+        # dbt gets the runner's database and resource settings through DUCKDB_* variables
+        command = ["dbt", "run", "--project-dir", DBT_DIR, "--profiles-dir", DBT_DIR, "--select", *models]
+        logger.info(f"Running {' '.join(command)}")
+        subprocess.run(command, check=True, env=dbt_env(self.settings))
+
+    def execute(self, name, con):
+        # Run one stage on con (a cursor for concurrent stages); returns wall seconds
+        start = time.perf_counter()
+        print(f"Stage {name} started")
+        logger.info(f"Stage {name} started")
+        try:
+            with self.tracer.step(name):
+                self.stage_function(name)(con)
+        finally:
+            if con is not None and con is not self.con:
+                con.close()
+        return time.perf_counter() - start
+
+    def finish(self, name, status, seconds=0.0, error=None):
+        self.status[name] = status
+        self.seconds[name] = seconds
+        if status == "done":
+            self.output_keys[name] = self.output_key(name)
+            self.con.execute("INSERT OR REPLACE INTO pipeline_state VALUES (?, ?, ?, ?, current_timestamp);",
+                             [name, self.input_keys.get(name), self.output_keys[name], self.run_id])
+        msg = f"Stage {name} {status}" + (f" in {seconds:.1f}s" if status == "done" else "")
+        if error is not None:
+            msg += f": {error}"
+            print(msg)
+            logger.error(msg)
+        else:
+            print(msg)
+            logger.info(msg)
+
+    def run(self, selected, force=False):
+        self.connect()
+        if self.options.full_refresh:
+            self.con.execute("DELETE FROM pipeline_state;")
+        state = read_pipeline_state(self.con)
+
+        # Stages left out of the selection keep the outputs of their last run
+        for name in STAGES:
+            if name not in selected:
+                self.output_keys[name] = (self.output_key(name) if name in ALWAYS_RUN and name != "prepare"
+                                          else state.get(name, (None, None))[1])
+
+        todo = list(selected)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.options.max_parallel) as pool:
+            while todo or running:
+                progressed = False
+                for name in list(todo):
+                    deps, kind = STAGES[name]
+                    if any(dep in todo or dep in running.values() for dep in deps):
+                        continue
+                    if any(self.status.get(dep) in ("failed", "blocked") for dep in deps):
+                        todo.remove(name)
+                        self.finish(name, "blocked")
+                        progressed = True
+                        continue
+
+                    key = self.input_keys[name] = self.input_key(name)
+                    if not force and name not in ALWAYS_RUN and state.get(name, (None,))[0] == key:
+                        todo.remove(name)
+                        self.output_keys[name] = state[name][1]
+                        self.finish(name, "skipped")
+                        progressed = True
+                        continue
+
+                    if kind == "duckdb":
+                        todo.remove(name)
+                        running[pool.submit(self.execute, name, self.con.cursor())] = name
+                        progressed = True
+                    elif not running:
+                        # Exclusive stage: nothing else is running at this point
+                        todo.remove(name)
+                        self.run_exclusive(name, kind)
+                        progressed = True
+                        break
+
+                if running and not progressed:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        if future.exception() is not None:
+                            self.finish(name, "failed", error=future.exception())
+                        else:
+                            self.finish(name, "done", future.result())
+
+        return self.status
+
+    def run_exclusive(self, name, kind):
+        if kind == "dbt":
+            self.con.close()
+        try:
+            seconds = self.execute(name, None if kind == "dbt" else self.con)
+            error = None
+        except Exception as e:
+            seconds, error = 0.0, e
+        finally:
+            if kind == "dbt":
+                self.connect()
+        if error is None:
+            self.finish(name, "done", seconds)
+        else:
+            self.finish(name, "failed", error=error)
+
+    def close(self):
+        stats = self.mirror.stats()
+        logger.info(f"Parquet mirror: {stats['hits']} hits, {stats['misses']} misses, "
+                    f"{stats['bytes_saved']:,} bytes saved, {stats['bytes_downloaded']:,} bytes downloaded")
+        print(f"{'stage':<16} {'status':<8} {'seconds':>9}")
+        for name in STAGES:
+            if name in self.status:
+                print(f"{name:<16} {self.status[name]:<8} {self.seconds[name]:>9.1f}")
+        self.tracer.close()
+
+
+def run_pipeline(options, settings):
+    selected = select_stages(only=options.only, start=options.start)
+    force = options.force or bool(options.only or options.start)
+    logger.info(f"Running stages {', '.join(selected)} (force={force})")
+    logger.info(f"DuckDB settings: {describe(settings)}")
+
+    runner = PipelineRunner(options, settings)
+    failed = False
+    try:
+        status = runner.run(selected, force=force)
+        failed = any(value in ("failed", "blocked") for value in status.values())
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        logger.error(f"An error occurred: {e}")
+        failed = True
+    finally:
+        runner.close()
+    return not failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run load → clean → transform → analyze as one stage DAG")
+    parser.add_argument("--only", nargs="+", metavar="STAGE",
+                        help="run only these stages (or groups, e.g. 'clean' for every clean_<cab>)")
+    parser.add_argument("--from", dest="start", metavar="STAGE",
+                        help="run this stage (or group) and everything downstream of it")
+    parser.add_argument("--force", action="store_true", help="run stages even if their inputs are unchanged")
+    parser.add_argument("--list", action="store_true", help="print the stage graph and exit")
+    parser.add_argument("--full-refresh", action="store_true", help="drop trip tables, manifests and stage state first")
+    parser.add_argument("--max-parallel", type=int, default=DEFAULT_MAX_PARALLEL,
+                        help="independent stages run at the same time")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="concurrent downloads per load stage")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="requests per second allowed per host")
+    parser.add_argument("--burst", type=int, default=DEFAULT_BURST, help="token bucket capacity per host")
+    parser.add_argument("--base-url", default=TLC_BASE_URL, help="source of the monthly files")
+    parser.add_argument("--mirror-dir", default=DEFAULT_MIRROR_DIR, help="local parquet mirror directory")
+    parser.add_argument("--mirror-max-gb", type=float, default=DEFAULT_MAX_BYTES / 1024 ** 3,
+                        help="size bound of the parquet mirror")
+    parser.add_argument("--offline", action="store_true", help="only read files already in the parquet mirror")
+    parser.add_argument("--clean-on-ingest", action="store_true", help="apply the validity rules while loading")
+    parser.add_argument("--stream", action="store_true",
+                        help="load months straight into trips_clean in bounded batches; clean stages only check")
+    parser.add_argument("--batch-rows", type=int, default=DEFAULT_BATCH_ROWS,
+                        help="rows read per batch with --stream")
+    parser.add_argument("--zones", action="store_true",
+                        help=f"keep the pickup/dropoff zone IDs and load the zone lookup from {ZONES_PATH}")
+    parser.add_argument("--dedup-workers", type=int, default=DEFAULT_DEDUP_WORKERS,
+                        help="pickup-month partitions de-duplicated in parallel per clean stage")
+    parser.add_argument("--fingerprint", action="store_true", help="de-duplicate on a 64-bit hash of the trip key")
+    parser.add_argument("--profile", action="store_true",
+                        help="keep DuckDB's EXPLAIN ANALYZE profile of every statement under logs/profiles/")
+    # threads and memory_limit are one budget shared by all concurrent stages (and dbt)
+    add_db_arguments(parser)
+    args = parser.parse_args()
+
+    if args.list:
+        for name, (deps, kind) in STAGES.items():
+            print(f"{name:<16} {kind:<7} <- {', '.join(deps) or '-'}")
+        sys.exit(0)
+
+    ok = run_pipeline(args, settings_from_args(args))
+    print("Pipeline run completed" if ok else "Pipeline run failed")
+    logger.info("Pipeline run completed" if ok else "Pipeline run failed")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,82 @@
+import uuid
+from datetime import datetime
+
+from trip_rules import CAB_COLUMNS, PICKUP, rejection_counts_sql
+
+# Data-quality statistics gathered in a single grouped aggregate per table, replacing
+# the separate COUNT/AVG/SUM scans in load.py and clean.py. Results are kept in
+# quality_metrics, one row per (run, stage, table, cab type).
+
+STAT_NAMES = (
+    "row_count",
+    "bad_passengers",
+    "bad_distance",
+    "bad_duration",
+    "avg_distance",
+    "total_passengers",
+    "min_pickup",
+    "max_pickup",
+)
+
+
+def new_run_id():
+    # Sortable, unique id for one run of a pipeline stage
+    return f"{datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+
+
+def ensure_quality_metrics(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS quality_metrics (
+            run_id VARCHAR,
+            stage VARCHAR,
+            table_name VARCHAR,
+            cab_type VARCHAR,
+            row_count BIGINT,
+            bad_passengers BIGINT,
+            bad_distance BIGINT,
+            bad_duration BIGINT,
+            avg_distance DOUBLE,
+            total_passengers DOUBLE,
+            min_pickup TIMESTAMP,
+            max_pickup TIMESTAMP,
+            recorded_at TIMESTAMP,
+            PRIMARY KEY (run_id, stage, table_name, cab_type)
+        );
+    """)
+
+
+def table_stats(con, table, cabs=None):
+    # cab type -> row count, per-rule violations and summary aggregates, from one grouped scan
+    # (of every cab type, or only `cabs`)
+    cabs = list(cabs or CAB_COLUMNS)
+    rows = con.execute(f"""
+        SELECT
+            CAST(cab_type AS VARCHAR) AS cab,
+            COUNT(*) AS row_count,
+            {rejection_counts_sql()},
+            AVG(trip_distance) AS avg_distance,
+            SUM(passenger_count) AS total_passengers,
+            MIN({PICKUP}) AS min_pickup,
+            MAX({PICKUP}) AS max_pickup
+        FROM {table}
+        WHERE cab_type IN ({', '.join(repr(cab) for cab in cabs)})
+        GROUP BY cab_type
+    """).fetchall()
+
+    # Cab types with no rows still get a (zero) entry
+    stats = {cab: dict(zip(STAT_NAMES, (0, 0, 0, 0, None, 0, None, None))) for cab in cabs}
+    for cab, *values in rows:
+        stats[cab] = dict(zip(STAT_NAMES, values))
+    return stats
+
+
+def record_table_stats(con, run_id, stage, table, cabs=None):
+    # Gather stats for a table and store them under (run_id, stage, table, cab type)
+    stats = table_stats(con, table, cabs)
+    ensure_quality_metrics(con)
+    for cab, cab_stats in stats.items():
+        con.execute(
+            "INSERT OR REPLACE INTO quality_metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, current_timestamp);",
+            [run_id, stage, table, cab] + [cab_stats[name] for name in STAT_NAMES],
+        )
+    return stats
@@ -0,0 +1,266 @@
+import sys
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from datetime import date
+
+import numpy as np
+
+from db_config import add_db_arguments, settings_from_args, connect
+from trip_rules import CAB_COLUMNS, relation_type
+
+# Parameterized CO2 queries over the hourly rollup (trip_co2_rollup) and the pickup zone
+# aggregate (trip_zone_co2) for ad-hoc cab types and date ranges. The cab type and dates are
+# bound as parameters, never written into the SQL; results are kept in
+# an LRU cache keyed by the arguments and the data version, so repeated dashboard and
+# report calls skip DuckDB until new months are loaded or the rollup is refreshed.
+
+# Uses the calling stage's logging configuration (e.g. logs/analysis.log)
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 256
+DEFAULT_START = date(2015, 1, 1)
+DEFAULT_END = date(2024, 12, 31)
+
+# Rollup columns a profile/extremes query groups by
+BUCKETS = {
+    "hour": "hour_of_day",
+    "day": "day_of_week",
+    "week": "week_of_year",
+    "month": "month_of_year",
+}
+
+# Period expression of a time series at each grain
+GRAINS = {
+    "hour": "pickup_date + to_hours(hour_of_day)",
+    "day": "pickup_date",
+    "week": "CAST(date_trunc('week', pickup_date) AS DATE)",
+    "month": "year_month",
+    "year": "year(pickup_date)",
+}
+
+ZONES_TBL = "main.trip_zone_co2"
+DEFAULT_TOP_ZONES = 10
+
+# Changes whenever months are (re)loaded or the rollup is refreshed
+DATA_VERSION_SQL = """
+    SELECT
+        (SELECT MAX(refreshed_at) FROM trip_co2_rollup),
+        (SELECT COUNT(*) FROM trip_co2_rollup),
+        (SELECT MAX(loaded_at) FROM load_manifest),
+        (SELECT COUNT(*) FROM load_manifest)
+"""
+
+
+def parse_date(value):
+    # Query dates arrive as date objects or ISO strings; anything else is rejected
+    return value if isinstance(value, date) else date.fromisoformat(str(value))
+
+
+def check_choice(kind, value, choices):
+    if value not in choices:
+        raise ValueError(f"Unknown {kind} {value!r}; expected one of {', '.join(choices)}")
+    return value
+
+
+def zone_labels(con):
+    # location_id -> "Zone (Borough)" from the taxi_zones lookup, or {} if it was not loaded
+    if relation_type(con, "taxi_zones") is None:
+        return {}
+    rows = con.execute("SELECT location_id, zone, borough FROM taxi_zones").fetchall()
+    return {location_id: f"{zone} ({borough})" for location_id, zone, borough in rows}
+
+
+def zones_available(con):
+    return relation_type(con, "trip_zone_co2") == "BASE TABLE"
+
+
+class CO2Queries:
+    # Cached CO2 queries on one DuckDB connection. Results (dicts of NumPy arrays) are shared
+    # between callers and must be treated as read-only.
+    def __init__(self, con, maxsize=DEFAULT_CACHE_SIZE, rollup_tbl="main.trip_co2_rollup"):
+        self.con = con
+        self.maxsize = maxsize
+        self.rollup_tbl = rollup_tbl
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = None
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def data_version(self):
+        # Not prepared: DuckDB can answer MAX/COUNT from table statistics when the statement
+        # is planned, and a prepared plan would keep returning the version it was planned with
+        return self.con.execute(DATA_VERSION_SQL).fetchone()
+
+    def _cached(self, key, compute):
+        # Serve key from the cache for the current data version, or compute and store it
+        version = self.data_version()
+        with self.lock:
+            if version != self.version:
+                if self.cache:
+                    self.invalidations += 1
+                    logger.info(f"Data version changed to {version}; dropped {len(self.cache)} cached results")
+                self.cache.clear()
+                self.version = version
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+            self.misses += 1
+
+        result = compute()
+        with self.lock:
+            self.cache[key] = result
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return result
+
+    def co2_profile(self, cab, bucket, start=DEFAULT_START, end=DEFAULT_END):
+        # Average CO2 per trip for every value of a bucket (hour of day, day of week, ...):
+        # {bucket, avg_co2, trip_count}
+        cab = check_choice("cab type", cab, CAB_COLUMNS)
+        column = BUCKETS[check_choice("bucket", bucket, BUCKETS)]
+        start, end = parse_date(start), parse_date(end)
+
+        def compute():
+            sql = f"""
+                SELECT
+                    {column} AS bucket,
+                    SUM(co2_kgs_sum) / SUM(trip_count) AS avg_co2,
+                    CAST(SUM(trip_count) AS BIGINT) AS trip_count
+                FROM {self.rollup_tbl}
+                WHERE cab_type = $1
+                  AND pickup_date BETWEEN $2 AND $3
+                GROUP BY ALL
+                ORDER BY ALL
+            """
+            return self.con.execute(sql, [cab, start, end]).fetchnumpy()
+
+        return self._cached(("profile", cab, bucket, start, end), compute)
+
+    def co2_extremes(self, cab, bucket, start=DEFAULT_START, end=DEFAULT_END):
+        # ((bucket, avg), (bucket, avg)) of the most and least carbon-heavy bucket values, or
+        # None when there are no trips in the range; picked from the cached profile
+        profile = self.co2_profile(cab, bucket, start, end)
+        values = profile["avg_co2"]
+        if len(values) == 0:
+            return None
+        hi, lo = np.argmax(values), np.argmin(values)
+        return (profile["bucket"][hi], values[hi]), (profile["bucket"][lo], values[lo])
+
+    def co2_series(self, cab, grain, start=DEFAULT_START, end=DEFAULT_END):
+        # CO2 totals per period at a time grain: {period, co2_kgs, trip_count, avg_co2}
+        cab = check_choice("cab type", cab, CAB_COLUMNS)
+        period = GRAINS[check_choice("grain", grain, GRAINS)]
+        start, end = parse_date(start), parse_date(end)
+
+        def compute():
+            sql = f"""
+                SELECT
+                    {period} AS period,
+                    SUM(co2_kgs_sum) AS co2_kgs,
+                    CAST(SUM(trip_count) AS BIGINT) AS trip_count,
+                    SUM(co2_kgs_sum) / SUM(trip_count) AS avg_co2
+                FROM {self.rollup_tbl}
+                WHERE cab_type = $1
+                  AND pickup_date BETWEEN $2 AND $3
+                GROUP BY ALL
+                ORDER BY ALL
+            """
+            return self.con.execute(sql, [cab, start, end]).fetchnumpy()
+
+        return self._cached(("series", cab, grain, start, end), compute)
+
+    def co2_zones(self, cab, start=DEFAULT_START, end=DEFAULT_END):
+        # CO2 per pickup zone and hour of day from trip_zone_co2, long format:
+        # {zone_id, hour_of_day, co2_kgs, trip_count}. The aggregate is monthly, so start and
+        # end are widened to whole months.
+        cab = check_choice("cab type", cab, CAB_COLUMNS)
+        start, end = parse_date(start), parse_date(end)
+
+        def compute():
+            sql = f"""
+                SELECT
+                    zone_id,
+                    hour_of_day,
+                    SUM(co2_kgs_sum) AS co2_kgs,
+                    CAST(SUM(trip_count) AS BIGINT) AS trip_count
+                FROM {ZONES_TBL}
+                WHERE cab_type = $1
+                  AND year_month BETWEEN $2 AND $3
+                GROUP BY ALL
+                ORDER BY ALL
+            """
+            return self.con.execute(sql, [cab, f"{start:%Y-%m}", f"{end:%Y-%m}"]).fetchnumpy()
+
+        return self._cached(("zones", cab, start, end), compute)
+
+    def cache_info(self):
+        return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations,
+                "size": len(self.cache), "maxsize": self.maxsize}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        filename="logs/queries.log",
+        encoding="utf-8",
+        filemode="a",
+        format="{asctime} - {levelname} - {message}",
+        style="{",
+        datefmt="%Y-%m-%d %H:%M",
+        level="DEBUG"
+    )
+
+    parser = argparse.ArgumentParser(description="Ad-hoc CO2 queries over the hourly rollup")
+    parser.add_argument("query", choices=["extremes", "series", "zones"])
+    parser.add_argument("--cab", choices=CAB_COLUMNS, nargs="+", default=list(CAB_COLUMNS))
+    parser.add_argument("--bucket", choices=list(BUCKETS), default="hour", help="bucket for extremes")
+    parser.add_argument("--grain", choices=list(GRAINS), default="month", help="time grain for series")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP_ZONES, help="pickup zones listed by zones")
+    parser.add_argument("--start", type=date.fromisoformat, default=DEFAULT_START, help="first pickup date")
+    parser.add_argument("--end", type=date.fromisoformat, default=DEFAULT_END, help="last pickup date")
+    add_db_arguments(parser)
+    args = parser.parse_args()
+
+    ok = True
+    try:
+        con = connect(settings_from_args(args), read_only=True)
+        queries = CO2Queries(con)
+        labels = zone_labels(con) if args.query == "zones" else {}
+        for cab in args.cab:
+            if args.query == "zones":
+                heatmap = queries.co2_zones(cab, args.start, args.end)
+                zones, inverse = np.unique(heatmap["zone_id"], return_inverse=True)
+                co2 = np.bincount(inverse, weights=heatmap["co2_kgs"], minlength=len(zones))
+                trips = np.bincount(inverse, weights=heatmap["trip_count"], minlength=len(zones))
+                print(f"{cab.upper()} pickup zones by CO2:")
+                for i in np.argsort(co2)[::-1][:args.top]:
+                    zone = labels.get(int(zones[i]), f"zone {zones[i]}")
+                    print(f"  {zone:<48} {co2[i]:>14,.2f} kg  {int(trips[i]):>10,} trips")
+            elif args.query == "extremes":
+                extremes = queries.co2_extremes(cab, args.bucket, args.start, args.end)
+                if extremes is None:
+                    print(f"No {cab} trips between {args.start} and {args.end}")
+                    continue
+                (max_bucket, max_avg), (min_bucket, min_avg) = extremes
+                print(f"{cab.upper()} most carbon-heavy {args.bucket}: {max_bucket}, avg {max_avg:.2f} kg")
+                print(f"{cab.upper()} least carbon-heavy {args.bucket}: {min_bucket}, avg {min_avg:.2f} kg")
+            else:
+                series = queries.co2_series(cab, args.grain, args.start, args.end)
+                periods = series["period"]
+                if periods.dtype.kind == "M":
+                    periods = np.datetime_as_string(periods, unit="m" if args.grain == "hour" else "D")
+                print(f"{cab.upper()} CO2 by {args.grain}:")
+                for period, co2, trips, avg in zip(periods, series["co2_kgs"],
+                                                   series["trip_count"], series["avg_co2"]):
+                    print(f"  {period}  {co2:>14,.2f} kg  {trips:>10,} trips  avg {avg:.2f} kg")
+        logger.info(f"Query cache: {queries.cache_info()}")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        logger.error(f"An error occurred: {e}")
+        ok = False
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,309 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import db_config
+from quality import new_run_id
+
+# Query tracing for the pipeline stages. Tracer.connect() returns a connection whose
+# execute() calls are timed and written as JSON-lines spans to logs/traces.jsonl, one
+# per statement, tagged with the stage and run id. With profiling on, DuckDB's
+# EXPLAIN ANALYZE tree for every statement is kept under logs/profiles/<run id>/.
+# Stages started by one pipeline run share its id through PIPELINE_RUN_ID.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TRACE_PATH = os.path.join("logs", "traces.jsonl")
+DEFAULT_PROFILE_DIR = os.path.join("logs", "profiles")
+SLOWEST_QUERIES = 10
+MAX_SQL_CHARS = 2000
+# Span kinds timing work inside DuckDB: running a statement and fetching its result
+DUCKDB_SPANS = ("query", "fetch")
+
+
+def process_memory_mb():
+    # (current, peak) resident set size of this process in MB; current is None off Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == "darwin" else 1024)
+    current = None
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError):
+        pass
+    return current, peak
+
+
+def profile_rows_in(node):
+    # Rows read by the leaf operators (table scans, parquet/csv readers) of a DuckDB
+    # JSON profile; key names differ between DuckDB releases
+    children = node.get("children") or []
+    if children:
+        return sum(profile_rows_in(child) for child in children)
+    for key in ("operator_rows_scanned", "operator_cardinality", "cardinality"):
+        if node.get(key):
+            return node[key]
+    return 0
+
+
+class TracedResult:
+    # Returned by TracedConnection.execute(); every fetch is timed as a span of its own, linked
+    # to the statement's span, with the rows it returned
+    def __init__(self, traced, span):
+        self._traced = traced
+        self._span = span
+
+    def _fetch(self, method, count, *args):
+        tracer = self._traced.tracer
+        span = tracer._start_span("fetch", sql=self._span["sql"], query_span=self._span["span_id"])
+        try:
+            result = getattr(self._traced._con, method)(*args)
+        except Exception as e:
+            span["error"] = str(e)
+            tracer._end_span(span)
+            raise
+        span["rows_out"] = count(result)
+        tracer._end_span(span)
+        return result
+
+    def fetchone(self):
+        return self._fetch("fetchone", lambda row: 0 if row is None else 1)
+
+    def fetchmany(self, size=1):
+        return self._fetch("fetchmany", len, size)
+
+    def fetchall(self):
+        return self._fetch("fetchall", len)
+
+    def fetchdf(self):
+        return self._fetch("fetchdf", len)
+
+    df = fetchdf
+
+    def fetchnumpy(self):
+        return self._fetch("fetchnumpy", lambda arrays: len(next(iter(arrays.values()), [])))
+
+    def arrow(self):
+        return self._fetch("arrow", lambda table: table.num_rows)
+
+    fetch_arrow_table = arrow
+
+    def __getattr__(self, name):
+        return getattr(self._traced._con, name)
+
+
+class TracedConnection:
+    # Wraps a DuckDB connection or cursor; everything but execute/cursor is passed through
+    def __init__(self, tracer, con):
+        self.tracer = tracer
+        self._con = con
+        self._profile_path = None
+        if tracer.profile:
+            # Every statement on this connection writes its EXPLAIN ANALYZE tree as JSON
+            self._profile_path = os.path.join(tracer.profile_dir, f"conn-{id(self):x}.json")
+            con.execute("SET enable_profiling = 'json';")
+            con.execute(f"SET profiling_output = '{self._profile_path}';")
+
+    def execute(self, query, parameters=None):
+        # The statement's span ends as soon as DuckDB returns, so time spent between calls is
+        # not counted; fetching its result is timed separately (see TracedResult)
+        span = self.tracer._start_span("query", sql=" ".join(query.split())[:MAX_SQL_CHARS])
+        try:
+            if parameters is None:
+                self._con.execute(query)
+            else:
+                self._con.execute(query, parameters)
+        except Exception as e:
+            span["error"] = str(e)
+            self.tracer._end_span(span)
+            raise
+        self.tracer._end_span(span, before_write=self._read_profile)
+        return TracedResult(self, span)
+
+    def cursor(self):
+        return self.tracer._wrap(self._con.cursor())
+
+    def _read_profile(self, span):
+        # Rows read and the kept EXPLAIN ANALYZE tree of the statement that just ran
+        if self._profile_path is None or not os.path.exists(self._profile_path):
+            return
+        try:
+            with open(self._profile_path, encoding="utf-8") as f:
+                span["rows_in"] = profile_rows_in(json.load(f))
+            kept = os.path.join(self.tracer.profile_dir, f"{self.tracer.stage}-{span['span_id']:05d}.json")
+            os.replace(self._profile_path, kept)
+            span["profile"] = kept
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read query profile {self._profile_path}: {e}")
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+
+def busy_seconds(intervals):
+    # Length of the union of (start, end) intervals: time during which at least one
+    # statement was running, however many cursors ran concurrently
+    total = 0.0
+    current_start = current_end = None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+class Tracer:
+    # Collects the spans of one stage run and appends them to the trace file as they end
+    def __init__(self, stage, run_id=None, profile=False, trace_path=DEFAULT_TRACE_PATH,
+                 profile_dir=DEFAULT_PROFILE_DIR):
+        self.stage = stage
+        self.run_id = run_id or os.environ.get("PIPELINE_RUN_ID") or new_run_id()
+        self.profile = profile or os.environ.get("PIPELINE_PROFILE") == "1"
+        self.trace_path = trace_path
+        self.profile_dir = os.path.join(profile_dir, self.run_id)
+        self.spans = []
+        self._intervals = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._next_id = 0
+
+        os.makedirs(os.path.dirname(trace_path) or ".", exist_ok=True)
+        if self.profile:
+            os.makedirs(self.profile_dir, exist_ok=True)
+        self._file = open(trace_path, "a", encoding="utf-8", buffering=1)
+        self._stage_span = self._start_span("stage", name=stage)
+
+    def connect(self, settings=None, read_only=False):
+        # A traced connection opened with the resolved DuckDB settings (see db_config)
+        return self._wrap(db_config.connect(settings, read_only=read_only))
+
+    def _wrap(self, con):
+        return TracedConnection(self, con)
+
+    @contextmanager
+    def step(self, name):
+        # Time a block of work; queries issued inside it (on this thread) are tagged with its name
+        steps = self._steps()
+        span = self._start_span("step", name=name)
+        steps.append(name)
+        try:
+            yield span
+        except Exception as e:
+            span["error"] = str(e)
+            raise
+        finally:
+            steps.pop()
+            self._end_span(span)
+
+    def _steps(self):
+        if not hasattr(self._local, "steps"):
+            self._local.steps = []
+        return self._local.steps
+
+    def _start_span(self, kind, **fields):
+        with self._lock:
+            span_id = self._next_id
+            self._next_id += 1
+        steps = self._steps()
+        return {
+            "run_id": self.run_id,
+            "stage": self.stage,
+            "kind": kind,
+            "span_id": span_id,
+            "step": steps[-1] if steps else None,
+            **fields,
+            "started_at": datetime.now().isoformat(timespec="milliseconds"),
+            "thread": threading.current_thread().name,
+            "_start": time.perf_counter(),
+        }
+
+    def _end_span(self, span, before_write=None):
+        end = time.perf_counter()
+        start = span.pop("_start")
+        span["wall_ms"] = round((end - start) * 1000, 3)
+        span["rss_mb"], span["peak_rss_mb"] = process_memory_mb()
+        if before_write is not None:
+            before_write(span)
+        with self._lock:
+            if span["kind"] in DUCKDB_SPANS:
+                self._intervals.append((start, end))
+            self.spans.append(span)
+            self._file.write(json.dumps(span, default=str) + "\n")
+
+    def close(self, top=SLOWEST_QUERIES):
+        # Write the stage span and report the slowest statements of the run. query_ms sums
+        # statement and fetch spans (concurrent cursors overlap); duckdb_ms is the time at
+        # least one of them was running, which never exceeds the stage's wall time.
+        queries = [span for span in self.spans if span["kind"] == "query"]
+        self._stage_span["queries"] = len(queries)
+        self._stage_span["query_ms"] = round(sum(span["wall_ms"] for span in self.spans
+                                                 if span["kind"] in DUCKDB_SPANS), 3)
+        self._stage_span["duckdb_ms"] = round(busy_seconds(self._intervals) * 1000, 3)
+        self._end_span(self._stage_span)
+        self._file.close()
+
+        summary = format_slowest([span for span in self.spans if span["kind"] in DUCKDB_SPANS], top)
+        msg = f"{self.stage} run {self.run_id}: {stage_line(self._stage_span)}"
+        print(msg)
+        print(summary)
+        logger.info(msg)
+        logger.info(f"Slowest queries:\n{summary}")
+
+
+def stage_line(span):
+    # "<n> queries, <s> in DuckDB of <s>" for a stage span; older spans have no duckdb_ms
+    query_ms = span.get("query_ms", 0)
+    duckdb_ms = span.get("duckdb_ms", query_ms)
+    line = f"{span.get('queries', 0)} queries, {duckdb_ms / 1000:.1f}s in DuckDB of {span['wall_ms'] / 1000:.1f}s"
+    if query_ms > duckdb_ms * 1.05:
+        line += f" ({query_ms / 1000:.1f}s summed over concurrent cursors)"
+    return line
+
+
+def format_slowest(spans, top=SLOWEST_QUERIES):
+    # Fixed-width table of the `top` slowest statement and fetch spans
+    lines = [f"{'ms':>10} {'rows in':>13} {'rows out':>11}  {'stage':<10} {'kind':<6} {'step':<20} sql"]
+    for span in sorted(spans, key=lambda s: s["wall_ms"], reverse=True)[:top]:
+        rows_in = "" if span.get("rows_in") is None else f"{span['rows_in']:,}"
+        rows_out = "" if span.get("rows_out") is None else f"{span['rows_out']:,}"
+        lines.append(f"{span['wall_ms']:>10,.1f} {rows_in:>13} {rows_out:>11}  {span['stage']:<10} "
+                     f"{span['kind']:<6} {(span.get('step') or '')[:20]:<20} {span['sql'][:80]}")
+    return "\n".join(lines)
+
+
+def summarize_traces(trace_path=DEFAULT_TRACE_PATH, run_id=None, top=SLOWEST_QUERIES):
+    # Per-stage totals and the slowest queries of one run (the latest by default)
+    with open(trace_path, encoding="utf-8") as f:
+        spans = [json.loads(line) for line in f if line.strip()]
+    if not spans:
+        return "No spans recorded"
+    run_id = run_id or spans[-1]["run_id"]
+    spans = [span for span in spans if span["run_id"] == run_id]
+
+    lines = [f"Run {run_id}"]
+    for span in spans:
+        if span["kind"] == "stage":
+            lines.append(f"  {span['stage']:<10} {stage_line(span)}, peak RSS {span['peak_rss_mb']:,.0f} MB")
+    lines.append(format_slowest([span for span in spans if span["kind"] in DUCKDB_SPANS], top))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize pipeline trace spans")
+    parser.add_argument("--trace-path", default=DEFAULT_TRACE_PATH, help="JSON-lines trace file")
+    parser.add_argument("--run-id", help="run to summarize (default: the latest)")
+    parser.add_argument("--top", type=int, default=SLOWEST_QUERIES, help="number of slowest queries to list")
+    args = parser.parse_args()
+
+    print(summarize_traces(args.trace_path, run_id=args.run_id, top=args.top))
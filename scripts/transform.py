@@ -1,2 +1,243 @@
-import duckdb
 import logging
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tracing import Tracer
+from db_config import add_db_arguments, settings_from_args, load_settings, describe
+from trip_rules import (CAB_COLUMNS, PICKUP, DROPOFF, SOURCE_MONTH, month_partitions, relation_type, drop_relation,
+                        create_compat_views)
+
+# The transform is maintained as dbt models (dbt/models/transformation/trips_transformed.sql).
+# This script is a parallel DuckDB path producing the same rows: emission factors are looked
+# up from the emissions table once per run instead of joined per row, trip duration is
+# computed once, and cab type/pickup month partitions are transformed concurrently on
+# separate cursors, with year_month and month_of_year written as constants of the partition.
+# --verify writes the result to another --target and compares it row by row with the
+# dbt-built table (dbt/tests/parallel_transform_matches_dbt.sql runs the same comparison
+# as a dbt test).
+
+# Configure logging for transform process
+logging.basicConfig(
+    filename="logs/transform.log",
+    encoding="utf-8",
+    filemode="a",
+    format="{asctime} - {levelname} - {message}",
+    style="{",
+    datefmt="%Y-%m-%d %H:%M",
+    level="DEBUG"
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TARGET = "trips_transformed"
+DEFAULT_TRANSFORM_WORKERS = 4
+
+# Time parts are stored as TINYINT (dbt writes BIGINT); every value fits and compares equal.
+# month_of_year is a constant of the pickup-month partition.
+TIME_PARTS = {"hour_of_day": "hour", "day_of_week": "dow", "week_of_year": "week"}
+
+
+def emission_factors(con):
+    # cab type -> co2_grams_per_mile as a typed SQL literal, looked up from emissions once per
+    # run. Keeping the lookup column's type keeps trip_co2_kgs bit-identical to the dbt join.
+    rows = con.execute("""
+        SELECT vehicle_type, CAST(co2_grams_per_mile AS VARCHAR), typeof(co2_grams_per_mile)
+        FROM emissions
+    """).fetchall()
+    factors = {vehicle_type: f"CAST({value} AS {type_name})" for vehicle_type, value, type_name in rows}
+    # Cab types without a factor are dropped, as by the inner join in dbt
+    return {cab: factors[f"{cab}_taxi"] for cab in CAB_COLUMNS if f"{cab}_taxi" in factors}
+
+
+def transform_select(source, factor, ym, predicate, transformed_at):
+    # Transformed trips of one cab type and pickup month; year_month, the emission factor and
+    # the run timestamp are constants of the partition. The timestamp is written as a literal:
+    # a bound parameter is cast again for every row.
+    parts = ",\n".join(f"CAST(EXTRACT('{part}' FROM {PICKUP}) AS TINYINT) AS {column}"
+                       for column, part in TIME_PARTS.items())
+    year_month = "NULL" if ym == "NULL" else f"'{ym}'"
+    month = "NULL" if ym == "NULL" else int(ym[5:])
+    return f"""
+        SELECT
+            t.* EXCLUDE (duration_s),
+            t.trip_distance * {factor} / 1000 AS trip_co2_kgs,
+            CASE
+                WHEN duration_s > 0
+                THEN t.trip_distance / (duration_s / 3600.0)
+                ELSE 0
+            END AS avg_mph,
+            {parts},
+            CAST({month} AS TINYINT) AS month_of_year,
+            CAST({year_month} AS VARCHAR) AS year_month,
+            TIMESTAMP '{transformed_at}' AS transformed_at
+        FROM (
+            SELECT
+                *,
+                DATEDIFF('second', {PICKUP}, {DROPOFF}) AS duration_s
+            FROM {source}
+            WHERE {predicate}
+        ) t
+    """
+
+
+def add_new_columns(con, target, select_sql):
+    # Columns the transform now writes but target lacks (e.g. the zone IDs) are appended, as
+    # dbt's on_schema_change='append_new_columns' does for the dbt model
+    existing = {row[0] for row in con.execute(f"DESCRIBE {target}").fetchall()}
+    for name, type_name, *_ in con.execute(f"DESCRIBE {select_sql}").fetchall():
+        if name not in existing:
+            con.execute(f"ALTER TABLE {target} ADD COLUMN {name} {type_name};")
+            logger.info(f"Added column {name} to {target}")
+
+
+def changed_months(con, source, target):
+    # (cab type, year_month) pickup months holding trips of files (re)loaded since target was
+    # last transformed, as the dbt model's incremental filter selects them: trips are matched
+    # to the manifest by source_month, in source and (once it has the column) in target
+    relations = [source]
+    if SOURCE_MONTH in {row[0] for row in con.execute(f"DESCRIBE {target}").fetchall()}:
+        relations.append(target)
+    months = " UNION ".join(f"""
+        SELECT DISTINCT CAST(r.cab_type AS VARCHAR), strftime(r.{PICKUP}, '%Y-%m')
+        FROM {relation} r
+        JOIN load_manifest m
+          ON m.cab_type = CAST(r.cab_type AS VARCHAR)
+         AND m.year_month = r.{SOURCE_MONTH}
+        WHERE m.loaded_at > (SELECT COALESCE(MAX(transformed_at), TIMESTAMP '1970-01-01') FROM {target})
+    """ for relation in relations)
+    return set(con.execute(months).fetchall())
+
+
+def transform_trips(con, source="trips_clean", target=DEFAULT_TARGET, workers=DEFAULT_TRANSFORM_WORKERS,
+                    full_refresh=False):
+    # Build or incrementally refresh target from source; returns rows written. Partitions are
+    # replaced one cab type and pickup month at a time, on `workers` cursors in parallel.
+    factors = emission_factors(con)
+    if not factors:
+        raise ValueError("No emission factors for any cab type in the emissions table")
+    partitions = [p for p in month_partitions(con, source, "TRUE", list(factors)) if p[3] > 0]
+    transformed_at = con.execute("SELECT CAST(now() AS TIMESTAMP)").fetchone()[0]
+
+    # The transform's columns and types; FALSE prunes the scan (LIMIT 0 does not)
+    cab = next(iter(factors))
+    empty_sql = transform_select(source, factors[cab], '2000-01', 'FALSE', transformed_at)
+    if full_refresh or relation_type(con, target) != "BASE TABLE":
+        drop_relation(con, target)
+        con.execute(f"CREATE TABLE {target} AS {empty_sql}")
+        logger.info(f"Created table {target}")
+    else:
+        add_new_columns(con, target, empty_sql)
+        months = changed_months(con, source, target)
+        partitions = [p for p in partitions if (p[0], p[2]) in months]
+    logger.info(f"Transforming {len(partitions)} partitions of {source} into {target}")
+
+    def run(partition):
+        cab, predicate, ym, _, _ = partition
+        cursor = con.cursor()
+        try:
+            # One transaction per partition, so a failed INSERT leaves the partition's old rows
+            month = "year_month IS NULL" if ym == "NULL" else f"year_month = '{ym}'"
+            cursor.execute("BEGIN TRANSACTION;")
+            try:
+                cursor.execute(f"DELETE FROM {target} WHERE cab_type = '{cab}' AND {month};")
+                written = cursor.execute(
+                    f"INSERT INTO {target} BY NAME {transform_select(source, factors[cab], ym, predicate, transformed_at)}"
+                ).fetchone()[0]
+                cursor.execute("COMMIT;")
+            except Exception:
+                cursor.execute("ROLLBACK;")
+                raise
+        finally:
+            cursor.close()
+        logger.info(f"{cab.capitalize()} {ym}: {written} trips transformed")
+        return written
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return sum(pool.map(run, partitions))
+
+
+def equivalence_check(con, reference, candidate):
+    # (rows only in reference, rows only in candidate), comparing every column except the
+    # run timestamp as a multiset of rows
+    columns = [row[0] for row in con.execute(f"DESCRIBE {reference}").fetchall() if row[0] != "transformed_at"]
+    select = ", ".join(columns)
+    missing = con.execute(f"""
+        SELECT COUNT(*) FROM (SELECT {select} FROM {reference} EXCEPT ALL SELECT {select} FROM {candidate})
+    """).fetchone()[0]
+    extra = con.execute(f"""
+        SELECT COUNT(*) FROM (SELECT {select} FROM {candidate} EXCEPT ALL SELECT {select} FROM {reference})
+    """).fetchone()[0]
+    return missing, extra
+
+
+def run_transform(target=DEFAULT_TARGET, workers=DEFAULT_TRANSFORM_WORKERS, full_refresh=False, verify=False,
+                  profile=False, settings=None):
+    # Returns False if the run failed or --verify found differing rows
+    ok = True
+    tracer = Tracer("transform", profile=profile)
+    try:
+        if verify and target == DEFAULT_TARGET:
+            # The result would be compared with itself
+            raise ValueError(f"--verify compares the result with the dbt-built {DEFAULT_TARGET}; "
+                             f"write it to another --target")
+        settings = settings or load_settings()
+        con = tracer.connect(settings)
+        logger.info("Connected to DuckDB for transform")
+        logger.info(f"DuckDB settings: {describe(settings)}")
+        print("Started parallel transform")
+
+        start = time.perf_counter()
+        with tracer.step("transform"):
+            written = transform_trips(con, target=target, workers=workers, full_refresh=full_refresh)
+        seconds = time.perf_counter() - start
+        if target == DEFAULT_TARGET:
+            create_compat_views(con, target, suffix="_transformed")
+
+        msg = (f"Transformed {written:,} trips into {target} in {seconds:.2f}s "
+               f"({written / seconds if seconds > 0 else 0:,.0f} rows/s, {workers} workers)")
+        print(msg)
+        logger.info(msg)
+
+        if verify:
+            # Row-level comparison with the dbt-built table
+            with tracer.step("verify"):
+                missing, extra = equivalence_check(con, DEFAULT_TARGET, target)
+            msg = f"Equivalence with {DEFAULT_TARGET}: {missing} rows missing, {extra} rows extra"
+            print(msg)
+            if missing or extra:
+                logger.error(msg)
+                ok = False
+            else:
+                logger.info(msg)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        logger.error(f"An error occurred: {e}")
+        ok = False
+    finally:
+        tracer.close()
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parallel DuckDB transform of trips_clean (dbt-equivalent)")
+    parser.add_argument("--target", default=DEFAULT_TARGET,
+                        help="table to write; use another name to compare with the dbt-built trips_transformed")
+    parser.add_argument("--workers", type=int, default=DEFAULT_TRANSFORM_WORKERS,
+                        help="cab type/pickup month partitions transformed in parallel")
+    parser.add_argument("--full-refresh", action="store_true", help="rebuild every partition")
+    parser.add_argument("--verify", action="store_true",
+                        help=f"compare the result row by row with the dbt-built {DEFAULT_TARGET} "
+                             f"(needs another --target)")
+    parser.add_argument("--profile", action="store_true",
+                        help="keep DuckDB's EXPLAIN ANALYZE profile of every statement under logs/profiles/")
+    add_db_arguments(parser)
+    args = parser.parse_args()
+
+    ok = run_transform(target=args.target, workers=args.workers, full_refresh=args.full_refresh,
+                       verify=args.verify, profile=args.profile, settings=settings_from_args(args))
+    print("Transform process completed" if ok else "Transform process failed")
+    logger.info("Transform process completed" if ok else "Transform process failed")
+    sys.exit(0 if ok else 1)
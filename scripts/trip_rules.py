@@ -0,0 +1,189 @@
+# Trip definitions shared by the pipeline stages. This module does not configure
+# logging, so importing it keeps each stage writing to its own log file.
+
+# Raw pickup/dropoff column names differ per cab type (tpep = yellow, lpep = green)
+CAB_COLUMNS = {
+    "yellow": ("tpep_pickup_datetime", "tpep_dropoff_datetime"),
+    "green": ("lpep_pickup_datetime", "lpep_dropoff_datetime"),
+}
+
+# Both cab types are stored in one normalized `trips` table (and trips_clean /
+# trips_transformed after it) with a cab_type column and common timestamp names
+PICKUP = "pickup_ts"
+DROPOFF = "dropoff_ts"
+
+# Columns identifying a duplicate trip
+DEDUP_COLUMNS = ("vendorid", PICKUP, DROPOFF, "passenger_count", "trip_distance")
+
+# Year-month of the TLC file a trip was loaded from. A reloaded file replaces the rows with
+# its source month, which may include pickups dated in other months (stray rows); the pickup
+# month only partitions the cleaned and transformed tables.
+SOURCE_MONTH = "source_month"
+
+# Optional pickup/dropoff taxi zones (TLC LocationID, the key of taxi_zones) -> raw column.
+# Loaded with load.py --zones; NULL otherwise and in files from before the zone IDs (mid-2016).
+LOCATION_COLUMNS = {
+    "pu_location_id": "PULocationID",
+    "do_location_id": "DOLocationID",
+}
+
+TRIPS_DDL = f"""
+    CREATE TABLE IF NOT EXISTS trips (
+        cab_type cab_type,
+        vendorid INTEGER,
+        {PICKUP} TIMESTAMP,
+        {DROPOFF} TIMESTAMP,
+        passenger_count SMALLINT,
+        trip_distance FLOAT,
+        pu_location_id SMALLINT,
+        do_location_id SMALLINT,
+        {SOURCE_MONTH} VARCHAR
+    );
+"""
+
+
+def raw_trip_select(cab, source_sql, ym, locations=False):
+    # SELECT mapping a raw TLC parquet source of one cab type and source month onto the trips
+    # columns; the zone IDs are read only with locations (the source must have them)
+    pickup, dropoff = CAB_COLUMNS[cab]
+    zones = ",\n".join(f"CAST({raw if locations else 'NULL'} AS SMALLINT) AS {column}"
+                       for column, raw in LOCATION_COLUMNS.items())
+    return f"""
+        SELECT
+            CAST('{cab}' AS cab_type) AS cab_type,
+            CAST(vendorid AS INTEGER) AS vendorid,
+            CAST({pickup} AS TIMESTAMP) AS {PICKUP},
+            CAST({dropoff} AS TIMESTAMP) AS {DROPOFF},
+            CAST(passenger_count AS SMALLINT) AS passenger_count,
+            CAST(trip_distance AS FLOAT) AS trip_distance,
+            {zones},
+            CAST('{ym}' AS VARCHAR) AS {SOURCE_MONTH}
+        FROM {source_sql}
+    """
+
+
+def relation_type(con, name):
+    # 'BASE TABLE', 'VIEW' or None for a relation in the main schema
+    row = con.execute(
+        "SELECT table_type FROM information_schema.tables WHERE table_schema = 'main' AND table_name = ?", [name]
+    ).fetchone()
+    return row[0] if row else None
+
+
+def drop_relation(con, name):
+    # Drop a table or view by name, whichever it currently is
+    kind = relation_type(con, name)
+    if kind is not None:
+        con.execute(f"DROP {'VIEW' if kind == 'VIEW' else 'TABLE'} {name};")
+
+
+def ensure_trips_table(con):
+    # Create the cab_type ENUM and the trips table; returns True if trips was just created
+    exists = con.execute("SELECT COUNT(*) FROM duckdb_types() WHERE type_name = 'cab_type'").fetchone()[0]
+    if not exists:
+        con.execute(f"CREATE TYPE cab_type AS ENUM ({', '.join(repr(cab) for cab in CAB_COLUMNS)});")
+    created = relation_type(con, "trips") is None
+    con.execute(TRIPS_DDL)
+    add_new_columns(con, "trips")
+    return created
+
+
+def add_new_columns(con, table):
+    # Columns for tables created before they existed, appended last in TRIPS_DDL order: the
+    # zone IDs, then source_month. Existing rows get their pickup month as source month (the
+    # reload key before it), so their file's next reload still replaces all but stray rows.
+    for column in LOCATION_COLUMNS:
+        con.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} SMALLINT;")
+    columns = {row[0] for row in con.execute(f"DESCRIBE {table}").fetchall()}
+    if SOURCE_MONTH not in columns:
+        con.execute(f"ALTER TABLE {table} ADD COLUMN {SOURCE_MONTH} VARCHAR;")
+        con.execute(f"UPDATE {table} SET {SOURCE_MONTH} = strftime({PICKUP}, '%Y-%m');")
+
+
+def ensure_clean_table(con, source="trips", target="trips_clean"):
+    # Empty target (plus its _clean compat views) with the columns of source, if it does not
+    # exist yet (an existing one gains any missing columns); returns True if just created
+    if relation_type(con, target) is not None:
+        add_new_columns(con, target)
+        return False
+    con.execute(f"CREATE TABLE {target} AS SELECT * FROM {source} LIMIT 0;")
+    create_compat_views(con, target, suffix="_clean")
+    return True
+
+
+def dedup_key(fingerprint=False):
+    # Duplicate-trip key; optionally folded into one 64-bit hash so a window only has to
+    # partition on a single integer
+    key = ", ".join(DEDUP_COLUMNS)
+    return f"hash({key})" if fingerprint else key
+
+
+def month_partitions(con, source, valid_sql, cabs=CAB_COLUMNS):
+    # (cab type, partition predicate, label, total rows, valid rows) per cab type and
+    # pickup month, from one grouped scan
+    # Months are formatted after grouping, so strftime runs once per group instead of per row
+    rows = con.execute(f"""
+        SELECT cab, strftime(month, '%Y-%m') AS ym, total_rows, valid_rows
+        FROM (
+            SELECT
+                CAST(cab_type AS VARCHAR) AS cab,
+                date_trunc('month', {PICKUP}) AS month,
+                COUNT(*) AS total_rows,
+                COUNT(*) FILTER (WHERE {valid_sql}) AS valid_rows
+            FROM {source}
+            WHERE cab_type IN ({', '.join(repr(cab) for cab in cabs)})
+            GROUP BY ALL
+        )
+        ORDER BY ALL
+    """).fetchall()
+
+    partitions = []
+    for cab, ym, total, valid in rows:
+        if ym is None:
+            predicate = f"cab_type = '{cab}' AND {PICKUP} IS NULL"
+        else:
+            predicate = (f"cab_type = '{cab}' AND {PICKUP} >= DATE '{ym}-01' "
+                         f"AND {PICKUP} < DATE '{ym}-01' + INTERVAL 1 MONTH")
+        partitions.append((cab, predicate, ym or "NULL", total, valid))
+    return partitions
+
+
+def create_compat_views(con, table, suffix=""):
+    # Per-cab views (yellow_trips<suffix>, green_trips<suffix>) with the original column names
+    for cab, (pickup, dropoff) in CAB_COLUMNS.items():
+        view = f"{cab}_trips{suffix}"
+        if relation_type(con, view) != "VIEW":
+            drop_relation(con, view)
+        con.execute(f"""
+            CREATE OR REPLACE VIEW {view} AS
+            SELECT
+                vendorid,
+                {PICKUP} AS {pickup},
+                {DROPOFF} AS {dropoff},
+                * EXCLUDE (cab_type, vendorid, {PICKUP}, {DROPOFF})
+            FROM {table}
+            WHERE cab_type = '{cab}';
+        """)
+
+
+def validity_rules(pickup=PICKUP, dropoff=DROPOFF):
+    # Rule name -> predicate a valid trip satisfies: passenger_count > 0,
+    # 0 < distance <= 100 miles and duration of at most 24 hours
+    return {
+        "passengers": "passenger_count > 0",
+        "distance": "trip_distance > 0 AND trip_distance <= 100",
+        "duration": f"DATEDIFF('hour', {pickup}, {dropoff}) <= 24",
+    }
+
+
+def valid_trip_predicate(pickup=PICKUP, dropoff=DROPOFF):
+    # WHERE clause keeping only trips that pass every rule (NULLs fail, as in clean_trips)
+    return " AND ".join(f"({rule})" for rule in validity_rules(pickup, dropoff).values())
+
+
+def rejection_counts_sql(pickup=PICKUP, dropoff=DROPOFF):
+    # Aggregate expressions counting the rows that fail each rule, in validity_rules() order
+    return ",\n".join(
+        f"COUNT(*) FILTER (WHERE ({rule}) IS NOT TRUE) AS bad_{name}"
+        for name, rule in validity_rules(pickup, dropoff).items()
+    )
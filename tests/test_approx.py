@@ -0,0 +1,84 @@
+import os
+import sys
+from datetime import date
+
+import duckdb
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+import approx  # noqa: E402
+
+START, END = date(2023, 1, 1), date(2024, 12, 31)
+TRIPS_PER_MONTH = 400
+
+
+@pytest.fixture
+def con():
+    # 24 months of yellow trips and 2 of green, every trip distinct and every pickup time
+    # shared by two trips; CO2 and speed follow the same pattern in every month. The sample
+    # holds about half of the yellow trips in 3 months and no green trips.
+    con = duckdb.connect()
+    con.execute(f"""
+        CREATE TABLE main.trips_transformed AS
+        SELECT
+            cab_type,
+            CAST(i % 2 AS INTEGER) AS vendorid,
+            month_start + INTERVAL (i // 2) MINUTE AS pickup_ts,
+            month_start + INTERVAL (i // 2 + 10) MINUTE AS dropoff_ts,
+            CAST(1 AS SMALLINT) AS passenger_count,
+            CAST(1 + i % 7 AS FLOAT) AS trip_distance,
+            CAST(0.2 * (i % 13) AS FLOAT) AS trip_co2_kgs,
+            CAST(5 + i % 11 AS DOUBLE) AS avg_mph,
+            strftime(month_start, '%Y-%m') AS year_month
+        FROM (
+            SELECT 'yellow' AS cab_type, month_start
+            FROM range(TIMESTAMP '2023-01-01', TIMESTAMP '2025-01-01', INTERVAL 1 MONTH) m(month_start)
+            UNION ALL
+            SELECT 'green', month_start
+            FROM range(TIMESTAMP '2024-01-01', TIMESTAMP '2024-03-01', INTERVAL 1 MONTH) m(month_start)
+        ), range({TRIPS_PER_MONTH}) r(i)
+    """)
+    con.execute("""
+        CREATE TABLE main.trip_co2_rollup AS
+        SELECT cab_type, year_month, CAST(pickup_ts AS DATE) AS pickup_date, COUNT(*) AS trip_count
+        FROM main.trips_transformed
+        GROUP BY ALL
+    """)
+    con.execute("""
+        CREATE TABLE main.trips_sample AS
+        SELECT *
+        FROM main.trips_transformed
+        WHERE cab_type = 'yellow'
+          AND year_month IN ('2023-02', '2023-09', '2024-05')
+          AND hash(vendorid || ' ' || pickup_ts) % 2 = 0
+    """)
+    yield con
+    con.close()
+
+
+def covers(estimate, exact):
+    value, bound = estimate
+    return abs(value - exact) <= bound
+
+
+def test_sample_missing_months_is_extrapolated(con):
+    exact = approx.exact_summary(con, START, END)
+    summary = approx.approx_summary(con, START, END)
+    yellow = summary["yellow"]
+
+    assert yellow["trips"] == 24 * TRIPS_PER_MONTH
+    assert yellow["uncovered"] == 21 * TRIPS_PER_MONTH
+    for name in ("avg_co2", "avg_mph", "distinct pickup times", "distinct trips"):
+        assert covers(yellow[name], exact["yellow"][name][0]), name
+        assert yellow[name][1] > 0, name
+    # Scaled up from the 3 sampled months rather than counting only what was sampled
+    assert yellow["distinct trips"][0] == pytest.approx(24 * TRIPS_PER_MONTH, rel=0.05)
+
+
+def test_cab_missing_from_sample_is_exact(con):
+    exact = approx.exact_summary(con, START, END)
+    green = approx.approx_summary(con, START, END)["green"]
+
+    assert green == exact["green"]
+    assert green["uncovered"] == 0